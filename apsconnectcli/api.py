@@ -0,0 +1,87 @@
+""" Importable API of apsconnectcli, the same operations the command line tool runs
+
+    from apsconnectcli import api
+
+    cluster = api.ClusterClient()
+    backend = api.install_backend(cluster, 'connector', 'image', {'key': 'value'},
+                                  wait_for='both')
+
+    with api.HubClient.from_profile() as hub:
+        package = api.fetch_package('https://example.com/connector.app.zip')
+        api.install_frontend(hub, package, 'oauth-key', 'oauth-secret', backend.url)
+
+Operations return result tuples instead of printing, progress messages are passed to the
+optional log callable. Failures are raised as APSConnectError subclasses: ConfigError,
+ClusterError, WaitTimeoutError, HubError, PackageError and CircuitOpenError.
+
+API calls failed by transient errors are retried with backoff, configure_retries(retries=...,
+base_delay=..., max_delay=..., breaker_threshold=..., breaker_reset=...) changes the policy.
+configure_metrics(metrics_file) collects the API call, phase and operation metrics, which
+write_metrics() saves.
+"""
+from apsconnectcli.cache import Package, fetch_package
+from apsconnectcli.cluster import (BackendResult, ClusterClient, SecretData, backend_address,
+                                   backend_journal, check_backend_params, install_backend,
+                                   list_contexts, load_config_data, load_config_dir,
+                                   load_overrides, render_backend, save_kube_config,
+                                   select_contexts, uninstall_backend)
+from apsconnectcli.doctor import Check, diagnose, latency_warnings
+from apsconnectcli.errors import (APSConnectError, CircuitOpenError, ClusterError, ConfigError,
+                                  HubError, PackageError, WaitTimeoutError)
+from apsconnectcli.hub import (FrontendResult, HubClient, frontend_journal, hub_profiles,
+                               install_frontend, load_hub_config)
+from apsconnectcli.journal import Journal
+from apsconnectcli.loadtest import LoadResult, check_thresholds, parse_profile, run_load
+from apsconnectcli.metrics import configure as configure_metrics, write as write_metrics
+from apsconnectcli.retry import configure as configure_retries
+from apsconnectcli.status import collect_status, join as join_status, watch_status
+from apsconnectcli.templates import Template, load_templates
+
+__all__ = [
+    'APSConnectError',
+    'BackendResult',
+    'Check',
+    'CircuitOpenError',
+    'ClusterClient',
+    'ClusterError',
+    'ConfigError',
+    'FrontendResult',
+    'HubClient',
+    'HubError',
+    'Journal',
+    'LoadResult',
+    'Package',
+    'PackageError',
+    'SecretData',
+    'Template',
+    'WaitTimeoutError',
+    'backend_address',
+    'backend_journal',
+    'check_backend_params',
+    'check_thresholds',
+    'collect_status',
+    'configure_metrics',
+    'configure_retries',
+    'diagnose',
+    'fetch_package',
+    'frontend_journal',
+    'hub_profiles',
+    'install_backend',
+    'install_frontend',
+    'join_status',
+    'latency_warnings',
+    'list_contexts',
+    'load_config_data',
+    'load_config_dir',
+    'load_hub_config',
+    'load_overrides',
+    'load_templates',
+    'parse_profile',
+    'render_backend',
+    'run_load',
+    'save_kube_config',
+    'select_contexts',
+    'uninstall_backend',
+    'watch_status',
+    'write_metrics',
+]
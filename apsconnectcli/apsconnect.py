@@ -4,80 +4,158 @@ import json
 import os
 import sys
 import time
-import copy
 import uuid
 import base64
 import warnings
-import zipfile
-from shutil import copyfile
-from xml.etree import ElementTree as xml_et
-from datetime import datetime, timedelta
-
-import fire
-import yaml
-import osaapi
-from requests import request, get
-
-from kubernetes import client, config
-from kubernetes.client.rest import ApiException
+import threading
+from datetime import datetime
+
+from apsconnectcli import retry
+from apsconnectcli import metrics
+from apsconnectcli import tracing
+from apsconnectcli.lazy import LazyModule
+from apsconnectcli import cache as package_cache
+from apsconnectcli.cache import fetch_package
+from apsconnectcli.cluster import (ClusterClient, DELETE_WORKERS, RENDER_PARAMS, SecretData,
+                                   backend_address, backend_journal, check_backend_params,
+                                   install_backend,
+                                   load_config_data, load_config_dir, load_overrides,
+                                   render_backend, save_kube_config, select_contexts,
+                                   uninstall_backend)
+from apsconnectcli.doctor import DOCTOR_SAMPLES, DOCTOR_WARN_LATENCY, diagnose, latency_warnings
+from apsconnectcli.errors import APSConnectError, ConfigError
+from apsconnectcli.hub import (HubClient, CFG_FILE_PATH, RETRY_CONFIG_KEY, check_backend_url,
+                               frontend_journal, hub_profiles, install_frontend)
+from apsconnectcli.loadtest import (LOADTEST_CONCURRENCY, LOADTEST_MAX_ERROR_RATE,
+                                    LOADTEST_PROFILE, LOADTEST_THRESHOLDS, LOADTEST_TIMEOUT,
+                                    check_thresholds, format_result, parse_profile, run_load)
+from apsconnectcli.probe import format_ms
+from apsconnectcli.templates import TEMPLATE_KINDS, Template, load_templates
+from apsconnectcli.status import (STATUS_TTL, STATUS_CONNECTIONS, HUB_REFRESH_INTERVAL,
+                                  collect_status, join, load_cached, save_cached, watch_status)
 
 if sys.version_info >= (3,):
-    import tempfile
-    import xmlrpc.client as xmlrpclib
     from tempfile import TemporaryDirectory
 else:
-    import xmlrpclib
-    import tempfile
     from backports.tempfile import TemporaryDirectory
 
+yaml = LazyModule('yaml')
+futures = LazyModule('concurrent.futures')
+
 warnings.filterwarnings('ignore')
 
-CFG_FILE_PATH = os.path.expanduser('~/.aps_config')
-KUBE_DIR_PATH = os.path.expanduser('~/.kube')
-KUBE_FILE_PATH = '{}/config'.format(KUBE_DIR_PATH)
-RPC_CONNECT_PARAMS = ('host', 'user', 'password', 'ssl', 'port')
-APS_CONNECT_PARAMS = ('aps_host', 'aps_port', 'use_tls_aps')
+_print_lock = threading.Lock()
+
+RESUME_HINT = "Completed steps are saved, run the command again with --resume to continue"
+DOCTOR_HEADERS = ('CHECK', 'ENDPOINT', 'DNS', 'CONNECT', 'TLS', 'FIRST CALL', 'CALL', 'STATUS')
+STATUS_HEADERS = ('NAMESPACE', 'BACKEND', 'READY', 'ADDRESS', 'HUB', 'CONNECTOR', 'INSTANCE')
+BACKEND_PARAMS = ('name', 'image', 'config_file', 'healthcheck_path', 'root_path', 'namespace',
+                  'replicas', 'force', 'wait_for', 'timeout', 'verify_ready', 'healthy_count',
+                  'latency_budget', 'probe_pods', 'cpu_request', 'memory_request', 'cpu_limit',
+                  'memory_limit', 'probe_delay', 'probe_period', 'probe_timeout', 'min_replicas',
+                  'max_replicas', 'target_cpu', 'overrides_file', 'templates_file', 'context',
+                  'config_dir')
+DEFAULT_KUBE_NAMES = {'context': 'cluster-context', 'cluster_name': 'cluster',
+                      'user_name': 'cluster-admin'}
 AUTH_TEMPLATE = {
     'apiVersion': 'v1',
     'clusters': [
         {
             'cluster': {
                 'api-version': 'v1',
-                'certificate-authority-data': '{BASE64CERT}',
-                'server': '{ENDPOINT}',
+                'certificate-authority-data': '${ca_cert_data}',
+                'server': 'https://${cluster_endpoint}',
             },
-            'name': 'cluster',
+            'name': '${cluster_name}',
         },
     ],
     'contexts': [
         {
             'context': {
-                'cluster': 'cluster',
-                'user': 'cluster-admin',
+                'cluster': '${cluster_name}',
+                'user': '${user_name}',
             },
-            'name': 'cluster-context',
+            'name': '${context}',
         },
     ],
-    'current-context': 'cluster-context',
+    'current-context': '${context}',
     'kind': 'Config',
     'preferences': {},
     'users': [
         {
-            'name': 'cluster-admin',
+            'name': '${user_name}',
             'user': {
-                'username': '{USERNAME}',
-                'password': '{PASSWORD}',
+                'username': '${user}',
+                'password': '${pwd}',
             },
         },
     ],
 }
 
 
+class PackageCacheUtil:
+    """ Manage the local cache of connector packages"""
+
+    def list(self):
+        """ List cached connector packages"""
+        entries = package_cache.list_entries()
+        if not entries:
+            print("Cache is empty [{}]".format(package_cache.CACHE_DIR_PATH))
+            return
+
+        rows = []
+        for e in entries:
+            meta = e['meta']
+            rows.append((e['sha256'][:12], _format_size(e['size']),
+                         datetime.fromtimestamp(e['last_used']).strftime('%Y-%m-%d %H:%M'),
+                         '{} {}-{}'.format(meta['id'], meta['version'], meta['release'])
+                         if meta else '-',
+                         ' '.join(e['urls']) or '-'))
+        _print_table(('SHA256', 'SIZE', 'LAST USED', 'PACKAGE', 'URL'), rows)
+        print("Total {} packages, {} [{}]".format(len(entries),
+                                                  _format_size(sum(e['size'] for e in entries)),
+                                                  package_cache.CACHE_DIR_PATH))
+
+    def prune(self, max_size=None, clear=False):
+        """ Evict least recently used packages until the cache fits --max-size MB,
+        --clear removes all packages"""
+        if clear:
+            max_size = 0
+        elif max_size is None:
+            max_size = package_cache.CACHE_MAX_SIZE
+        else:
+            max_size = int(float(max_size) * 1024 * 1024)
+
+        evicted = package_cache.prune(max_size)
+        for e in evicted:
+            print("Removed {} {}".format(e['sha256'][:12], ' '.join(e['urls'])))
+        print("Pruned {} packages, {} freed".format(len(evicted),
+                                                    _format_size(sum(e['size'] for e in evicted))))
+
+
 class APSConnectUtil:
-    """ A command line tool for APS connector installation on Odin Automation in the relaxed way"""
+    """ A command line tool for APS connector installation on Odin Automation in the relaxed way,
+    --timings prints time spent in every phase, --trace-file saves them in Chrome trace format,
+    --retries and --retry-max-delay limit the retries of the API calls failed by transient
+    errors, --metrics-file saves API call, retry, transfer and phase metrics of the run as
+    Prometheus textfile or appends them as JSON lines, see --metrics-format"""
+
+    cache = PackageCacheUtil()
 
-    def init_cluster(self, cluster_endpoint, user, pwd, ca_cert):
-        """ Connect your kubernetes (k8s) cluster"""
+    def __init__(self, timings=False, trace_file=None, retries=None, retry_max_delay=None,
+                 metrics_file=None, metrics_format=None):
+        tracing.tracer.configure(timings, trace_file)
+        try:
+            metrics.configure(metrics_file, metrics_format)
+            retry.configure(log=_retry_log, **_retry_settings(retries, retry_max_delay))
+        except APSConnectError as e:
+            print(e)
+            sys.exit(1)
+
+    def init_cluster(self, cluster_endpoint, user, pwd, ca_cert, context=None):
+        """ Connect your kubernetes (k8s) cluster, with --context the cluster is added to the
+        k8s config as named context next to the others, the default one is replaced and made
+        current otherwise"""
         try:
             with open(ca_cert) as _file:
                 ca_cert_data = base64.b64encode(_file.read().encode())
@@ -85,213 +163,441 @@ class APSConnectUtil:
             print("Unable to read ca_cert file, error: {}".format(e))
             sys.exit(1)
 
-        auth_template = copy.deepcopy(AUTH_TEMPLATE)
-        cluster = auth_template['clusters'][0]['cluster']
-        user_data = auth_template['users'][0]['user']
-
-        cluster['certificate-authority-data'] = ca_cert_data.decode()
-        cluster['server'] = 'https://{}'.format(cluster_endpoint)
-        user_data['username'] = user
-        user_data['password'] = pwd
-
-        _, temp_config = tempfile.mkstemp()
-        with open(temp_config, 'w') as fd:
-            yaml.safe_dump(auth_template, fd)
+        names = ({'context': context, 'cluster_name': context,
+                  'user_name': '{}-admin'.format(context)} if context else DEFAULT_KUBE_NAMES)
+        auth_template = Template(AUTH_TEMPLATE, 'kubeconfig').render(
+            ca_cert_data=ca_cert_data.decode(), cluster_endpoint=cluster_endpoint, user=user,
+            pwd=pwd, **names)
 
+        # Config is checked before it is saved, without a round trip through a file
         try:
-            api_client = _get_k8s_api_client(temp_config)
-            api = client.VersionApi(api_client)
-            code = api.get_code()
+            code = ClusterClient.from_config_dict(auth_template).get_version()
             print("Connectivity with k8s cluster api [ok]")
             print("k8s cluster version - {}".format(code.git_version))
-        except Exception as e:
+        except APSConnectError as e:
             print("Unable to communicate with k8s cluster {}, error: {}".format(
                 cluster_endpoint, e))
             sys.exit(1)
 
-        os.remove(temp_config)
-
-        if not os.path.exists(KUBE_DIR_PATH):
-            os.mkdir(KUBE_DIR_PATH)
-            print("Created directory [{}]".format(KUBE_DIR_PATH))
-
-        with open(KUBE_FILE_PATH, 'w+') as fd:
-            yaml.safe_dump(auth_template, fd)
-            print("Config saved [{}]".format(KUBE_FILE_PATH))
+        try:
+            path = save_kube_config(auth_template, current=not context)
+        except APSConnectError as e:
+            print(e)
+            sys.exit(1)
+        if context:
+            print("Context {} saved [{}]".format(context, path))
+        else:
+            print("Config saved [{}]".format(path))
 
     def init_hub(self, hub_host, user='admin', pwd='1q2w3e', use_tls=False, port=8440,
-                 aps_host=None, aps_port=6308, use_tls_aps=True):
-        """ Connect your Odin Automation Hub"""
+                 aps_host=None, aps_port=6308, use_tls_aps=True, cache_token=False,
+                 profile=None):
+        """ Connect your Odin Automation Hub, with --cache-token APS token is kept on disk
+        between the runs, with --profile the hub is saved as named profile for --hubs"""
         if not aps_host:
             aps_host = hub_host
         use_tls = use_tls in ('Yes', 'True', '1')
-        hub = osaapi.OSA(host=hub_host, user=user, password=pwd, ssl=use_tls, port=port)
+        hub_cfg = {'host': hub_host, 'user': user, 'password': pwd, 'ssl': use_tls,
+                   'port': port, 'aps_port': aps_port, 'aps_host': aps_host,
+                   'use_tls_aps': use_tls_aps, 'cache_token': bool(cache_token)}
+        hub = HubClient(hub_cfg)
         try:
-            hub_version = _get_hub_version(hub)
+            # RPC and APS (with the token fetch) are checked concurrently
+            applications_job = hub.submit(hub.list_applications)
+            hub_version = hub.get_version()
             print("Connectivity with Hub RPC API [ok]")
             _assert_hub_version(hub_version)
             print("Hub version {}".format(hub_version))
-            r = request('GET', '{}/{}'.format(_get_aps_url(aps_host, aps_port, use_tls_aps),
-                                              'aps/2/applications/'),
-                        headers=_get_user_token(hub, user), verify=False)
-            r.raise_for_status()
+            applications_job.result()
             print("Connectivity with Hub APS API [ok]")
 
         except Exception as e:
             print("Unable to communicate with hub {}, error: {}".format(hub_host, e))
             sys.exit(1)
 
+        try:
+            saved_cfg = json.load(open(CFG_FILE_PATH))
+        except Exception:
+            saved_cfg = {}
+        profiles = saved_cfg.get('profiles', {})
+
+        if profile:
+            profiles[profile] = hub_cfg
+            saved_cfg['profiles'] = profiles
+        else:
+            retry_cfg = saved_cfg.get(RETRY_CONFIG_KEY)
+            saved_cfg = dict(hub_cfg)
+            if profiles:
+                saved_cfg['profiles'] = profiles
+            if retry_cfg:
+                saved_cfg[RETRY_CONFIG_KEY] = retry_cfg
+
         with open(CFG_FILE_PATH, 'w+') as cfg:
-            cfg.write(json.dumps({'host': hub_host, 'user': user, 'password': pwd, 'ssl': use_tls,
-                                  'port': port, 'aps_port': aps_port, 'aps_host': aps_host,
-                                  'use_tls_aps': use_tls_aps},
-                                 indent=4))
-            print("Config saved [{}]".format(CFG_FILE_PATH))
+            cfg.write(json.dumps(saved_cfg, indent=4))
+            if profile:
+                print("Config saved [{}] profile {}".format(CFG_FILE_PATH, profile))
+            else:
+                print("Config saved [{}]".format(CFG_FILE_PATH))
 
-    def install_backend(self, name, image, config_file, healthcheck_path='/',
+    def install_backend(self, name, image, config_file=None, healthcheck_path='/',
                         root_path='/', namespace='default', replicas=2,
-                        force=False):
-        """ Install connector-backend in the k8s cluster"""
+                        force=False, wait_for='service', timeout=180, verify_ready=False,
+                        healthy_count=3, latency_budget=1.0, probe_pods=False, cpu_request=None,
+                        memory_request=None, cpu_limit='100m', memory_limit='128Mi',
+                        probe_delay=None, probe_period=None, probe_timeout=None,
+                        min_replicas=None, max_replicas=None, target_cpu=80,
+                        overrides_file=None, templates_file=None, resume=False, dry_run=False,
+                        context=None, contexts=None, config_dir=None, loadtest=False,
+                        loadtest_profile=LOADTEST_PROFILE, max_p99_ms=None,
+                        max_error_rate=LOADTEST_MAX_ERROR_RATE, min_rps=None):
+        """ Install connector-backend in the k8s cluster, the config is the JSON config file or
+        every file of --config-dir stored as one secret, --wait-for can be service, rollout
+        or both, with --verify-ready the health check of the exposed service (and every pod
+        with --probe-pods) must give --healthy-count consecutive responses within
+        --latency-budget seconds, with --max-replicas the deployment is autoscaled between
+        --min-replicas and --max-replicas by --target-cpu utilization, --overrides-file is
+        merged into the deployment, service and autoscaler, --templates-file replaces their
+        built-in templates, --resume continues the failed install skipping the steps done,
+        --dry-run prints the manifests without contacting the cluster. --context selects the
+        k8s config context, --contexts is a comma separated list of contexts or all to install
+        to in parallel. With --loadtest the health check is loaded by --loadtest-profile at the
+        end, see loadtest-backend, and the install fails if --max-p99-ms, --max-error-rate or
+        --min-rps is missed"""
+        spec = {'name': name, 'image': image, 'healthcheck_path': healthcheck_path,
+                'root_path': root_path, 'namespace': namespace, 'replicas': replicas,
+                'force': force, 'wait_for': wait_for, 'timeout': timeout,
+                'verify_ready': verify_ready, 'healthy_count': healthy_count,
+                'latency_budget': latency_budget, 'probe_pods': probe_pods,
+                'cpu_request': cpu_request, 'memory_request': memory_request,
+                'cpu_limit': cpu_limit, 'memory_limit': memory_limit, 'probe_delay': probe_delay,
+                'probe_period': probe_period, 'probe_timeout': probe_timeout,
+                'min_replicas': min_replicas, 'max_replicas': max_replicas,
+                'target_cpu': target_cpu, 'templates_file': templates_file}
+        journal = None
 
         try:
-            config_data = json.load(open(config_file))
-            print("Loading config file: {}".format(config_file))
-        except Exception as e:
-            print("Unable to read config file, error: {}".format(e))
+            if loadtest:
+                spec['loadtest'] = _loadtest_settings(loadtest_profile, LOADTEST_CONCURRENCY,
+                                                      LOADTEST_TIMEOUT, max_p99_ms,
+                                                      max_error_rate, min_rps)
+            check_backend_params(wait_for, verify_ready, probe_pods, spec.get('loadtest'))
+            if context and contexts:
+                raise ConfigError("Use either --context or --contexts")
+
+            config_data = _load_config(config_file, config_dir)
+            overrides = load_overrides(overrides_file) if overrides_file else None
+            # Templates are checked before the cluster is contacted
+            load_templates(templates_file, overrides)
+            if dry_run:
+                _print_manifests([_render_backend(spec, config_data, overrides)])
+                return
+
+            if config_dir:
+                print("Loading config dir: {} ({} files, {})".format(
+                    config_dir, len(config_data.data), _format_size(config_data.size)))
+            else:
+                print("Loading config file: {}".format(config_file))
+            if overrides_file:
+                print("Loading overrides file: {}".format(overrides_file))
+            if templates_file:
+                print("Loading templates file: {}".format(templates_file))
+
+            if contexts:
+                contexts = select_contexts(contexts)
+            else:
+                cluster = _connect_cluster(context=context)
+                journal = _backend_journal(cluster, spec, config_data, overrides, resume)
+                install_backend(cluster, config_data=config_data, overrides=overrides,
+                                log=print, progress=True, journal=journal, **spec)
+        except APSConnectError as e:
+            print(e)
+            if journal is not None and journal.steps:
+                print(RESUME_HINT)
             sys.exit(1)
 
-        api_client = _get_k8s_api_client()
-        api = client.VersionApi(api_client)
-        core_v1 = client.CoreV1Api(api_client)
-        ext_v1 = client.ExtensionsV1beta1Api(api_client)
+        if contexts:
+            jobs = [dict(spec, context=c, config_data=config_data, overrides=overrides)
+                    for c in contexts]
+            with futures.ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+                results = list(executor.map(lambda job: _install_backend_job(
+                    job, resume=resume, label=job['context']), jobs))
+
+            _print_results(results)
+            if not all(r['ok'] for r in results):
+                if any(r.get('resumable') for r in results):
+                    print(RESUME_HINT)
+                sys.exit(1)
 
-        try:
-            api.get_code()
-            print("Connected to cluster - {}".format(api_client.host))
-        except Exception as e:
-            print("Unable to communicate with k8s cluster, error: {}".format(e))
-            sys.exit(1)
+        print("[Success]")
+
+    def install_many(self, manifest, workers=4, force=False, resume=False, dry_run=False,
+                     context=None):
+        """ Install connector-backends listed in the YAML/JSON manifest in parallel, --resume
+        continues the failed installs skipping the steps done, --dry-run prints the manifests
+        without contacting the cluster, --context is the k8s config context of the backends
+        which don't set their own"""
 
         try:
-            _create_secret(name, config_data, core_v1, namespace, force)
-            print("Create config [ok]")
+            with open(manifest) as fd:
+                specs = _load_backends_manifest(yaml.safe_load(fd),
+                                                os.path.dirname(os.path.abspath(manifest)))
         except Exception as e:
-            print("Can't create config in cluster, error: {}".format(e))
+            print("Unable to read manifest file, error: {}".format(e))
             sys.exit(1)
 
+        if dry_run:
+            try:
+                _print_manifests([_render_backend(spec, _load_config(spec.get('config_file'),
+                                                                     spec.get('config_dir')),
+                                                  load_overrides(spec['overrides_file'])
+                                                  if spec.get('overrides_file') else None)
+                                  for spec in specs])
+            except APSConnectError as e:
+                print(e)
+                sys.exit(1)
+            return
+
+        print("Loading manifest file: {} ({} backends)".format(manifest, len(specs)))
+
+        for spec in specs:
+            spec.setdefault('context', context)
+        clusters = {}
         try:
-            _create_deployment(name, image, ext_v1, healthcheck_path, replicas,
-                               namespace, force, core_api=core_v1)
-            print("Create deployment [ok]")
-        except Exception as e:
-            print("Can't create deployment in cluster, error: {}".format(e))
+            for spec in specs:
+                if spec['context'] not in clusters:
+                    clusters[spec['context']] = _connect_cluster(workers, spec['context'])
+        except APSConnectError as e:
+            print(e)
             sys.exit(1)
 
-        try:
-            _create_service(name, core_v1, namespace, force)
-            print("Create service [ok]")
-        except Exception as e:
-            print("Can't create deployment in cluster, error: {}".format(e))
+        started = time.time()
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda spec: _install_backend_job(
+                spec, clusters[spec['context']], force, resume), specs))
+
+        _print_results(results)
+        failed = len([r for r in results if not r['ok']])
+        print("Installed {} of {} backends in {:.1f}s".format(len(results) - failed, len(results),
+                                                              time.time() - started))
+
+        if failed:
+            if any(r.get('resumable') for r in results):
+                print(RESUME_HINT)
             sys.exit(1)
 
-        print("Checking service availability")
+        print("[Success]")
+
+    def uninstall_backend(self, name, namespace='default', wait=False, timeout=180,
+                          context=None):
+        """ Remove connector-backend from the k8s cluster, --context selects the k8s config
+        context"""
 
         try:
-            ip = _polling_service_access(name, core_v1, namespace, timeout=180)
-            print("Expose service [ok]")
-            print("Connector backend - http://{}/{}".format(ip, root_path.lstrip('/')))
-        except Exception as e:
-            print("Service expose FAILED, error: {}".format(e))
+            cluster = _connect_cluster(DELETE_WORKERS, context)
+            uninstall_backend(cluster, name, namespace, wait, timeout, log=print, progress=True)
+        except APSConnectError as e:
+            print(e)
             sys.exit(1)
 
         print("[Success]")
 
     def install_frontend(self, source, oauth_key, oauth_secret, backend_url, settings_file=None,
-                         network='public'):
+                         network='public', no_cache=False, skip_imported=False, hubs=None,
+                         resume=False):
         """ Install connector-frontend in Odin Automation Hub, --source can be http(s):// or
-        filepath"""
+        filepath, http(s) packages are cached locally unless --no-cache, with --skip-imported
+        the package is not imported again if its version is already on the hub, --hubs is a
+        comma separated list of hub profiles to install to concurrently or all, --resume
+        continues the failed install skipping the import done"""
 
-        with TemporaryDirectory() as tdir:
-            is_http_source = True if source.startswith('http://') or source.startswith('https://') \
-                else False
+        try:
+            check_backend_url(backend_url)
+            if backend_url.startswith('http://'):
+                print("WARN: Make sure that the APS development mode enabled for http backend. "
+                      "Run `apsconnect aps_devel_mode` command.")
 
-            if is_http_source:
-                package_name = _download_file(source, target=tdir)
-            else:
-                package_name = os.path.basename(source)
-                copyfile(os.path.expanduser(source), os.path.join(tdir, package_name))
+            settings = _load_settings(settings_file)
 
-            package_path = os.path.join(tdir, package_name)
-            with zipfile.ZipFile(package_path, 'r') as zip_ref:
-                meta_path = zip_ref.extract('APP-META.xml', path=tdir)
+            # Hub sessions are opened and the tokens fetched while the package is prepared
+            sessions = _get_hub_sessions(hubs)
+            for _, hub in sessions:
+                hub.prefetch_token()
+        except APSConnectError as e:
+            print(e)
+            sys.exit(1)
 
-            tree = xml_et.ElementTree(file=meta_path)
-            namespace = '{http://aps-standard.org/ns/2}'
-            connector_id = tree.find('{}id'.format(namespace)).text
-            version = tree.find('{}version'.format(namespace)).text
-            release = tree.find('{}release'.format(namespace)).text
+        with TemporaryDirectory() as tdir:
+            try:
+                package = fetch_package(source, no_cache, target_dir=tdir)
+            except APSConnectError as e:
+                print(e)
+                sys.exit(1)
 
-            if not settings_file:
-                settings_file = {}
+            if package.is_http_source and no_cache:
+                print("Package downloaded, sha256 {}".format(package.sha256))
+            elif package.is_http_source:
+                print("Package {}, sha256 {}".format('found in cache' if package.from_cache
+                                                     else 'downloaded', package.sha256))
+
+            journals = []
+
+            def install(hub, log):
+                journal = frontend_journal(hub, package, {'oauth_key': oauth_key,
+                                                          'backend_url': backend_url,
+                                                          'settings': settings,
+                                                          'network': network}, resume)
+                journals.append(journal)
+                result = install_frontend(hub, package, oauth_key, oauth_secret, backend_url,
+                                          settings, network, skip_imported, log, journal)
+                return "Connector {} {}-{} installed".format(result.connector_id,
+                                                             result.version, result.release)
+
+            if hubs:
+                results = _run_on_hubs(sessions, install)
+                if not all(r['ok'] for r in results):
+                    if any(journal.steps for journal in journals):
+                        print(RESUME_HINT)
+                    sys.exit(1)
             else:
-                settings_file = json.load(open(settings_file))
+                try:
+                    install(sessions[0][1], print)
+                except APSConnectError as e:
+                    print(e)
+                    if any(journal.steps for journal in journals):
+                        print(RESUME_HINT)
+                    sys.exit(1)
+
+            print("[Success]")
+
+    def status(self, namespace=None, hubs=None, ttl=STATUS_TTL, watch=False,
+               interval=HUB_REFRESH_INTERVAL):
+        """ Show connector-backends of the k8s cluster with the hub application instances using
+        them, all namespaces unless --namespace, --hubs is a comma separated list of hub profiles
+        or all. Results are cached for --ttl seconds, 0 disables the cache. With --watch the
+        changes are printed as they happen, hub instances are listed every --interval seconds"""
+        try:
+            cluster = ClusterClient(pool_maxsize=STATUS_CONNECTIONS)
+            if hubs:
+                sessions = _get_hub_sessions(hubs)
+            else:
+                try:
+                    sessions = _get_hub_sessions()
+                except ConfigError:
+                    print("Hub is not configured, frontends are not shown")
+                    sessions = []
+        except APSConnectError as e:
+            print(e)
+            sys.exit(1)
 
-            if backend_url.startswith('http://'):
-                print("WARN: Make sure that the APS development mode enabled for http backend. "
-                      "Run `apsconnect aps_devel_mode` command.")
-            elif backend_url.startswith('https://'):
+        if watch:
+            try:
+                _watch_status(cluster, sessions, namespace, interval)
+            except KeyboardInterrupt:
                 pass
-            else:
-                print("Backend url must be URL http(s)://, got {}".format(backend_url))
-                sys.exit(1)
+            return
 
-            cfg, hub = _get_cfg(), _get_hub()
-
-            with open(package_path, 'rb') as package_binary:
-                print("Importing connector {} {}-{}".format(connector_id, version, release))
-                import_kwargs = {'package_url': source} if is_http_source \
-                    else {'package_body': xmlrpclib.Binary(package_binary.read())}
-                r = hub.APS.importPackage(**import_kwargs)
-                _osaapi_raise_for_status(r)
-
-                print("Connector {} imported with id={}"
-                      .format(connector_id, r['result']['application_id']))
-
-            payload = {
-                "aps": {
-                    "package": {
-                        "type": connector_id,
-                        "version": version,
-                        "release": release,
-                    },
-                    "endpoint": backend_url,
-                    "network": network,
-                    "auth": {
-                        "oauth": {
-                            "key": oauth_key,
-                            "secret": oauth_secret,
-                        }
-                    }
-                }
-            }
-
-            payload.update(settings_file)
-
-            base_aps_url = _get_aps_url(**{k: _get_cfg()[k] for k in APS_CONNECT_PARAMS})
-
-            r = request(method='POST', url='{}/{}'.format(base_aps_url, 'aps/2/applications/'),
-                        headers=_get_user_token(hub, cfg['user']), verify=False, json=payload)
+        key = '|'.join([cluster.host, namespace or '*'] +
+                       ['{}={}'.format(name, hub.rpc_url) for name, hub in sessions])
+        snapshot = load_cached(key, ttl) if ttl else None
+        cached = snapshot is not None
+        if not cached:
+            try:
+                snapshot = collect_status(cluster, sessions, namespace)
+            except APSConnectError as e:
+                print(e)
+                sys.exit(1)
+            if ttl and not snapshot['errors']:
+                save_cached(key, snapshot, ttl)
+
+        rows = _status_rows(snapshot)
+        if rows:
+            _print_table(STATUS_HEADERS, rows)
+        for error in snapshot['errors']:
+            print("WARN: {}".format(error))
+        print("Total {} backends, {} instances{}".format(
+            len(snapshot['backends']), len(snapshot['frontends']),
+            ", cached {:.0f}s ago".format(time.time() - snapshot['time']) if cached else ''))
+
+    def doctor(self, hubs=None, samples=DOCTOR_SAMPLES, warn_ms=DOCTOR_WARN_LATENCY * 1000):
+        """ Measure latency of the k8s API and the hub RPC, token and APS calls concurrently,
+        DNS lookup, TCP connect and TLS handshake apart from the calls, --hubs is a comma
+        separated list of hub profiles or all, the hops slower than --warn-ms are reported"""
+        # Retries would be measured as latency
+        retry.configure(retries=0)
+        try:
             try:
-                r.raise_for_status()
-                print("[Success]")
-            except Exception as e:
-                if 'error' in r.json():
-                    err = "{} {}".format(r.json()['error'], r.json()['message'])
-                else:
-                    err = str(e)
-                print("Installation of connector {} FAILED.\n"
-                      "Hub APS API response {} code.\n"
-                      "Error: {}".format(connector_id, r.status_code, err))
+                cluster = ClusterClient()
+            except ConfigError:
+                print("k8s cluster is not configured, k8s API is not checked")
+                cluster = None
+            if hubs:
+                sessions = _get_hub_sessions(hubs)
+            else:
+                try:
+                    sessions = _get_hub_sessions()
+                except ConfigError:
+                    print("Hub is not configured, hub APIs are not checked")
+                    sessions = []
+        except APSConnectError as e:
+            print(e)
+            sys.exit(1)
+
+        checks = diagnose(cluster, sessions, int(samples))
+        if not checks:
+            print("Nothing to check, run init commands first")
+            sys.exit(1)
+
+        _print_table(DOCTOR_HEADERS, [(c.name, c.url, format_ms(c.dns), format_ms(c.connect),
+                                       format_ms(c.tls), format_ms(c.first_call),
+                                       format_ms(c.call), c.error or 'ok') for c in checks])
+        for warning in latency_warnings(checks, float(warn_ms) / 1000):
+            print("WARN: {}".format(warning))
+
+        if any(c.error for c in checks):
+            sys.exit(1)
+
+    def loadtest_backend(self, url=None, name=None, namespace='default', paths=None,
+                         profile=LOADTEST_PROFILE, concurrency=LOADTEST_CONCURRENCY,
+                         timeout=LOADTEST_TIMEOUT, max_p99_ms=None,
+                         max_error_rate=LOADTEST_MAX_ERROR_RATE, min_rps=None, context=None):
+        """ Load the connector-backend at --url or the service address of the backend --name
+        with concurrent GET requests of --paths, a comma separated list, through a pool of
+        --concurrency connections. --profile is a comma separated list of RPS:SECONDS stages,
+        0 RPS sends as fast as the connections allow. Prints throughput, p50/p95/p99 latency
+        and error rate, exits with non-zero code if p99 latency is over --max-p99-ms, error
+        rate over --max-error-rate or throughput under --min-rps"""
+        try:
+            settings = _loadtest_settings(profile, concurrency, timeout, max_p99_ms,
+                                          max_error_rate, min_rps)
+            if not url and not name:
+                raise ConfigError("Backend --url or --name is required")
+            if not url:
+                cluster = _connect_cluster(context=context)
+                url = 'http://{}/'.format(backend_address(cluster, name, namespace))
+        except APSConnectError as e:
+            print(e)
+            sys.exit(1)
+
+        if isinstance(paths, (list, tuple)):
+            paths = [str(path) for path in paths]
+        else:
+            paths = [path.strip() for path in str(paths or '').split(',') if path.strip()]
+        urls = ['{}/{}'.format(url.rstrip('/'), path.lstrip('/')) for path in paths] or [url]
+
+        thresholds = {k: settings.pop(k) for k in LOADTEST_THRESHOLDS}
+        print("Loading {} with {} connections, profile {}".format(', '.join(urls),
+                                                                  settings['concurrency'],
+                                                                  profile))
+        result = run_load(urls, **settings)
+        for line in format_result(result):
+            print(line)
+
+        failures = check_thresholds(result, **thresholds)
+        if failures:
+            print("Load test FAILED, error: {}".format('; '.join(failures)))
+            sys.exit(1)
+
+        print("[Success]")
 
     def generate_oauth(self, namespace=''):
         """ Helper for Oauth credentials generation"""
@@ -299,23 +605,26 @@ class APSConnectUtil:
             namespace += '-'
         print("OAuh key: {}{}\nSecret: {}".format(namespace, uuid.uuid4().hex, uuid.uuid4().hex))
 
-    def aps_devel_mode(self, disable=False):
-        """ Enable development mode for OA Hub"""
-        hub = _get_hub()
-        r = hub.setSystemProperty(account_id=1, name='APS_DEVEL_MODE', bool_value=not bool(disable))
-        _osaapi_raise_for_status(r)
-        print("APS Development mode {}.".format('DISABLED' if disable else 'ENABLED'))
-
-
-def _get_aps_url(aps_host, aps_port, use_tls_aps):
-    return '{}://{}:{}'.format('https' if use_tls_aps else 'http', aps_host, aps_port)
-
+    def aps_devel_mode(self, disable=False, hubs=None):
+        """ Enable development mode for OA Hub, --hubs is a comma separated list of hub
+        profiles or all"""
+        def set_mode(hub, log):
+            hub.set_devel_mode(not bool(disable))
+            message = "APS Development mode {}.".format('DISABLED' if disable else 'ENABLED')
+            log(message)
+            return message
 
-def _get_hub_version(hub):
-    r = hub.statistics.getStatisticsReport(reports=[{'name': 'report-for-cep', 'value': ''}])
-    _osaapi_raise_for_status(r)
-    tree = xml_et.fromstring(r['result'][0]['value'])
-    return tree.find('ClientVersion').text
+        try:
+            sessions = _get_hub_sessions(hubs)
+            if hubs:
+                results = _run_on_hubs(sessions, set_mode)
+                if not all(r['ok'] for r in results):
+                    sys.exit(1)
+            else:
+                set_mode(sessions[0][1], print)
+        except APSConnectError as e:
+            print(e)
+            sys.exit(1)
 
 
 def _assert_hub_version(hub_version):
@@ -324,272 +633,303 @@ def _assert_hub_version(hub_version):
         sys.exit(1)
 
 
-def _get_user_token(hub, user):
-    # TODO user -> user_id
-    r = hub.APS.getUserToken(user_id=1)
-    _osaapi_raise_for_status(r)
-    return {'APS-Token': r['result']['aps_token']}
+def _connect_cluster(pool_maxsize=None, context=None):
+    cluster = ClusterClient.for_context(context, pool_maxsize=pool_maxsize)
+    cluster.get_version()
+    print("Connected to cluster - {}{}".format(cluster.host,
+                                               " ({})".format(context) if context else ''))
+    return cluster
 
 
-def _get_hub():
-    return osaapi.OSA(**{k: _get_cfg()[k] for k in RPC_CONNECT_PARAMS})
+def _load_settings(settings_file):
+    if not settings_file:
+        return {}
 
+    try:
+        with open(settings_file) as fd:
+            return json.load(fd)
+    except Exception as e:
+        raise ConfigError("Unable to read settings file, error: {}".format(e))
+
+
+def _get_hub_sessions(hubs=None):
+    """ Named hub clients of the --hubs profiles, the default hub without them"""
+    if not hubs:
+        return [(None, HubClient.from_profile())]
+    return [(name, HubClient.from_config(cfg)) for name, cfg in hub_profiles(hubs)]
+
+
+def _status_rows(snapshot):
+    rows = []
+    for row in join(snapshot):
+        backend = (row['namespace'] or '-', row['name'] or '-',
+                   '-' if row['replicas'] is None else '{}/{}'.format(row['ready'],
+                                                                      row['replicas']),
+                   row['address'] or '-')
+        for instance in row['instances'] or [None]:
+            if instance:
+                rows.append(backend + (instance['hub'] or 'default', '{} {}-{}'.format(
+                    instance['connector_id'], instance['version'], instance['release']),
+                    instance['instance_id'] or '-'))
+            else:
+                rows.append(backend + ('-', '-', '-'))
+    return rows
 
-def _get_k8s_api_client(config_file=None):
-    if not config_file:
-        config_file = KUBE_FILE_PATH
-
-    return config.new_client_from_config(config_file=config_file)
 
+def _watch_status(cluster, sessions, namespace, interval):
+    """ Print the status table, then the changed rows as they happen"""
+    previous, errors = None, []
+    for snapshot in watch_status(cluster, sessions, namespace, interval):
+        ordered = _status_rows(snapshot)
+        rows = {(r[0], r[1], r[3] if r[1] == '-' else '', r[4], r[6]): r for r in ordered}
 
-def _osaapi_raise_for_status(r):
-    if r['status']:
-        if 'error_message' in r:
-            raise Exception("Error: {}".format(r['error_message']))
+        if previous is None:
+            _print_table(STATUS_HEADERS, ordered)
         else:
-            raise Exception("Error: Unknown {}".format(r))
-
-
-def _download_file(url, target=None):
-    local_filename = url.split('/')[-1]
-    if target:
-        local_filename = os.path.join(target, local_filename)
-    r = get(url, stream=True)
-    with open(local_filename, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:  # filter out keep-alive new chunks
-                f.write(chunk)
-    return local_filename
-
+            stamp = datetime.now().strftime('%H:%M:%S')
+            changes = [(key, 'REMOVED', previous[key]) for key in previous if key not in rows]
+            changes.extend((key, 'ADDED' if key not in previous else 'CHANGED', rows[key])
+                           for key in rows if previous.get(key) != rows[key])
+            for _, change, row in sorted(changes):
+                print("[{}] {:<7}  {}".format(stamp, change, '  '.join(row)))
+
+        for error in snapshot['errors']:
+            if error not in errors:
+                print("WARN: {}".format(error))
+        previous, errors = rows, snapshot['errors']
+        sys.stdout.flush()
+
+
+def _run_on_hubs(sessions, func):
+    """ Run func(hub, log) against the named hub sessions concurrently and print the
+    results"""
+    def run(named_session):
+        name, hub = named_session
+        log = _prefixed_log(name)
+        started = time.time()
+        try:
+            ok, details = True, func(hub, log) or ''
+        except Exception as e:
+            log(e)
+            ok, details = False, ' '.join(str(e).splitlines())
+        return {'name': name, 'ok': ok, 'elapsed': time.time() - started, 'details': details}
+
+    with futures.ThreadPoolExecutor(max_workers=len(sessions)) as executor:
+        results = list(executor.map(run, sessions))
+
+    _print_results(results)
+    return results
+
+
+def _load_backends_manifest(manifest, base_dir):
+    if isinstance(manifest, list):
+        manifest = {'backends': manifest}
+    if not isinstance(manifest, dict) or not manifest.get('backends'):
+        raise ConfigError("Manifest must contain a non-empty list of backends")
+
+    defaults = manifest.get('defaults', {})
+    specs = []
+    for backend in manifest['backends']:
+        spec = dict(defaults)
+        spec.update(backend)
+
+        unknown = set(spec) - set(BACKEND_PARAMS)
+        if unknown:
+            raise ConfigError("Unknown backend parameters: {}".format(', '.join(sorted(unknown))))
+        for param in ('name', 'image'):
+            if not spec.get(param):
+                raise ConfigError("Backend parameter {} is required, got {}".format(param, backend))
+        if bool(spec.get('config_file')) == bool(spec.get('config_dir')):
+            raise ConfigError("Backend parameter config_file or config_dir is required, got "
+                              "{}".format(backend))
+        check_backend_params(spec.get('wait_for', 'service'), spec.get('verify_ready'),
+                             spec.get('probe_pods'))
+
+        for param in ('config_file', 'config_dir', 'overrides_file', 'templates_file'):
+            if spec.get(param):
+                spec[param] = os.path.join(base_dir, os.path.expanduser(spec[param]))
+        specs.append(spec)
+
+    names = [spec['name'] for spec in specs]
+    duplicates = set(n for n in names if names.count(n) > 1)
+    if duplicates:
+        raise ConfigError("Duplicate backend names: {}".format(', '.join(sorted(duplicates))))
+
+    return specs
+
+
+def _install_backend_job(spec, cluster=None, force=False, resume=False, label=None):
+    """ Install the backend of the spec to the cluster, to the cluster of the spec context
+    without it, spec can carry loaded config_data and overrides"""
+    spec = dict(spec)
+    spec.setdefault('force', force)
+    context = spec.pop('context', None)
+    name = label or spec['name']
+    log = _prefixed_log(name)
+    started = time.time()
+    journal = None
 
-def _get_cfg():
-    cfg = json.load(open(CFG_FILE_PATH))
-    if not cfg:
-        print("Run init command.")
-        sys.exit(1)
-    return cfg
+    try:
+        if 'config_data' in spec:
+            config_data, overrides = spec.pop('config_data'), spec.pop('overrides')
+        else:
+            config_data = _load_config(spec.pop('config_file', None), spec.pop('config_dir', None))
+            overrides_file = spec.pop('overrides_file', None)
+            overrides = load_overrides(overrides_file) if overrides_file else None
+        if cluster is None:
+            cluster = ClusterClient.for_context(context)
+            cluster.get_version()
+            log("Connected to cluster - {}".format(cluster.host))
+
+        journal = _backend_journal(cluster, spec, config_data, overrides, resume)
+        result = install_backend(cluster, config_data=config_data, overrides=overrides, log=log,
+                                 progress=False, journal=journal, **spec)
+        ok, details = True, result.url or ''
+    except Exception as e:
+        log(e)
+        ok, details = False, str(e)
 
+    return {'name': name, 'ok': ok, 'elapsed': time.time() - started, 'details': details,
+            'resumable': bool(journal and journal.steps)}
 
-def _create_secret(name, data, api, namespace='default', force=False):
-    secret = {
-        'apiVersion': 'v1',
-        'data': {
-            'config.json': base64.b64encode(json.dumps(data).encode('utf-8')).decode(),
-        },
-        'kind': 'Secret',
-        'metadata': {
-            'name': name,
-        },
-        'type': 'Opaque',
-    }
 
-    if force:
-        _delete_secret(name, api, namespace)
+def _backend_journal(cluster, spec, config_data, overrides, resume):
+    params = {k: v for k, v in spec.items() if k not in ('name', 'namespace')}
+    # Config directory is bound by its digest, not by the content
+    params.update(config_data=config_data.digest if isinstance(config_data, SecretData)
+                  else config_data, overrides=overrides)
+    return backend_journal(cluster, spec['name'], spec.get('namespace', 'default'), params,
+                           resume)
 
-    api.create_namespaced_secret(
-        namespace=namespace,
-        body=secret,
-    )
 
-
-def _delete_secret(name, api, namespace):
+def _loadtest_settings(profile, concurrency, timeout, max_p99_ms, max_error_rate, min_rps):
+    """ Settings of run_load and check_thresholds, the options are checked before the
+    install"""
     try:
-        api.delete_namespaced_secret(
-            namespace=namespace,
-            body=client.V1DeleteOptions(),
-            name=name,
-        )
-    except ApiException as e:
-        if e.status != 404:
-            raise
-
-
-def _create_deployment(name, image, api, healthcheck_path='/', replicas=2,
-                       namespace='default', force=False, core_api=None):
-    template = {
-        'apiVersion': 'extensions/v1beta1',
-        'kind': 'Deployment',
-        'metadata': {
-            'name': name,
-        },
-        'spec': {
-            'replicas': replicas,
-            'template': {
-                'metadata': {
-                    'labels': {
-                        'name': name,
-                    },
-                },
-                'spec': {
-                    'containers': [
-                        {
-                            'name': name,
-                            'image': image,
-                            'env': [
-                                {
-                                    'name': 'CONFIG_FILE',
-                                    'value': '/config/config.json',
-                                },
-                            ],
-                            'livenessProbe': {
-                                'httpGet': {
-                                    'path': healthcheck_path,
-                                    'port': 80,
-                                },
-                            },
-                            'readinessProbe': {
-                                'httpGet': {
-                                    'path': healthcheck_path,
-                                    'port': 80,
-                                },
-                            },
-                            'ports': [
-                                {
-                                    'containerPort': 80,
-                                    'name': 'http-server',
-                                },
-                            ],
-                            'resources': {
-                                # TODO increase limits by default
-                                'limits': {
-                                    'cpu': '100m',
-                                    'memory': '128Mi',
-                                },
-                            },
-                            'volumeMounts': [
-                                {
-                                    'mountPath': '/config',
-                                    'name': 'config-volume',
-                                },
-                            ],
-                        },
-                    ],
-                    'volumes': [
-                        {
-                            'name': 'config-volume',
-                            'secret': {
-                                'secretName': name,
-                            },
-                        },
-                    ],
-                },
-            },
-        },
-    }
+        return {'stages': parse_profile(profile), 'concurrency': int(concurrency),
+                'timeout': float(timeout),
+                'max_p99': None if max_p99_ms is None else float(max_p99_ms) / 1000,
+                'max_error_rate': None if max_error_rate is None else float(max_error_rate),
+                'min_rps': None if min_rps is None else float(min_rps)}
+    except (TypeError, ValueError) as e:
+        raise ConfigError("Invalid load test option, error: {}".format(e))
 
-    if force:
-        _delete_deployment(name, api=api, namespace=namespace, core_api=core_api)
 
-    api.create_namespaced_deployment(namespace=namespace, body=template)
+def _load_config(config_file=None, config_dir=None):
+    if config_file and config_dir:
+        raise ConfigError("Use either config file or --config-dir")
+    if not config_file and not config_dir:
+        raise ConfigError("Config file or --config-dir is required")
+    return load_config_dir(config_dir) if config_dir else load_config_data(config_file)
 
 
-def _delete_deployment(name, api, namespace, core_api=None):
-    try:
-        api.delete_namespaced_deployment(
-            namespace=namespace,
-            name=name,
-            body=client.V1DeleteOptions(),
-            grace_period_seconds=0,
-        )
-    except ApiException as e:
-        if e.status != 404:
-            raise
-
-    replica_set = api.list_namespaced_replica_set(
-        namespace=namespace,
-        label_selector='name={}'.format(name),
-    )
-
-    if len(replica_set.items):
-        for rs in replica_set.items:
-            rs_name = rs.metadata.name
-            api.delete_namespaced_replica_set(namespace=namespace, name=rs_name,
-                                              body=client.V1DeleteOptions(),
-                                              grace_period_seconds=0)
-
-    pods = core_api.list_namespaced_pod(
-        namespace=namespace,
-        label_selector='name={}'.format(name)
-    )
-    pod_names = [pod.metadata.name for pod in pods.items]
-
-    for name in pod_names:
-        core_api.delete_namespaced_pod(
-            namespace=namespace,
-            name=name,
-            body=client.V1DeleteOptions(),
-            grace_period_seconds=0,
-        )
-
-
-def _create_service(name, api, namespace='default', force=False):
-    service = {
-        'apiVersion': 'v1',
-        'kind': 'Service',
-        'metadata': {
-            'labels': {
-                'name': name,
-            },
-            'name': name,
-        },
-        'spec': {
-            'ports': [
-                {
-                    'port': 80,
-                    'protocol': 'TCP',
-                    'targetPort': 80,
-                }
-            ],
-            'selector': {
-                'name': name
-            },
-            'type': 'LoadBalancer'
-        }
-    }
-
-    if force:
-        _delete_service(name, api, namespace)
+def _render_backend(spec, config_data, overrides):
+    return render_backend(config_data=config_data, overrides=overrides,
+                          **{k: v for k, v in spec.items() if k in RENDER_PARAMS})
 
-    api.create_namespaced_service(namespace=namespace, body=service)
 
+def _print_manifests(backends):
+    """ Manifests of the backends as one YAML stream, documents in the order of creation"""
+    print(yaml.safe_dump_all([manifests[kind] for manifests in backends
+                              for kind in TEMPLATE_KINDS if kind in manifests],
+                             default_flow_style=False), end='')
 
-def _delete_service(name, api, namespace):
-    try:
-        api.delete_namespaced_service(namespace=namespace, name=name)
-    except ApiException as e:
-        if e.status != 404:
-            raise
 
+def _print_results(results):
+    _print_table(('NAME', 'STATUS', 'TIME', 'DETAILS'),
+                 [(r['name'], 'ok' if r['ok'] else 'FAILED', '{:.1f}s'.format(r['elapsed']),
+                   r['details']) for r in results])
 
-def _polling_service_access(name, api, namespace, timeout=120):
-    max_time = datetime.now() + timedelta(seconds=timeout)
 
-    while True:
-        try:
-            data = api.read_namespaced_service_status(name=name, namespace=namespace)
-            ingress = data.status.load_balancer.ingress
+def _print_table(headers, rows):
+    widths = [max(len(str(value)) for value in column) for column in zip(headers, *rows)]
+    row_format = '  '.join('{:<' + str(width) + '}' for width in widths[:-1]) + '  {}'
+    for row in [headers] + list(rows):
+        print(row_format.format(*[str(value) for value in row]))
 
-            if ingress:
-                print()
-                return ingress[0].ip
 
-            sys.stdout.write('.')
-            sys.stdout.flush()
-        except:
-            raise
+def _format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '{:.0f} {}'.format(size, unit) if unit == 'B' else '{:.1f} {}'.format(size, unit)
+        size /= 1024.0
+    return '{:.1f} GB'.format(size)
 
-        if datetime.now() > max_time:
-            raise Exception("Waiting time exceeded")
 
-        time.sleep(10)
+def _retry_settings(retries=None, max_delay=None, cfg_path=CFG_FILE_PATH):
+    """ Retry settings of the config file, the options override them"""
+    try:
+        with open(cfg_path) as fd:
+            settings = json.load(fd).get(RETRY_CONFIG_KEY) or {}
+    except (IOError, OSError, ValueError, AttributeError):
+        settings = {}
+    if not isinstance(settings, dict):
+        raise ConfigError("Invalid {} section of {}".format(RETRY_CONFIG_KEY, cfg_path))
+
+    settings = dict(settings)
+    if retries is not None:
+        settings['retries'] = retries
+    if max_delay is not None:
+        settings['max_delay'] = max_delay
+    return settings
+
+
+def _retry_log(message):
+    with _print_lock:
+        print("WARN: {}".format(message))
+
+
+def _prefixed_log(prefix):
+    def log(message):
+        with _print_lock:
+            print("[{}] {}".format(prefix, message))
+    return log
+
+
+def _report_trace():
+    tracer = tracing.tracer
+    if tracer.timings and tracer.spans:
+        print()
+        _print_table(('PHASE', 'COUNT', 'TIME', 'API CALLS', 'SENT', 'RECEIVED'),
+                     [(p['name'], p['count'], format_ms(p['elapsed']), p['calls'],
+                       _format_size(p['bytes_sent']), _format_size(p['bytes_received']))
+                      for p in tracer.summary()])
+    if tracer.trace_file and tracer.spans:
+        tracer.write_chrome_trace(tracer.trace_file)
+        print("Trace saved [{}]".format(tracer.trace_file))
+
+
+def _report_metrics(exit_code, started):
+    if not metrics.registry.enabled:
+        return
+    commands = [arg.replace('-', '_') for arg in sys.argv[1:]]
+    command = next((c for c in commands if not c.startswith('_') and hasattr(APSConnectUtil, c)),
+                   None)
+    try:
+        path = metrics.write(command, exit_code, started)
+    except (IOError, OSError) as e:
+        print("Unable to save metrics, error: {}".format(e))
+    else:
+        print("Metrics saved [{}]".format(path))
 
 
 def main():
+    import fire
+
+    started = time.time()
+    exit_code = 0
     try:
         fire.Fire(APSConnectUtil, name='apsconnect')
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+        raise
     except Exception as e:
         print("Error: {}".format(e))
+        exit_code = 1
         sys.exit(1)
+    finally:
+        _report_trace()
+        _report_metrics(exit_code, started)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,257 @@
+from __future__ import print_function
+
+import os
+import json
+import time
+import hashlib
+import zipfile
+import tempfile
+from collections import namedtuple
+from xml.etree import ElementTree as xml_et
+
+from apsconnectcli import files
+from apsconnectcli import retry
+from apsconnectcli import tracing
+from apsconnectcli.lazy import LazyModule
+from apsconnectcli.errors import PackageError
+
+CACHE_DIR_PATH = os.path.expanduser('~/.aps_cache')
+CACHE_MAX_SIZE = 1024 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+APS_NAMESPACE = '{http://aps-standard.org/ns/2}'
+PACKAGE_SUFFIX = '.app.zip'
+META_SUFFIX = '.meta.json'
+
+requests = LazyModule('requests')
+
+Package = namedtuple('Package', ('source', 'path', 'is_http_source', 'sha256', 'from_cache',
+                                 'meta'))
+
+
+def fetch_package(source, no_cache=False, target_dir=None, cache_dir=CACHE_DIR_PATH,
+                  max_size=CACHE_MAX_SIZE):
+    """ Connector package from http(s) URL or file path, http(s) packages are taken from the
+    cache unless no_cache, then they are downloaded to target_dir, the current directory by
+    default. Returns Package with the parsed metadata"""
+    is_http_source = source.startswith('http://') or source.startswith('https://')
+    sha256, from_cache = None, False
+
+    try:
+        if is_http_source and no_cache:
+            with tracing.span('download'):
+                path, sha256 = download(source, target_dir)
+        elif is_http_source:
+            with tracing.span('download'):
+                path, sha256, from_cache = fetch(source, cache_dir, max_size)
+        else:
+            path = os.path.expanduser(source)
+    except Exception as e:
+        raise PackageError("Unable to download package {}, error: {}".format(source, e))
+
+    try:
+        with tracing.span('package metadata'):
+            # Only the cached copies keep their metadata, downloaded ones are temporary
+            meta = get_meta(path, None if no_cache else sha256, cache_dir)
+    except Exception as e:
+        raise PackageError("Unable to read package {}, error: {}".format(path, e))
+
+    return Package(source, path, is_http_source, sha256, from_cache, meta)
+
+
+def download(url, target_dir=None):
+    """ Download the file, returns its local path and sha256 computed while writing"""
+    local_filename = url.split('/')[-1]
+    if target_dir:
+        local_filename = os.path.join(target_dir, local_filename)
+    r = retry.send(requests.request, 'GET', url, stream=True,
+                   hooks={'response': tracing.requests_hook_for('download')})
+    r.raise_for_status()
+    sha256 = hashlib.sha256()
+    with open(local_filename, 'wb') as f:
+        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if chunk:  # filter out keep-alive new chunks
+                sha256.update(chunk)
+                f.write(chunk)
+    return local_filename, sha256.hexdigest()
+
+
+def read_package_meta(package_path):
+    """ Parse id, version and release of the connector from APP-META.xml of the package"""
+    with zipfile.ZipFile(package_path, 'r') as zip_ref:
+        tree = xml_et.fromstring(zip_ref.read('APP-META.xml'))
+
+    return {key: tree.find('{}{}'.format(APS_NAMESPACE, key)).text
+            for key in ('id', 'version', 'release')}
+
+
+def fetch(url, cache_dir=CACHE_DIR_PATH, max_size=CACHE_MAX_SIZE):
+    """ Get the package from the cache revalidating it with a conditional GET, download and
+    store it otherwise. Returns package path, its sha256 and whether the cached copy was used"""
+    index = _load_index(cache_dir)
+    entry = index['urls'].get(url)
+    headers = {}
+
+    if entry and os.path.exists(_package_path(cache_dir, entry['sha256'])):
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    r = retry.send(requests.request, 'GET', url, stream=True, headers=headers,
+                   hooks={'response': tracing.requests_hook_for('download')})
+
+    if r.status_code == 304:
+        r.close()
+        package_path = _package_path(cache_dir, entry['sha256'])
+        _touch(package_path)
+        return package_path, entry['sha256'], True
+
+    r.raise_for_status()
+
+    blobs_dir = _blobs_dir(cache_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=blobs_dir, suffix='.part')
+    sha256 = hashlib.sha256()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if chunk:  # filter out keep-alive new chunks
+                    sha256.update(chunk)
+                    f.write(chunk)
+
+        digest = sha256.hexdigest()
+        package_path = _package_path(cache_dir, digest)
+        if os.path.exists(package_path):
+            # Same content under another URL or version, keep a single copy
+            os.remove(tmp_path)
+            _touch(package_path)
+        else:
+            files.replace(tmp_path, package_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    index['urls'][url] = {
+        'sha256': digest,
+        'etag': r.headers.get('ETag'),
+        'last_modified': r.headers.get('Last-Modified'),
+    }
+    _save_index(cache_dir, index)
+
+    prune(max_size, cache_dir, keep=(digest,))
+
+    return package_path, digest, False
+
+
+def get_meta(package_path, sha256=None, cache_dir=CACHE_DIR_PATH):
+    """ Package metadata, for cached packages it is stored next to the package so the archive
+    is parsed only once"""
+    if not sha256:
+        return read_package_meta(package_path)
+
+    meta_path = os.path.join(_blobs_dir(cache_dir), sha256 + META_SUFFIX)
+    try:
+        with open(meta_path) as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        pass
+
+    meta = read_package_meta(package_path)
+    files.write_json(meta_path, meta, indent=4)
+    return meta
+
+
+def list_entries(cache_dir=CACHE_DIR_PATH):
+    """ Cached packages ordered from the most recently used"""
+    if not os.path.isdir(os.path.join(cache_dir, 'packages')):
+        return []
+
+    urls = {}
+    for url, entry in _load_index(cache_dir)['urls'].items():
+        urls.setdefault(entry['sha256'], []).append(url)
+
+    entries = []
+    for sha256, path in _iter_packages(cache_dir):
+        stat = os.stat(path)
+        meta_path = os.path.join(_blobs_dir(cache_dir), sha256 + META_SUFFIX)
+        try:
+            with open(meta_path) as fd:
+                meta = json.load(fd)
+        except (IOError, OSError, ValueError):
+            meta = None
+        entries.append({
+            'sha256': sha256,
+            'path': path,
+            'size': stat.st_size,
+            'last_used': stat.st_mtime,
+            'meta': meta,
+            'urls': sorted(urls.get(sha256, [])),
+        })
+
+    return sorted(entries, key=lambda e: e['last_used'], reverse=True)
+
+
+def prune(max_size=CACHE_MAX_SIZE, cache_dir=CACHE_DIR_PATH, keep=()):
+    """ Evict the least recently used packages until the cache fits max_size,
+    returns evicted entries"""
+    entries = list_entries(cache_dir)
+    total = sum(e['size'] for e in entries)
+    evicted = []
+
+    for entry in reversed(entries):
+        if total <= max_size:
+            break
+        if entry['sha256'] in keep:
+            continue
+        for path in (entry['path'],
+                     os.path.join(_blobs_dir(cache_dir), entry['sha256'] + META_SUFFIX)):
+            if os.path.exists(path):
+                os.remove(path)
+        total -= entry['size']
+        evicted.append(entry)
+
+    if evicted:
+        evicted_sha256 = set(e['sha256'] for e in evicted)
+        index = _load_index(cache_dir)
+        index['urls'] = {url: entry for url, entry in index['urls'].items()
+                         if entry['sha256'] not in evicted_sha256}
+        _save_index(cache_dir, index)
+
+    return evicted
+
+
+def _blobs_dir(cache_dir):
+    path = os.path.join(cache_dir, 'packages')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def _package_path(cache_dir, sha256):
+    return os.path.join(_blobs_dir(cache_dir), sha256 + PACKAGE_SUFFIX)
+
+
+def _iter_packages(cache_dir):
+    blobs_dir = _blobs_dir(cache_dir)
+    for filename in os.listdir(blobs_dir):
+        if filename.endswith(PACKAGE_SUFFIX):
+            yield filename[:-len(PACKAGE_SUFFIX)], os.path.join(blobs_dir, filename)
+
+
+def _touch(path):
+    now = time.time()
+    os.utime(path, (now, now))
+
+
+def _load_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, 'index.json')) as fd:
+            index = json.load(fd)
+    except (IOError, OSError, ValueError):
+        index = {}
+    index.setdefault('urls', {})
+    return index
+
+
+def _save_index(cache_dir, index):
+    files.write_json(os.path.join(cache_dir, 'index.json'), index, indent=4)
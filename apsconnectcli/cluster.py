@@ -0,0 +1,1034 @@
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import re
+import base64
+import random
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from collections import namedtuple
+
+from apsconnectcli import probe
+from apsconnectcli import retry
+from apsconnectcli import metrics
+from apsconnectcli import loadtest as load
+from apsconnectcli import tracing
+from apsconnectcli.lazy import LazyModule
+from apsconnectcli.journal import Journal, JOURNAL_DIR_PATH
+from apsconnectcli.templates import BACKEND_LABELS, load_templates
+from apsconnectcli.errors import ClusterError, ConfigError, WaitTimeoutError, wrap_error
+
+KUBE_DIR_PATH = os.path.expanduser('~/.kube')
+KUBE_FILE_PATH = '{}/config'.format(KUBE_DIR_PATH)
+WAIT_FOR_CHOICES = ('service', 'rollout', 'both')
+POLL_INITIAL_DELAY = 1
+POLL_MAX_DELAY = 10
+DELETE_WORKERS = 8
+OVERRIDES_SECTIONS = ('deployment', 'service', 'autoscaler')
+CONFIG_KEY = 'config.json'
+# Secret data is limited by the API server, larger objects are rejected by etcd
+SECRET_MAX_SIZE = 1024 * 1024
+# Multiple of 3 bytes, so the base64 chunks join without padding
+CONFIG_CHUNK_SIZE = 3 * 64 * 1024
+CONFIG_HASH_ANNOTATION = 'apsconnect/config-hash'
+# Fields of the object applied last time, --force removes the ones no longer desired
+LAST_APPLIED_ANNOTATION = 'apsconnect/last-applied'
+# Secret data is set as a whole and not recorded in the annotation, it can be too large for it
+SECRET_REPLACED = ('/data',)
+# Attempts to replace an object changed by someone else since it was read
+APPLY_ATTEMPTS = 3
+SECRET_KEY_RE = re.compile(r'^[-._a-zA-Z0-9]+$')
+BACKEND_SELECTOR = ','.join('{}={}'.format(k, v) for k, v in sorted(BACKEND_LABELS.items()))
+# Parameters of install_backend defining the objects, the same render_backend gets
+RENDER_PARAMS = ('name', 'image', 'healthcheck_path', 'namespace', 'replicas', 'cpu_request',
+                 'memory_request', 'cpu_limit', 'memory_limit', 'probe_delay', 'probe_period',
+                 'probe_timeout', 'min_replicas', 'max_replicas', 'target_cpu', 'templates_file')
+# Parameters which don't change the created objects, the install can be resumed with others
+JOURNAL_IGNORED_PARAMS = ('force', 'wait_for', 'timeout', 'verify_ready', 'healthy_count',
+                          'latency_budget', 'probe_pods', 'loadtest')
+
+yaml = LazyModule('yaml')
+client = LazyModule('kubernetes.client')
+config = LazyModule('kubernetes.config')
+watch = LazyModule('kubernetes.watch')
+k8s_rest = LazyModule('kubernetes.client.rest')
+futures = LazyModule('concurrent.futures')
+
+_kube_configs = {}
+_clients = {}
+_clients_lock = threading.Lock()
+
+BackendResult = namedtuple('BackendResult', ('name', 'url', 'actions', 'probes', 'elapsed',
+                                             'load'))
+# Base64 encoded secret data by key, digest of the content and its total size in bytes
+SecretData = namedtuple('SecretData', ('data', 'digest', 'size'))
+
+
+class ClusterClient(object):
+    """ Connection to the k8s cluster, the API groups share one connection pool, so the client
+    can be kept for many operations"""
+
+    def __init__(self, config_file=None, pool_maxsize=None, api_client=None, context=None):
+        if api_client is None:
+            path = _kube_config_path(config_file)
+            api_client = _new_api_client(load_kube_config(path), context, os.path.dirname(path))
+
+        tracing.instrument_k8s_client(api_client)
+        retry.retry_k8s_client(api_client)
+        self.api_client = api_client
+        self.context = context
+        if pool_maxsize:
+            self._grow_pool(pool_maxsize)
+
+        self.version_api = client.VersionApi(api_client)
+        self.core_api = client.CoreV1Api(api_client)
+        self.ext_api = client.ExtensionsV1beta1Api(api_client)
+        self.autoscaling_api = client.AutoscalingV1Api(api_client)
+
+    @classmethod
+    def from_config_dict(cls, config_dict, pool_maxsize=None, context=None):
+        """ Client of the cluster described by the kubeconfig mapping, which is not saved"""
+        return cls(pool_maxsize=pool_maxsize, api_client=_new_api_client(config_dict, context),
+                   context=context)
+
+    @classmethod
+    def for_context(cls, context=None, config_file=None, pool_maxsize=None):
+        """ Client of the kubeconfig context, the current one by default, shared by the whole
+        process: the config is parsed and the connections are set up once per context, so
+        several clusters can be used in parallel. The client is replaced when the file
+        changes"""
+        path = _kube_config_path(config_file)
+        config_dict = load_kube_config(path)
+        key = (path, context or config_dict.get('current-context'))
+        with _clients_lock:
+            loaded, cluster = _clients.get(key, (None, None))
+            if loaded is not config_dict:
+                cluster = cls(path, pool_maxsize, context=key[1])
+                _clients[key] = (config_dict, cluster)
+            elif pool_maxsize:
+                cluster._grow_pool(pool_maxsize)
+        return cluster
+
+    @property
+    def host(self):
+        return self.api_client.host
+
+    def get_version(self):
+        """ Cluster version info, checks the connectivity"""
+        try:
+            with tracing.span('k8s get_code'):
+                return self.version_api.get_code()
+        except Exception as e:
+            raise ClusterError("Unable to communicate with k8s cluster, error: {}".format(e))
+
+    def _grow_pool(self, maxsize):
+        """ Keep a connection per worker instead of discarding the extra ones"""
+        pool_manager = self.api_client.rest_client.pool_manager
+        if maxsize > pool_manager.connection_pool_kw.get('maxsize', 1):
+            pool_manager.connection_pool_kw['maxsize'] = maxsize
+            # Pools keep the size they were created with, they are created again on demand
+            pool_manager.clear()
+
+
+def load_kube_config(config_file=None):
+    """ Parsed kubeconfig file, cached until the file changes"""
+    path = _kube_config_path(config_file)
+    try:
+        mtime = os.path.getmtime(path)
+        loaded = _kube_configs.get(path)
+        if loaded and loaded[0] == mtime:
+            return loaded[1]
+        with open(path) as fd:
+            config_dict = yaml.safe_load(fd)
+    except Exception as e:
+        raise ConfigError("Unable to load k8s config, error: {}".format(e))
+
+    if not isinstance(config_dict, dict):
+        raise ConfigError("Unable to load k8s config, error: {} is not a kubeconfig".format(path))
+    _kube_configs[path] = (mtime, config_dict)
+    return config_dict
+
+
+def list_contexts(config_file=None):
+    """ Context names of the kubeconfig file and the current one"""
+    config_dict = load_kube_config(config_file)
+    return ([c.get('name') for c in config_dict.get('contexts') or []],
+            config_dict.get('current-context'))
+
+
+def select_contexts(contexts, config_file=None):
+    """ Context names of the comma separated string or list, all selects every context of the
+    kubeconfig file"""
+    if isinstance(contexts, (list, tuple)):
+        names = [str(name) for name in contexts]
+    else:
+        names = [name.strip() for name in str(contexts).split(',') if name.strip()]
+
+    available = list_contexts(config_file)[0]
+    if names == ['all']:
+        names = available
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ConfigError("Unknown k8s contexts: {}, expected {}".format(
+            ', '.join(unknown), ', '.join(available) or 'none, run init-cluster first'))
+    if not names:
+        raise ConfigError("No k8s contexts selected")
+    return names
+
+
+def save_kube_config(config_dict, config_file=None, current=True):
+    """ Add the clusters, users and contexts of the kubeconfig mapping to the file, entries of
+    the same names are replaced and the others kept. The context becomes current if current
+    is set or there is no current one. Returns the path"""
+    path = _kube_config_path(config_file)
+    try:
+        saved = load_kube_config(path)
+    except ConfigError:
+        if os.path.exists(path):
+            raise
+        saved = {}
+
+    merged = dict(saved, **{k: v for k, v in config_dict.items()
+                            if k not in ('clusters', 'users', 'contexts', 'current-context')})
+    for section in ('clusters', 'users', 'contexts'):
+        names = set(entry['name'] for entry in config_dict.get(section) or [])
+        merged[section] = [entry for entry in saved.get(section) or []
+                           if entry.get('name') not in names] + list(config_dict.get(section) or [])
+    if current or not saved.get('current-context'):
+        merged['current-context'] = config_dict['current-context']
+
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fd:
+            yaml.safe_dump(merged, fd, default_flow_style=False)
+    except (IOError, OSError) as e:
+        raise ConfigError("Unable to save k8s config, error: {}".format(e))
+    finally:
+        # Modification time can stay the same within its resolution
+        _kube_configs.pop(path, None)
+    return path
+
+
+def _kube_config_path(config_file):
+    return os.path.abspath(os.path.expanduser(config_file or KUBE_FILE_PATH))
+
+
+def _new_api_client(config_dict, context=None, base_path=''):
+    try:
+        client_config = client.ConfigurationObject()
+        config.kube_config.KubeConfigLoader(
+            config_dict, active_context=context, client_configuration=client_config,
+            config_base_path=base_path).load_and_set()
+        return client.ApiClient(config=client_config)
+    except Exception as e:
+        raise ConfigError("Unable to load k8s config, error: {}".format(e))
+
+
+def _create_secret(secret, api, namespace='default', force=False):
+    name = secret['metadata']['name']
+    if force:
+        # Large data is not compared when the content hash is the same, otherwise it is
+        # replaced, so the keys of the files removed from the config dir go away
+        config_hash = (secret['metadata'].get('annotations') or {}).get(CONFIG_HASH_ANNOTATION)
+        return _apply_object(api, 'secret', secret, namespace,
+                             recreate=lambda: _delete_secret(name, api, namespace),
+                             replaced=SECRET_REPLACED,
+                             unchanged=lambda current: config_hash is not None and (
+                                 current['metadata'].get('annotations') or {}).get(
+                                     CONFIG_HASH_ANNOTATION) == config_hash)
+
+    api.create_namespaced_secret(
+        namespace=namespace,
+        body=_with_last_applied(secret, SECRET_REPLACED),
+    )
+    return 'created'
+
+
+def _delete_secret(name, api, namespace):
+    try:
+        api.delete_namespaced_secret(
+            namespace=namespace,
+            body=client.V1DeleteOptions(),
+            name=name,
+        )
+    except k8s_rest.ApiException as e:
+        if e.status != 404:
+            raise
+
+
+def _create_deployment(deployment, api, namespace='default', force=False, core_api=None,
+                       autoscaled=False):
+    name = deployment['metadata']['name']
+    if force:
+        # Replicas are managed by the autoscaler, re-apply must not reset them
+        return _apply_object(api, 'deployment', deployment, namespace,
+                             recreate=lambda: _delete_deployment(name, api=api,
+                                                                 namespace=namespace,
+                                                                 core_api=core_api),
+                             ignore=('/spec/replicas',) if autoscaled else ())
+
+    api.create_namespaced_deployment(namespace=namespace, body=_with_last_applied(deployment))
+    return 'created'
+
+
+def _delete_deployment(name, api, namespace, core_api=None):
+    try:
+        api.delete_namespaced_deployment(
+            namespace=namespace,
+            name=name,
+            body=client.V1DeleteOptions(),
+            grace_period_seconds=0,
+        )
+    except k8s_rest.ApiException as e:
+        if e.status != 404:
+            raise
+
+    label_selector = 'name={}'.format(name)
+
+    # Replica sets go first, otherwise they bring the pods back
+    _delete_collection(api, 'replica_set', namespace, label_selector)
+
+    # Collection delete can't skip the grace period, pods are removed one by one concurrently
+    pods = core_api.list_namespaced_pod(namespace=namespace, label_selector=label_selector)
+    _delete_concurrently(core_api, 'pod', namespace, [pod.metadata.name for pod in pods.items])
+
+
+def _delete_collection(api, kind, namespace, label_selector):
+    try:
+        getattr(api, 'delete_collection_namespaced_{}'.format(kind))(
+            namespace=namespace,
+            label_selector=label_selector,
+        )
+    except k8s_rest.ApiException as e:
+        if e.status not in (404, 405):
+            raise
+        # Collection delete is not supported by the API server
+        items = getattr(api, 'list_namespaced_{}'.format(kind))(
+            namespace=namespace,
+            label_selector=label_selector,
+        ).items
+        _delete_concurrently(api, kind, namespace, [item.metadata.name for item in items])
+
+
+def _delete_concurrently(api, kind, namespace, names):
+    def delete(name):
+        try:
+            getattr(api, 'delete_namespaced_{}'.format(kind))(
+                namespace=namespace,
+                name=name,
+                body=client.V1DeleteOptions(),
+                grace_period_seconds=0,
+            )
+        except k8s_rest.ApiException as e:
+            if e.status != 404:
+                raise
+
+    if not names:
+        return
+
+    with futures.ThreadPoolExecutor(max_workers=min(len(names), DELETE_WORKERS)) as executor:
+        list(executor.map(delete, names))
+
+
+def _create_service(service, api, namespace='default', force=False):
+    name = service['metadata']['name']
+    if force:
+        return _apply_object(api, 'service', service, namespace,
+                             recreate=lambda: _delete_service(name, api, namespace))
+
+    api.create_namespaced_service(namespace=namespace, body=_with_last_applied(service))
+    return 'created'
+
+
+def _delete_service(name, api, namespace):
+    try:
+        api.delete_namespaced_service(namespace=namespace, name=name)
+    except k8s_rest.ApiException as e:
+        if e.status != 404:
+            raise
+
+
+def _create_autoscaler(autoscaler, api, namespace='default', force=False):
+    name = autoscaler['metadata']['name']
+    if force:
+        return _apply_object(api, 'horizontal_pod_autoscaler', autoscaler, namespace,
+                             recreate=lambda: _delete_autoscaler(name, api, namespace))
+
+    api.create_namespaced_horizontal_pod_autoscaler(namespace=namespace,
+                                                    body=_with_last_applied(autoscaler))
+    return 'created'
+
+
+def _delete_autoscaler(name, api, namespace):
+    """ Returns whether the autoscaler existed"""
+    try:
+        api.delete_namespaced_horizontal_pod_autoscaler(
+            namespace=namespace,
+            name=name,
+            body=client.V1DeleteOptions(),
+        )
+    except k8s_rest.ApiException as e:
+        if e.status != 404:
+            raise
+        return False
+    return True
+
+
+@metrics.measured('install_backend')
+def install_backend(cluster, name, image, config_data, healthcheck_path='/', root_path='/',
+                    namespace='default', replicas=2, force=False, wait_for='service',
+                    timeout=180, verify_ready=False, healthy_count=3, latency_budget=1.0,
+                    probe_pods=False, cpu_request=None, memory_request=None, cpu_limit='100m',
+                    memory_limit='128Mi', probe_delay=None, probe_period=None,
+                    probe_timeout=None, min_replicas=None, max_replicas=None, target_cpu=80,
+                    overrides=None, templates_file=None, log=None, progress=False,
+                    journal=None, loadtest=None):
+    """ Create or with force update config, deployment, service and autoscaler of the
+    connector-backend and wait for them, returns BackendResult. Progress messages are passed
+    to log, progress prints dots while waiting. Completed steps are recorded in the journal,
+    the steps recorded by the resumed journal are skipped if their objects still exist and
+    the rest are applied like with force. loadtest is a mapping of run_load settings and
+    LOADTEST_THRESHOLDS, the health check of the exposed service is loaded with them at the
+    end and the install fails if the thresholds are missed"""
+    check_backend_params(wait_for, verify_ready, probe_pods, loadtest)
+    manifests = render_backend(name, image, config_data, healthcheck_path, namespace, replicas,
+                               cpu_request, memory_request, cpu_limit, memory_limit,
+                               probe_delay, probe_period, probe_timeout, min_replicas,
+                               max_replicas, target_cpu, overrides, templates_file)
+    replicas, _, autoscaled = _backend_replicas(replicas, min_replicas, max_replicas)
+    core_api, ext_api = cluster.core_api, cluster.ext_api
+    log = log or _no_log
+    started = time.time()
+    actions = {}
+    resume = journal is not None and journal.resumed
+    if resume:
+        log("Resuming install, done before: {}".format(', '.join(sorted(journal.steps))))
+        # Objects of the steps not recorded may be created already
+        force = True
+
+    def run_step(what, create, read):
+        if resume and journal.done(what) and _object_exists(read, name, namespace):
+            return 'skipped'
+        action = create()
+        if journal is not None:
+            journal.record(what, action=action)
+        return action
+
+    try:
+        with tracing.span('secret'):
+            actions['config'] = run_step(
+                'config', lambda: _create_secret(manifests['secret'], core_api, namespace, force),
+                core_api.read_namespaced_secret)
+        log(_action_message('config', actions['config']))
+    except Exception as e:
+        raise ClusterError("Can't create config in cluster, error: {}".format(e))
+
+    if force and not autoscaled:
+        # Autoscaler of the previous install would keep scaling the fixed replicas
+        try:
+            with tracing.span('autoscaler'):
+                if _delete_autoscaler(name, cluster.autoscaling_api, namespace):
+                    actions['autoscaler'] = 'deleted'
+                    log(_action_message('autoscaler', actions['autoscaler']))
+        except Exception as e:
+            raise ClusterError("Can't delete autoscaler in cluster, error: {}".format(e))
+
+    try:
+        with tracing.span('deployment'):
+            actions['deployment'] = run_step('deployment', lambda: _create_deployment(
+                manifests['deployment'], ext_api, namespace, force, core_api=core_api,
+                autoscaled=autoscaled),
+                ext_api.read_namespaced_deployment)
+        log(_action_message('deployment', actions['deployment']))
+    except Exception as e:
+        raise ClusterError("Can't create deployment in cluster, error: {}".format(e))
+
+    try:
+        with tracing.span('service'):
+            actions['service'] = run_step('service', lambda: _create_service(
+                manifests['service'], core_api, namespace, force),
+                core_api.read_namespaced_service)
+        log(_action_message('service', actions['service']))
+    except Exception as e:
+        raise ClusterError("Can't create service in cluster, error: {}".format(e))
+
+    if autoscaled:
+        try:
+            with tracing.span('autoscaler'):
+                actions['autoscaler'] = run_step('autoscaler', lambda: _create_autoscaler(
+                    manifests['autoscaler'], cluster.autoscaling_api, namespace, force),
+                    cluster.autoscaling_api.read_namespaced_horizontal_pod_autoscaler)
+            log(_action_message('autoscaler', actions['autoscaler']))
+        except Exception as e:
+            raise ClusterError("Can't create autoscaler in cluster, error: {}".format(e))
+
+    deadline = datetime.now() + timedelta(seconds=timeout)
+    backend_url = None
+
+    if wait_for in ('service', 'both'):
+        log("Checking service availability")
+
+        try:
+            ip = None
+            if resume and journal.done('exposure'):
+                ip = _service_address(core_api.read_namespaced_service_status(
+                    name=name, namespace=namespace))
+            if ip is None:
+                with tracing.span('service exposure'):
+                    ip = _wait_for_service_access(name, core_api, namespace, deadline, progress)
+                if journal is not None:
+                    journal.record('exposure', address=ip)
+            backend_url = "http://{}/{}".format(ip, root_path.lstrip('/'))
+            log("Expose service [ok]")
+            log("Connector backend - {}".format(backend_url))
+        except Exception as e:
+            raise wrap_error(e, "Service expose FAILED, error: {}", ClusterError)
+
+    if wait_for in ('rollout', 'both'):
+        log("Checking deployment rollout")
+
+        try:
+            with tracing.span('rollout'):
+                _wait_for_rollout(name, ext_api, namespace, deadline, progress)
+                _wait_for_pods_ready(name, replicas, core_api, namespace, deadline, progress)
+            log("Rollout deployment [ok]")
+        except Exception as e:
+            raise wrap_error(e, "Deployment rollout FAILED, error: {}", ClusterError)
+
+    results = []
+    if verify_ready:
+        log("Checking backend readiness")
+
+        urls = ['http://{}/{}'.format(ip, healthcheck_path.lstrip('/'))]
+        if probe_pods:
+            try:
+                pods = core_api.list_namespaced_pod(namespace=namespace,
+                                                    label_selector='name={}'.format(name))
+            except Exception as e:
+                raise wrap_error(e, "Can't list backend pods, error: {}", ClusterError)
+            urls.extend('http://{}/{}'.format(pod.status.pod_ip, healthcheck_path.lstrip('/'))
+                        for pod in pods.items if pod.status.pod_ip and _is_pod_ready(pod))
+
+        with tracing.span('readiness'):
+            results = probe.wait_until_healthy(urls, deadline, healthy_count, latency_budget)
+        for result in results:
+            log(probe.format_result(result))
+
+        failed = [r for r in results if not r['ready']]
+        if failed:
+            raise ClusterError("Backend readiness FAILED, error: {}".format(
+                '; '.join('{} {}'.format(r['url'], r['error']) for r in failed)))
+        log("Backend readiness [ok]")
+
+    load_result = None
+    if loadtest:
+        log("Running backend load test")
+
+        settings = dict(loadtest)
+        thresholds = {k: settings.pop(k) for k in load.LOADTEST_THRESHOLDS if k in settings}
+        with tracing.span('load test'):
+            load_result = load.run_load(['http://{}/{}'.format(ip, healthcheck_path.lstrip('/'))],
+                                        **settings)
+        for line in load.format_result(load_result):
+            log(line)
+
+        failures = load.check_thresholds(load_result, **thresholds)
+        if failures:
+            raise ClusterError("Backend load test FAILED, error: {}".format('; '.join(failures)))
+        log("Backend load test [ok]")
+
+    if journal is not None:
+        journal.complete()
+
+    return BackendResult(name, backend_url, actions, results, time.time() - started, load_result)
+
+
+def render_backend(name, image, config_data, healthcheck_path='/', namespace='default',
+                   replicas=2, cpu_request=None, memory_request=None, cpu_limit='100m',
+                   memory_limit='128Mi', probe_delay=None, probe_period=None, probe_timeout=None,
+                   min_replicas=None, max_replicas=None, target_cpu=80, overrides=None,
+                   templates_file=None):
+    """ Manifests of the connector-backend objects by template kind: secret, deployment,
+    service and with max_replicas autoscaler. Rendered from the compiled templates without
+    contacting the cluster, config_data is the connector config or SecretData of a config
+    directory"""
+    templates = load_templates(templates_file, overrides)
+    replicas, min_replicas, autoscaled = _backend_replicas(replicas, min_replicas, max_replicas)
+
+    with tracing.span('render'):
+        secret_data = secret_config_data(config_data)
+        manifests = {
+            'secret': templates['secret'].render(
+                name=name, namespace=namespace, data=secret_data.data,
+                config=secret_data.data.get(CONFIG_KEY), config_hash=secret_data.digest),
+            'deployment': templates['deployment'].render(
+                name=name, namespace=namespace, image=image, replicas=replicas,
+                healthcheck_path=healthcheck_path,
+                cpu_request=_resource_quantity(cpu_request),
+                memory_request=_resource_quantity(memory_request),
+                cpu_limit=_resource_quantity(cpu_limit),
+                memory_limit=_resource_quantity(memory_limit),
+                probe_delay=_optional_int(probe_delay), probe_period=_optional_int(probe_period),
+                probe_timeout=_optional_int(probe_timeout)),
+            'service': templates['service'].render(name=name, namespace=namespace),
+        }
+        if autoscaled:
+            manifests['autoscaler'] = templates['autoscaler'].render(
+                name=name, namespace=namespace, min_replicas=min_replicas,
+                max_replicas=int(max_replicas), target_cpu=int(target_cpu))
+    return manifests
+
+
+def backend_journal(cluster, name, namespace='default', params=None, resume=False,
+                    journal_dir=JOURNAL_DIR_PATH):
+    """ Journal of the backend install to the cluster namespace, bound to the params which
+    define the objects"""
+    params = {k: v for k, v in (params or {}).items() if k not in JOURNAL_IGNORED_PARAMS}
+    return Journal.open('backend', '{}/{}/{}'.format(cluster.host, namespace, name), params,
+                        resume, journal_dir)
+
+
+def backend_address(cluster, name, namespace='default'):
+    """ Address of the exposed service of the connector-backend"""
+    try:
+        service = cluster.core_api.read_namespaced_service_status(name=name, namespace=namespace)
+    except Exception as e:
+        raise ClusterError("Can't read service {} in cluster, error: {}".format(name, e))
+
+    address = _service_address(service)
+    if not address:
+        raise ClusterError("Service {} is not exposed yet".format(name))
+    return address
+
+
+@metrics.measured('uninstall_backend')
+def uninstall_backend(cluster, name, namespace='default', wait=False, timeout=180, log=None,
+                      progress=False):
+    """ Delete autoscaler, service, deployment and config of the connector-backend, with wait
+    until its pods are terminated, returns BackendResult"""
+    core_api, ext_api = cluster.core_api, cluster.ext_api
+    log = log or _no_log
+    started = time.time()
+    steps = (
+        ('autoscaler', lambda: _delete_autoscaler(name, cluster.autoscaling_api, namespace)),
+        ('service', lambda: _delete_service(name, core_api, namespace)),
+        ('deployment', lambda: _delete_deployment(name, ext_api, namespace, core_api=core_api)),
+        ('config', lambda: _delete_secret(name, core_api, namespace)),
+    )
+
+    def run(step):
+        what, delete = step
+        try:
+            delete()
+            log("Delete {} [ok]".format(what))
+        except Exception as e:
+            raise ClusterError("Can't delete {} in cluster, error: {}".format(what, e))
+
+    with futures.ThreadPoolExecutor(max_workers=len(steps)) as executor:
+        list(executor.map(run, steps))
+
+    if wait:
+        log("Checking pods termination")
+        deadline = datetime.now() + timedelta(seconds=timeout)
+        try:
+            _wait_for_gone(core_api.list_namespaced_pod, namespace, deadline, progress,
+                           label_selector='name={}'.format(name))
+            log("Terminate pods [ok]")
+        except Exception as e:
+            raise wrap_error(e, "Pods termination FAILED, error: {}", ClusterError)
+
+    return BackendResult(name, None, {what: 'deleted' for what, _ in steps}, [],
+                         time.time() - started, None)
+
+
+def check_backend_params(wait_for, verify_ready=False, probe_pods=False, loadtest=None):
+    if wait_for not in WAIT_FOR_CHOICES:
+        raise ConfigError("Wait for must be one of {}, got {}".format(
+            ', '.join(WAIT_FOR_CHOICES), wait_for))
+    if verify_ready and wait_for == 'rollout':
+        raise ConfigError("Readiness verification needs the service address, "
+                          "use --wait-for service or both")
+    if loadtest and wait_for == 'rollout':
+        raise ConfigError("Load test needs the service address, use --wait-for service or both")
+    if probe_pods and not verify_ready:
+        raise ConfigError("Probing pods needs --verify-ready")
+
+
+def _action_message(what, action):
+    if action == 'skipped':
+        return "{} done before [skip]".format(what.capitalize())
+    if action == 'unchanged':
+        return "{} unchanged [ok]".format(what.capitalize())
+    verb = {'updated': 'Update', 'deleted': 'Delete'}.get(action, 'Create')
+    return "{} {} [ok]".format(verb, what)
+
+
+def _backend_replicas(replicas, min_replicas=None, max_replicas=None):
+    """ Initial replicas, min replicas and whether the deployment is autoscaled"""
+    if not max_replicas:
+        return replicas, min_replicas, False
+    min_replicas = int(min_replicas or replicas)
+    if int(max_replicas) < min_replicas:
+        raise ConfigError("Max replicas {} is less than min replicas {}".format(
+            max_replicas, min_replicas))
+    return min_replicas, min_replicas, True
+
+
+def _resource_quantity(value):
+    return None if value in (None, '') else str(value)
+
+
+def _optional_int(value):
+    return None if value is None else int(value)
+
+
+def load_config_data(path):
+    """ Connector config to store in the backend secret"""
+    try:
+        with tracing.span('config load'):
+            with open(path) as fd:
+                return json.load(fd)
+    except Exception as e:
+        raise ConfigError("Unable to read config file, error: {}".format(e))
+
+
+def load_config_dir(path):
+    """ SecretData of the files of the directory, a key per file. Files are read and encoded
+    chunk by chunk, the total size is checked against the secret limit before and while
+    they are read"""
+    try:
+        names = sorted(n for n in os.listdir(path) if os.path.isfile(os.path.join(path, n)))
+        sizes = [os.path.getsize(os.path.join(path, n)) for n in names]
+    except Exception as e:
+        raise ConfigError("Unable to read config dir, error: {}".format(e))
+
+    if not names:
+        raise ConfigError("Config dir {} has no files".format(path))
+    invalid = [n for n in names if not SECRET_KEY_RE.match(n)]
+    if invalid:
+        raise ConfigError("Config file names must consist of letters, digits, '-', '_' or "
+                          "'.', got {}".format(', '.join(invalid)))
+    _check_secret_size(sum(sizes) + sum(len(n) for n in names), path)
+
+    data, size = {}, sum(len(n) for n in names)
+    digest = hashlib.sha256()
+    with tracing.span('config load'):
+        for name in names:
+            chunks, file_digest = [], hashlib.sha256()
+            try:
+                with open(os.path.join(path, name), 'rb') as fd:
+                    for chunk in iter(lambda: fd.read(CONFIG_CHUNK_SIZE), b''):
+                        size += len(chunk)
+                        # File grown since it was listed
+                        _check_secret_size(size, path)
+                        file_digest.update(chunk)
+                        chunks.append(base64.b64encode(chunk).decode())
+            except (IOError, OSError) as e:
+                raise ConfigError("Unable to read config file, error: {}".format(e))
+            data[name] = ''.join(chunks)
+            digest.update('{}\0{}\n'.format(name, file_digest.hexdigest()).encode('utf-8'))
+
+    return SecretData(data, digest.hexdigest(), size)
+
+
+def secret_config_data(config_data):
+    """ SecretData of the connector config, stored as config.json, SecretData is kept as
+    is"""
+    if isinstance(config_data, SecretData):
+        return config_data
+
+    content = json.dumps(config_data).encode('utf-8')
+    size = len(CONFIG_KEY) + len(content)
+    _check_secret_size(size, CONFIG_KEY)
+    digest = hashlib.sha256('{}\0{}\n'.format(
+        CONFIG_KEY, hashlib.sha256(content).hexdigest()).encode('utf-8'))
+    return SecretData({CONFIG_KEY: base64.b64encode(content).decode()}, digest.hexdigest(), size)
+
+
+def load_overrides(path):
+    """ Overrides file sections to merge into the generated objects"""
+    try:
+        with open(path) as fd:
+            overrides = yaml.safe_load(fd) or {}
+    except Exception as e:
+        raise ConfigError("Unable to read overrides file, error: {}".format(e))
+
+    if not isinstance(overrides, dict):
+        raise ConfigError("Overrides must be a mapping with {} sections".format(
+            ', '.join(OVERRIDES_SECTIONS)))
+    unknown = set(overrides) - set(OVERRIDES_SECTIONS)
+    if unknown:
+        raise ConfigError("Unknown overrides sections: {}, expected {}".format(
+            ', '.join(sorted(unknown)), ', '.join(OVERRIDES_SECTIONS)))
+    return overrides
+
+
+def _apply_object(api, kind, body, namespace, recreate=None, ignore=(), unchanged=None,
+                  replaced=()):
+    """ Create the object or replace the existing one with the desired fields set over it,
+    except the ignored paths, returns created, updated or unchanged. Fields applied last time
+    and no longer desired are removed, fields set by the server only are kept as is, the
+    replaced top level paths are set as a whole. unchanged(current) tells the object is up to
+    date without comparing the fields"""
+    name = body['metadata']['name']
+    body = _with_last_applied(body, replaced)
+
+    for attempt in range(APPLY_ATTEMPTS):
+        try:
+            current = _read_object(api, kind, name, namespace)
+        except k8s_rest.ApiException as e:
+            if e.status != 404:
+                raise
+            getattr(api, 'create_namespaced_{}'.format(kind))(namespace=namespace, body=body)
+            return 'created'
+
+        if unchanged and unchanged(current):
+            return 'unchanged'
+
+        current.pop('status', None)
+        try:
+            applied = json.loads(current['metadata'].get('annotations', {})
+                                 .get(LAST_APPLIED_ANNOTATION) or '{}')
+        except ValueError:
+            applied = {}
+        updated = _merge_applied(body, current, applied, ignore=ignore, replaced=replaced)
+        if updated == current:
+            return 'unchanged'
+
+        try:
+            # resourceVersion of the object read is kept, so a concurrent change is not lost
+            getattr(api, 'replace_namespaced_{}'.format(kind))(name=name, namespace=namespace,
+                                                               body=updated)
+        except k8s_rest.ApiException as e:
+            if e.status == 409 and attempt + 1 < APPLY_ATTEMPTS:
+                continue
+            if e.status != 422 or not recreate:
+                raise
+            # Immutable field is changed, the object can be only replaced
+            recreate()
+            getattr(api, 'create_namespaced_{}'.format(kind))(namespace=namespace, body=body)
+
+        return 'updated'
+
+
+def _read_object(api, kind, name, namespace):
+    """ Object as served, not parsed into the client model, so the fields unknown to the
+    model are not dropped when it is written back"""
+    read = getattr(api, 'read_namespaced_{}'.format(kind))
+    r = read(name=name, namespace=namespace, _preload_content=False)
+    return json.loads(r.data.decode('utf-8'))
+
+
+def _with_last_applied(body, replaced=()):
+    """ Copy of the object annotated with its fields except the replaced top level paths"""
+    metadata = dict(body['metadata'])
+    annotations = dict(metadata.get('annotations') or {})
+    annotations.pop(LAST_APPLIED_ANNOTATION, None)
+    metadata['annotations'] = annotations
+    applied = dict((key, value) for key, value in body.items() if '/' + key not in replaced)
+    applied = json.dumps(dict(applied, metadata=metadata), sort_keys=True, separators=(',', ':'))
+    metadata['annotations'] = dict(annotations, **{LAST_APPLIED_ANNOTATION: applied})
+    return dict(body, metadata=metadata)
+
+
+def _merge_applied(desired, current, applied, path='', ignore=(), replaced=()):
+    """ Current value with the desired one set over it: mappings are merged key by key and the
+    keys applied before but no longer desired are removed, lists of the same length are merged
+    item by item, other values are replaced. The ignored paths keep the current value, the
+    replaced ones get the desired value as a whole"""
+    if path in ignore:
+        return current
+    if path in replaced:
+        return desired
+
+    if isinstance(desired, dict) and isinstance(current, dict):
+        applied = applied if isinstance(applied, dict) else {}
+        merged = {}
+        for key, value in current.items():
+            key_path = '{}/{}'.format(path, key)
+            if key in desired:
+                merged[key] = _merge_applied(desired[key], value, applied.get(key), key_path,
+                                             ignore, replaced)
+            elif key not in applied or key_path in ignore:
+                merged[key] = value
+        for key, value in desired.items():
+            merged.setdefault(key, value)
+        return merged
+
+    if isinstance(desired, list) and isinstance(current, list) and len(desired) == len(current):
+        if not isinstance(applied, list) or len(applied) != len(desired):
+            applied = [None] * len(desired)
+        return [_merge_applied(item, current[i], applied[i], '{}/{}'.format(path, i), ignore,
+                               replaced)
+                for i, item in enumerate(desired)]
+
+    return desired
+
+
+def _object_exists(read, name, namespace):
+    try:
+        read(name=name, namespace=namespace)
+        return True
+    except k8s_rest.ApiException as e:
+        if e.status != 404:
+            raise
+        return False
+
+
+def _no_log(message):
+    pass
+
+
+def _print_progress():
+    sys.stdout.write('.')
+    sys.stdout.flush()
+
+
+def _watch_until(list_func, on_event, deadline, progress=True, **kwargs):
+    """ Stream watch events until on_event returns a result, None on deadline"""
+    while True:
+        remaining = int((deadline - datetime.now()).total_seconds())
+        if remaining <= 0:
+            return None
+
+        stream = watch.Watch()
+        for event in stream.stream(list_func, timeout_seconds=remaining, **kwargs):
+            result = on_event(event['type'], event['object'])
+            if result is not None:
+                stream.stop()
+                return result
+
+            if progress:
+                _print_progress()
+
+
+def _poll_until(poll_func, on_poll, deadline, progress=True):
+    """ Poll with exponential backoff and jitter until on_poll returns a result, None on
+    deadline"""
+    delay = POLL_INITIAL_DELAY
+
+    while True:
+        result = on_poll(poll_func())
+        if result is not None:
+            return result
+
+        if progress:
+            _print_progress()
+
+        remaining = (deadline - datetime.now()).total_seconds()
+        if remaining <= 0:
+            return None
+
+        time.sleep(min(remaining, delay / 2.0 + random.uniform(0, delay / 2.0)))
+        delay = min(delay * 2, POLL_MAX_DELAY)
+
+
+def _wait_until(list_func, on_event, poll_func, on_poll, deadline, progress=True, **kwargs):
+    try:
+        result = _watch_until(list_func, on_event, deadline, progress, **kwargs)
+    except Exception:
+        # Watch can be cut by proxies or not permitted, fall back to polling
+        result = _poll_until(poll_func, on_poll, deadline, progress)
+
+    if progress:
+        print()
+
+    if result is None:
+        raise WaitTimeoutError("Waiting time exceeded")
+
+    return result
+
+
+def _wait_for_object(list_func, read_func, check, name, namespace, deadline, progress=True):
+    def on_event(event_type, obj):
+        if event_type != 'DELETED':
+            return check(obj)
+
+    return _wait_until(list_func, on_event,
+                       lambda: read_func(name=name, namespace=namespace), check,
+                       deadline, progress, namespace=namespace,
+                       field_selector='metadata.name={}'.format(name))
+
+
+def _service_address(service):
+    ingress = service.status.load_balancer.ingress
+    if ingress:
+        return ingress[0].ip or ingress[0].hostname
+
+
+def _wait_for_service_access(name, api, namespace, deadline, progress=True):
+    return _wait_for_object(api.list_namespaced_service, api.read_namespaced_service_status,
+                            _service_address, name, namespace, deadline, progress)
+
+
+def _wait_for_rollout(name, api, namespace, deadline, progress=True):
+    def check(deployment):
+        replicas = deployment.spec.replicas
+        status = deployment.status
+        if (status.observed_generation or 0) < deployment.metadata.generation:
+            return None
+        if (status.updated_replicas or 0) >= replicas \
+                and (status.available_replicas or 0) >= replicas:
+            return True
+
+    return _wait_for_object(api.list_namespaced_deployment,
+                            api.read_namespaced_deployment_status,
+                            check, name, namespace, deadline, progress)
+
+
+def _wait_for_gone(list_func, namespace, deadline, progress=True, **selector):
+    current = list_func(namespace=namespace, **selector)
+    remaining = set(item.metadata.name for item in current.items)
+    if not remaining:
+        return True
+
+    def on_event(event_type, obj):
+        if event_type == 'DELETED':
+            remaining.discard(obj.metadata.name)
+        return True if not remaining else None
+
+    def on_poll(obj_list):
+        return True if not obj_list.items else None
+
+    return _wait_until(list_func, on_event, lambda: list_func(namespace=namespace, **selector),
+                       on_poll, deadline, progress, namespace=namespace,
+                       resource_version=current.metadata.resource_version, **selector)
+
+
+def _is_pod_ready(pod):
+    if not pod.status.conditions or pod.metadata.deletion_timestamp:
+        return False
+    return any(c.type == 'Ready' and c.status == 'True' for c in pod.status.conditions)
+
+
+def _wait_for_pods_ready(name, replicas, api, namespace, deadline, progress=True):
+    label_selector = 'name={}'.format(name)
+    pods = {}
+
+    def on_event(event_type, pod):
+        if event_type == 'DELETED':
+            pods.pop(pod.metadata.name, None)
+        else:
+            pods[pod.metadata.name] = _is_pod_ready(pod)
+        return True if sum(pods.values()) >= replicas else None
+
+    def on_poll(pod_list):
+        ready = sum(1 for pod in pod_list.items if _is_pod_ready(pod))
+        return True if ready >= replicas else None
+
+    return _wait_until(api.list_namespaced_pod, on_event,
+                       lambda: api.list_namespaced_pod(namespace=namespace,
+                                                       label_selector=label_selector),
+                       on_poll, deadline, progress, namespace=namespace,
+                       label_selector=label_selector)
+
+
+def _check_secret_size(size, source):
+    if size > SECRET_MAX_SIZE:
+        raise ConfigError("Config {} is {} bytes, k8s secrets are limited to {} bytes".format(
+            source, size, SECRET_MAX_SIZE))
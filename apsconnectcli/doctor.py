@@ -0,0 +1,114 @@
+from __future__ import print_function
+
+import ssl
+import sys
+import time
+import socket
+from collections import namedtuple
+
+from apsconnectcli.lazy import LazyModule
+from apsconnectcli.probe import format_ms, percentile
+from apsconnectcli.status import DEFAULT_PORTS
+
+if sys.version_info >= (3,):
+    from urllib.parse import urlparse
+else:
+    from urlparse import urlparse
+
+DOCTOR_SAMPLES = 3
+# Installs make dozens of sequential calls, slower ones add up to minutes
+DOCTOR_WARN_LATENCY = 0.3
+CONNECT_TIMEOUT = 10
+
+futures = LazyModule('concurrent.futures')
+
+Check = namedtuple('Check', ('name', 'url', 'dns', 'connect', 'tls', 'first_call', 'call',
+                             'error'))
+
+
+def diagnose(cluster=None, hubs=(), samples=DOCTOR_SAMPLES):
+    """ Latency of the k8s API and the RPC, token and APS calls of the named hubs, all measured
+    concurrently. DNS lookup, TCP connect and TLS handshake of a new connection to every
+    endpoint are timed apart from the calls, the first call includes the connection setup of
+    the client, the next ones reuse it. Returns Check per endpoint, with the error if failed"""
+    checks = []
+    if cluster is not None:
+        checks.append(('k8s API', cluster.host, cluster.get_version, None))
+    for name, hub in hubs:
+        prefix = 'hub {} '.format(name) if name else 'hub '
+        checks.append((prefix + 'RPC', hub.rpc_url, hub.get_version, None))
+        checks.append((prefix + 'token', hub.rpc_url,
+                       lambda hub=hub: hub.get_token(refresh=True), None))
+        # Token is fetched before, so APS calls are measured alone
+        checks.append((prefix + 'APS', hub.aps_url, hub.list_applications, hub.get_token))
+
+    if not checks:
+        return []
+    with futures.ThreadPoolExecutor(max_workers=len(checks)) as executor:
+        jobs = [executor.submit(_check, name, url, call, samples, prepare)
+                for name, url, call, prepare in checks]
+    return [job.result() for job in jobs]
+
+
+def measure_connection(url, timeout=CONNECT_TIMEOUT):
+    """ Seconds of DNS lookup, TCP connect and TLS handshake of a new connection to the URL
+    host, TLS is None for http"""
+    parsed = urlparse(url)
+    port = parsed.port or DEFAULT_PORTS[parsed.scheme]
+
+    started = time.time()
+    family, socktype, proto, _, address = socket.getaddrinfo(parsed.hostname, port, 0,
+                                                             socket.SOCK_STREAM)[0]
+    resolved = time.time()
+    sock = socket.socket(family, socktype, proto)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+        connected = time.time()
+        tls = None
+        if parsed.scheme == 'https':
+            # Only the handshake is measured, the clients verify the certificates themselves
+            context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS', ssl.PROTOCOL_SSLv23))
+            context.verify_mode = ssl.CERT_NONE
+            sock = context.wrap_socket(sock, server_hostname=parsed.hostname)
+            tls = time.time() - connected
+    finally:
+        sock.close()
+
+    return resolved - started, connected - resolved, tls
+
+
+def latency_warnings(checks, warn_latency=DOCTOR_WARN_LATENCY):
+    """ Warnings of the hops slow enough to slow down the installs"""
+    warnings = []
+    for c in checks:
+        if c.error:
+            continue
+        for value, what, impact in (
+                (c.dns, 'DNS lookup', "every new connection waits for it"),
+                (c.connect, 'TCP connect', "every new connection waits for it"),
+                (c.tls, 'TLS handshake', "every new connection waits for it"),
+                (c.call, 'call', "installs making many calls will be slow")):
+            if value is not None and value > warn_latency:
+                warnings.append("{} {} takes {}, {}".format(c.name, what, format_ms(value),
+                                                            impact))
+    return warnings
+
+
+def _check(name, url, call, samples, prepare=None):
+    dns = connect = tls = first_call = median_call = None
+    try:
+        dns, connect, tls = measure_connection(url)
+        if prepare:
+            prepare()
+        times = []
+        for _ in range(max(samples, 1)):
+            started = time.time()
+            call()
+            times.append(time.time() - started)
+        first_call, median_call = times[0], percentile(times[1:], 50)
+    except Exception as e:
+        return Check(name, url, dns, connect, tls, first_call, median_call,
+                     ' '.join(str(e).splitlines()) or type(e).__name__)
+
+    return Check(name, url, dns, connect, tls, first_call, median_call, None)
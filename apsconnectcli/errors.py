@@ -0,0 +1,33 @@
+class APSConnectError(Exception):
+    """ Base of the errors raised by apsconnectcli operations"""
+
+
+class ConfigError(APSConnectError):
+    """ Missing or invalid configuration, manifest, overrides or settings"""
+
+
+class ClusterError(APSConnectError):
+    """ k8s cluster is unreachable or rejected the request"""
+
+
+class WaitTimeoutError(ClusterError):
+    """ Cluster objects did not reach the expected state in time"""
+
+
+class HubError(APSConnectError):
+    """ Hub is unreachable or rejected the request"""
+
+
+class CircuitOpenError(APSConnectError):
+    """ Calls to the host are stopped after repeated transient failures"""
+
+
+class PackageError(APSConnectError):
+    """ Connector package can't be downloaded or read"""
+
+
+def wrap_error(error, message, default=APSConnectError):
+    """ Error with the message formatted with the original error, of the same type if it is
+    already an APSConnectError"""
+    cls = type(error) if isinstance(error, APSConnectError) else default
+    return cls(message.format(error))
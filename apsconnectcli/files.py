@@ -0,0 +1,37 @@
+from __future__ import print_function
+
+import os
+import json
+import tempfile
+
+replace = getattr(os, 'replace', os.rename)
+
+
+def write_atomic(path, text, mode=None):
+    """ Write the text to a temporary file next to path and rename it over path, so readers
+    see either the old or the new content, never half of it. The directory is created if
+    missing, mode sets the permissions of the file instead of the private ones of mkstemp"""
+    directory = os.path.dirname(path) or '.'
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by a concurrent writer meanwhile
+            if not os.path.isdir(directory):
+                raise
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_json(path, data, indent=None):
+    write_atomic(path, json.dumps(data, indent=indent))
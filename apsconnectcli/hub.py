@@ -0,0 +1,497 @@
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import base64
+import threading
+from collections import namedtuple
+from xml.etree import ElementTree as xml_et
+
+from apsconnectcli import files
+from apsconnectcli import retry
+from apsconnectcli import metrics
+from apsconnectcli import tracing
+from apsconnectcli.lazy import LazyModule
+from apsconnectcli.journal import Journal, JOURNAL_DIR_PATH
+from apsconnectcli.errors import APSConnectError, ConfigError, HubError
+
+CFG_FILE_PATH = os.path.expanduser('~/.aps_config')
+DEFAULT_HUB_PROFILE = 'default'
+# Section of the config file with the retry settings, not a hub config
+RETRY_CONFIG_KEY = 'retry'
+TOKEN_CACHE_PATH = os.path.expanduser('~/.aps_token')
+TOKEN_TTL = 10 * 60
+RPC_CONNECT_PARAMS = ('host', 'user', 'password', 'ssl', 'port')
+APS_CONNECT_PARAMS = ('aps_host', 'aps_port', 'use_tls_aps')
+UPLOAD_CHUNK_SIZE = 3 * 64 * 1024
+HUB_WORKERS = 4
+
+osaapi = LazyModule('osaapi')
+requests = LazyModule('requests')
+xmlrpclib = LazyModule('xmlrpc.client' if sys.version_info >= (3,) else 'xmlrpclib')
+futures = LazyModule('concurrent.futures')
+
+# Sessions of several hubs save their tokens to the same file
+_token_cache_lock = threading.Lock()
+
+FrontendResult = namedtuple('FrontendResult', ('connector_id', 'version', 'release',
+                                               'application_id', 'imported', 'instance',
+                                               'elapsed'))
+
+
+class HubClient(object):
+    """ Connection to the hub API, XML-RPC and APS REST calls share one keep-alive HTTP
+    connection pool and the APS token is reused until it expires or is rejected.
+
+    Independent calls can be run concurrently with submit(), it returns a
+    concurrent.futures.Future which asyncio code can await with asyncio.wrap_future()"""
+
+    def __init__(self, cfg, token_cache_path=None):
+        self.cfg = cfg
+        self.rpc_url = get_rpc_url(cfg['host'], cfg['port'], cfg['ssl'])
+        self.aps_url = get_aps_url(**{k: cfg[k] for k in APS_CONNECT_PARAMS})
+        self.session = requests.Session()
+        self.session.verify = False
+        self.session.hooks['response'].append(tracing.requests_hook_for('hub'))
+        retry.retry_session(self.session)
+
+        self._rpc_auth = (cfg['user'], cfg['password'])
+        self.rpc = osaapi.OSA(**{k: cfg[k] for k in RPC_CONNECT_PARAMS})
+        self.rpc.__server__ = xmlrpclib.ServerProxy(
+            self.rpc_url, transport=_SessionTransport(self.session, self.rpc_url, self._rpc_auth))
+
+        self._token_cache_path = token_cache_path
+        self._token_key = '{}@{}:{}'.format(cfg['user'], cfg['host'], cfg['port'])
+        self._token = None
+        self._token_expires = 0
+        self._token_lock = threading.Lock()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, func, *args, **kwargs):
+        """ Run func(*args, **kwargs) in the session thread pool, returns a Future"""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = futures.ThreadPoolExecutor(max_workers=HUB_WORKERS)
+            return self._executor.submit(func, *args, **kwargs)
+
+    def prefetch_token(self):
+        """ Start fetching the APS token in background, so it is ready for the APS calls.
+        Errors are raised by the APS call which needs the token"""
+        return self.submit(self.get_token)
+
+    def aps_request_async(self, method, path, **kwargs):
+        return self.submit(self.aps_request, method, path, **kwargs)
+
+    def call_rpc_body_async(self, body):
+        return self.submit(self.call_rpc_body, body)
+
+    @classmethod
+    def from_config(cls, cfg):
+        """ Client of the hub config as saved by init-hub, the APS token is kept on disk if
+        the config has cache_token"""
+        return cls(cfg, token_cache_path=TOKEN_CACHE_PATH if cfg.get('cache_token') else None)
+
+    @classmethod
+    def from_profile(cls, profile=None, cfg_path=None):
+        """ Client of the hub saved by init-hub, the default or named profile"""
+        return cls.from_config(load_hub_config(profile, cfg_path))
+
+    def get_version(self):
+        """ Hub version, checks the XML-RPC API connectivity"""
+        try:
+            r = self.rpc.statistics.getStatisticsReport(reports=[{'name': 'report-for-cep',
+                                                                  'value': ''}])
+            osaapi_raise_for_status(r)
+            tree = xml_et.fromstring(r['result'][0]['value'])
+            return tree.find('ClientVersion').text
+        except APSConnectError:
+            raise
+        except Exception as e:
+            raise HubError("Unable to get hub version, error: {}".format(e))
+
+    def list_applications(self):
+        """ Applications imported to the hub, checks the APS API connectivity"""
+        try:
+            r = self.aps_request('GET', 'aps/2/applications/')
+            r.raise_for_status()
+            return r.json()
+        except APSConnectError:
+            raise
+        except Exception as e:
+            raise HubError("Unable to list applications, error: {}".format(e))
+
+    def list_instances(self, application_id):
+        """ Instances of the imported application"""
+        try:
+            r = self.aps_request('GET', 'aps/2/applications/{}/instances/'.format(application_id))
+            r.raise_for_status()
+            return r.json()
+        except APSConnectError:
+            raise
+        except Exception as e:
+            raise HubError("Unable to list instances of {}, error: {}".format(application_id, e))
+
+    def find_application(self, connector_id, version, release):
+        """ APS id of the application imported from the package of the same version, if any"""
+        for application in self.list_applications():
+            if application.get('id') == connector_id \
+                    and str(application.get('version')) == version \
+                    and str(application.get('release')) == release:
+                return application['aps']['id']
+
+        return None
+
+    def import_package(self, package):
+        """ Import the package, http(s) packages are imported by URL, local ones are
+        streamed from the file. Returns id of the imported application"""
+        if package.is_http_source:
+            r = self.rpc.APS.importPackage(package_url=package.source)
+        else:
+            # Sent as xmlrpclib would do it but without loading the whole package into memory
+            r = self.call_rpc_body(XmlRpcBinaryBody('pem.APS.importPackage', 'package_body',
+                                                    package.path))
+        osaapi_raise_for_status(r)
+        return r['result']['application_id']
+
+    def create_instance(self, payload):
+        """ Create the application instance, returns it"""
+        r = self.aps_request('POST', 'aps/2/applications/', json=payload)
+        try:
+            r.raise_for_status()
+        except Exception as e:
+            try:
+                response = r.json()
+            except ValueError:
+                response = {}
+            if 'error' in response:
+                err = "{} {}".format(response['error'], response.get('message'))
+            else:
+                err = str(e)
+            raise HubError("Installation of connector {} FAILED.\n"
+                           "Hub APS API response {} code.\n"
+                           "Error: {}".format(payload['aps']['package']['type'], r.status_code,
+                                              err))
+        return r.json()
+
+    def set_devel_mode(self, enabled=True):
+        r = self.rpc.setSystemProperty(account_id=1, name='APS_DEVEL_MODE',
+                                       bool_value=bool(enabled))
+        osaapi_raise_for_status(r)
+
+    def close(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+        self.session.close()
+
+    def get_token(self, refresh=False):
+        with self._token_lock:
+            now = time.time()
+            if not refresh and not self._token and self._token_cache_path:
+                self._token, self._token_expires = _load_cached_token(self._token_cache_path,
+                                                                      self._token_key)
+            if refresh or not self._token or self._token_expires <= now:
+                # TODO user -> user_id
+                with tracing.span('token fetch'):
+                    r = self.rpc.APS.getUserToken(user_id=1)
+                osaapi_raise_for_status(r)
+                self._token, self._token_expires = r['result']['aps_token'], now + TOKEN_TTL
+                if self._token_cache_path:
+                    _save_cached_token(self._token_cache_path, self._token_key, self._token,
+                                       self._token_expires)
+            return self._token
+
+    def aps_headers(self, refresh=False):
+        return {'APS-Token': self.get_token(refresh)}
+
+    def aps_request(self, method, path, **kwargs):
+        """ APS REST API request, the token is refreshed once if the hub rejects it"""
+        url = '{}/{}'.format(self.aps_url, path)
+        r = self.session.request(method, url, headers=self.aps_headers(), **kwargs)
+        if r.status_code == 401:
+            r = self.session.request(method, url, headers=self.aps_headers(refresh=True),
+                                     **kwargs)
+        return r
+
+    def call_rpc_body(self, body):
+        """ Send prepared XML-RPC request body, returns the decoded result"""
+        r = self.session.post(self.rpc_url, data=body, auth=self._rpc_auth,
+                              headers={'Content-Type': 'text/xml'})
+        r.raise_for_status()
+        return xmlrpclib.loads(r.content)[0][0]
+
+
+@metrics.measured('install_frontend')
+def install_frontend(hub, package, oauth_key, oauth_secret, backend_url, settings=None,
+                     network='public', skip_imported=False, log=None, journal=None):
+    """ Import the package unless it is already imported with skip_imported and create the
+    application instance with the backend URL, returns FrontendResult. Import and instance
+    are recorded in the journal, the resumed journal skips them if they still exist"""
+    check_backend_url(backend_url)
+    log = log or _no_log
+    started = time.time()
+    meta = package.meta
+    connector_id, version, release = meta['id'], meta['version'], meta['release']
+    resume = journal is not None and journal.resumed
+
+    # Token is not needed for the import, it is fetched while the package is uploaded
+    hub.prefetch_token()
+
+    try:
+        application_id, imported, instance = None, False, None
+        if resume and journal.done('import'):
+            recorded = journal.get('import', 'application_id')
+            with tracing.span('application lookup'):
+                if any(a['aps']['id'] == recorded for a in hub.list_applications()):
+                    application_id = recorded
+                    log("Connector {} {}-{} import done before with id={} [skip]"
+                        .format(connector_id, version, release, application_id))
+
+        if not application_id and skip_imported:
+            with tracing.span('application lookup'):
+                application_id = hub.find_application(connector_id, version, release)
+            if application_id:
+                log("Connector {} {}-{} is already imported with id={}, skip import"
+                    .format(connector_id, version, release, application_id))
+
+        if not application_id:
+            log("Importing connector {} {}-{}".format(connector_id, version, release))
+            with tracing.span('importPackage'):
+                application_id = hub.import_package(package)
+            imported = True
+            log("Connector {} imported with id={}".format(connector_id, application_id))
+        if journal is not None:
+            journal.record('import', application_id=application_id)
+
+        if resume and journal.done('instance'):
+            recorded = journal.get('instance', 'instance_id')
+            instance = next((i for i in hub.list_instances(application_id)
+                             if i.get('aps', {}).get('id') == recorded), None)
+            if instance:
+                log("Connector {} instance done before with id={} [skip]".format(connector_id,
+                                                                                 recorded))
+
+        if instance is None:
+            with tracing.span('APS POST'):
+                instance = hub.create_instance(frontend_payload(meta, oauth_key, oauth_secret,
+                                                                backend_url, settings, network))
+            if journal is not None:
+                journal.record('instance', instance_id=instance.get('aps', {}).get('id'))
+    except APSConnectError:
+        raise
+    except Exception as e:
+        raise HubError("Installation of connector {} FAILED, error: {}".format(connector_id, e))
+
+    if journal is not None:
+        journal.complete()
+
+    return FrontendResult(connector_id, version, release, application_id, imported, instance,
+                          time.time() - started)
+
+
+def frontend_journal(hub, package, params=None, resume=False, journal_dir=JOURNAL_DIR_PATH):
+    """ Journal of the package install to the hub, bound to the instance params"""
+    meta = package.meta
+    target = '{}/{} {}-{}'.format(hub.aps_url.rstrip('/'), meta['id'].split('/')[-1],
+                                  meta['version'], meta['release'])
+    return Journal.open('frontend', target, dict(params or {}, connector_id=meta['id']), resume,
+                        journal_dir)
+
+
+def frontend_payload(meta, oauth_key, oauth_secret, backend_url, settings=None,
+                     network='public'):
+    payload = {
+        "aps": {
+            "package": {
+                "type": meta['id'],
+                "version": meta['version'],
+                "release": meta['release'],
+            },
+            "endpoint": backend_url,
+            "network": network,
+            "auth": {
+                "oauth": {
+                    "key": oauth_key,
+                    "secret": oauth_secret,
+                }
+            }
+        }
+    }
+
+    payload.update(settings or {})
+    return payload
+
+
+def check_backend_url(backend_url):
+    if not backend_url.startswith('http://') and not backend_url.startswith('https://'):
+        raise ConfigError("Backend url must be URL http(s)://, got {}".format(backend_url))
+
+
+def load_hub_config(profile=None, cfg_path=None):
+    """ Hub config saved by init-hub, the default or named profile"""
+    try:
+        with tracing.span('config load'):
+            with open(cfg_path or CFG_FILE_PATH) as fd:
+                cfg = json.load(fd)
+    except (IOError, OSError, ValueError):
+        cfg = {}
+
+    if profile and profile != DEFAULT_HUB_PROFILE:
+        cfg = cfg.get('profiles', {}).get(profile)
+    elif cfg:
+        cfg = {k: v for k, v in cfg.items() if k not in ('profiles', RETRY_CONFIG_KEY)}
+    if not cfg or 'host' not in cfg:
+        raise ConfigError("Run init command{}.".format(' with --profile {}'.format(profile)
+                                                       if profile else ''))
+    return cfg
+
+
+def hub_profiles(hubs, cfg_path=None):
+    """ Named configs of the hub profiles, comma separated string, list or all"""
+    if isinstance(hubs, (list, tuple)):
+        names = [str(name) for name in hubs]
+    else:
+        names = [name.strip() for name in str(hubs).split(',') if name.strip()]
+
+    if names == ['all']:
+        try:
+            with open(cfg_path or CFG_FILE_PATH) as fd:
+                cfg = json.load(fd)
+        except (IOError, OSError, ValueError):
+            cfg = {}
+        names = ([DEFAULT_HUB_PROFILE] if 'host' in cfg else []) + \
+            sorted(cfg.get('profiles', {}))
+
+    return [(name, load_hub_config(name, cfg_path)) for name in names]
+
+
+class XmlRpcBinaryBody(object):
+    """ File-like XML-RPC request body passing the file as a single base64 struct member,
+    the file is read and encoded chunk by chunk while the request is sent"""
+
+    def __init__(self, method, param, path, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.method = method
+        self._head = ("<?xml version='1.0'?>\n<methodCall>\n<methodName>{}</methodName>\n"
+                      "<params>\n<param>\n<value><struct>\n<member>\n<name>{}</name>\n"
+                      "<value><base64>\n").format(method, param).encode()
+        self._tail = ("\n</base64></value>\n</member>\n</struct></value>\n</param>\n"
+                      "</params>\n</methodCall>\n").encode()
+        size = os.path.getsize(path)
+        self._length = len(self._head) + 4 * ((size + 2) // 3) + len(self._tail)
+        self._path = path
+        # Chunks of 3 bytes multiple are encoded without padding, so they can be concatenated
+        self._chunk_size = chunk_size - chunk_size % 3
+        self.rewind()
+
+    def __len__(self):
+        return self._length
+
+    def rewind(self):
+        """ Start over, so the request can be sent again"""
+        self._chunks = self._iter_chunks(self._path, self._chunk_size)
+        self._buffer = b''
+        self._offset = 0
+
+    def _iter_chunks(self, path, chunk_size):
+        yield self._head
+        with open(path, 'rb') as fd:
+            for data in iter(lambda: fd.read(chunk_size), b''):
+                yield base64.b64encode(data)
+        yield self._tail
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._buffer[self._offset:] + b''.join(self._chunks)
+            self._buffer, self._offset = b'', 0
+            return data
+
+        if self._offset >= len(self._buffer):
+            self._buffer, self._offset = next(self._chunks, b''), 0
+
+        data = self._buffer[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+
+class _SessionTransport(object):
+    """ XML-RPC transport for ServerProxy sending requests through the shared requests
+    session"""
+
+    def __init__(self, session, url, auth):
+        self._session = session
+        self._url = url
+        self._auth = auth
+
+    def request(self, host, handler, request_body, verbose=False):
+        r = self._session.post(self._url, data=request_body, auth=self._auth,
+                               headers={'Content-Type': 'text/xml'})
+        if r.status_code != 200:
+            raise xmlrpclib.ProtocolError(host + handler, r.status_code, r.reason, r.headers)
+
+        parser, unmarshaller = xmlrpclib.getparser()
+        parser.feed(r.content)
+        parser.close()
+        return unmarshaller.close()
+
+    def close(self):
+        pass
+
+
+def get_aps_url(aps_host, aps_port, use_tls_aps):
+    return '{}://{}:{}'.format('https' if use_tls_aps else 'http', aps_host, aps_port)
+
+
+def get_rpc_url(host, port, ssl):
+    return '{}://{}:{}/RPC2'.format('https' if ssl else 'http', host, port)
+
+
+def osaapi_raise_for_status(r):
+    if r['status']:
+        if 'error_message' in r:
+            raise HubError("Error: {}".format(r['error_message']))
+        else:
+            raise HubError("Error: Unknown {}".format(r))
+
+
+def _no_log(message):
+    pass
+
+
+def _load_cached_token(path, key):
+    try:
+        with open(path) as fd:
+            entry = json.load(fd).get(key)
+    except (IOError, OSError, ValueError):
+        entry = None
+
+    if entry and entry['expires'] > time.time():
+        return entry['token'], entry['expires']
+    return None, 0
+
+
+def _save_cached_token(path, key, token, expires):
+    with _token_cache_lock:
+        try:
+            with open(path) as fd:
+                tokens = json.load(fd)
+        except (IOError, OSError, ValueError):
+            tokens = {}
+
+        now = time.time()
+        tokens = {k: v for k, v in tokens.items() if v['expires'] > now}
+        tokens[key] = {'token': token, 'expires': expires}
+
+        # Token grants access to the hub, keep it readable by the owner only. The file is
+        # shared by concurrent runs, it is replaced at once, so none of them reads it half
+        # written
+        files.write_atomic(path, json.dumps(tokens), mode=0o600)
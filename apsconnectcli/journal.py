@@ -0,0 +1,73 @@
+from __future__ import print_function
+
+import os
+import re
+import json
+import time
+import hashlib
+
+from apsconnectcli import files
+
+JOURNAL_DIR_PATH = os.path.expanduser('~/.aps_journal')
+
+
+class Journal(object):
+    """ Completed steps of one install kept in a local file, so the install failed halfway can
+    be resumed from the first step not done. The journal is bound to the install target and
+    parameters, it is not resumed if any of them changed"""
+
+    def __init__(self, path, target, params_hash):
+        self.path = path
+        self.target = target
+        self.params_hash = params_hash
+        self.steps = {}
+        self.resumed = False
+
+    @classmethod
+    def open(cls, kind, target, params, resume=False, journal_dir=JOURNAL_DIR_PATH):
+        """ Journal of the kind install to the target, with resume the steps recorded by the
+        previous run of the same install are loaded"""
+        digest = hashlib.sha256(target.encode('utf-8')).hexdigest()[:12]
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', target.split('/')[-1])[:64]
+        path = os.path.join(journal_dir, '{}-{}-{}.json'.format(kind, name, digest))
+        journal = cls(path, target, _params_hash(params))
+
+        if resume:
+            try:
+                with open(path) as fd:
+                    saved = json.load(fd)
+            except (IOError, OSError, ValueError):
+                saved = {}
+            if saved.get('target') == target and saved.get('params') == journal.params_hash:
+                journal.steps = saved.get('steps', {})
+                journal.resumed = bool(journal.steps)
+
+        return journal
+
+    def done(self, step):
+        return step in self.steps
+
+    def get(self, step, key=None):
+        data = self.steps.get(step) or {}
+        return data.get(key) if key else data
+
+    def record(self, step, **data):
+        """ Mark the step done, the journal is saved right away to survive the failure of the
+        next step"""
+        self.steps[step] = dict(data, time=time.time())
+        self.save()
+
+    def save(self):
+        files.write_json(self.path, {'target': self.target, 'params': self.params_hash,
+                                     'steps': self.steps}, indent=4)
+
+    def complete(self):
+        """ Install is done, nothing to resume"""
+        self.steps = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _params_hash(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str)
+                          .encode('utf-8')).hexdigest()
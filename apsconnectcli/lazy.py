@@ -0,0 +1,15 @@
+import importlib
+
+
+class LazyModule(object):
+    """ Module proxy importing the module on the first attribute access, so heavy dependencies
+    are loaded only by the commands using them"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
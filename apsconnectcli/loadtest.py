@@ -0,0 +1,178 @@
+from __future__ import print_function
+
+import time
+import threading
+from collections import Counter, namedtuple
+
+from apsconnectcli.lazy import LazyModule
+from apsconnectcli.errors import ConfigError
+from apsconnectcli.probe import PERCENTILES, format_ms, percentile
+
+LOADTEST_RPS = 20
+LOADTEST_DURATION = 10
+LOADTEST_PROFILE = '{}:{}'.format(LOADTEST_RPS, LOADTEST_DURATION)
+LOADTEST_CONCURRENCY = 8
+LOADTEST_TIMEOUT = 5
+LOADTEST_MAX_ERROR_RATE = 0.01
+# Settings of the load test gate checked against the result, the others drive the load
+LOADTEST_THRESHOLDS = ('max_p99', 'max_error_rate', 'min_rps')
+
+requests = LazyModule('requests')
+futures = LazyModule('concurrent.futures')
+
+
+class LoadResult(namedtuple('LoadResult', ('urls', 'requests', 'errors', 'elapsed',
+                                           'latencies', 'outcomes'))):
+    """ Requests sent, failed ones, seconds from the first request to the last response,
+    sorted latencies and the count of responses by status code or error name"""
+    __slots__ = ()
+
+    @property
+    def throughput(self):
+        return self.requests / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def error_rate(self):
+        return float(self.errors) / self.requests if self.requests else 0.0
+
+    def percentile(self, percent):
+        return percentile(self.latencies, percent)
+
+
+def parse_profile(profile):
+    """ Load stages of the profile, comma separated RPS:SECONDS string or list of them, RPS
+    alone runs for the default duration, 0 RPS sends as fast as the concurrency allows"""
+    if isinstance(profile, (int, float)):
+        profile = [profile]
+    elif not isinstance(profile, (list, tuple)):
+        profile = str(profile).split(',')
+
+    stages = []
+    for stage in profile:
+        rps, _, seconds = str(stage).strip().partition(':')
+        try:
+            rps, seconds = float(rps), float(seconds or LOADTEST_DURATION)
+        except ValueError:
+            rps = seconds = -1
+        if rps < 0 or seconds <= 0:
+            raise ConfigError("Load profile stage must be RPS:SECONDS, got {}".format(stage))
+        stages.append((rps, seconds))
+    if not stages:
+        raise ConfigError("Load profile has no stages")
+    return stages
+
+
+def run_load(urls, stages=((LOADTEST_RPS, LOADTEST_DURATION),),
+             concurrency=LOADTEST_CONCURRENCY, timeout=LOADTEST_TIMEOUT):
+    """ Send GET requests to the urls in turn from concurrency workers sharing a connection
+    pool, at the rate of every (rps, seconds) stage. Requests are scheduled ahead, latency
+    is counted from the scheduled time, so a backend falling behind shows up as latency
+    instead of a lower request rate. Returns LoadResult"""
+    concurrency = max(int(concurrency), 1)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=len(urls), pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    schedule = _Schedule(stages)
+    latencies, outcomes = [], Counter()
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            slot = schedule.next()
+            if slot is None:
+                return
+            index, at = slot
+            if at > time.time():
+                time.sleep(at - time.time())
+
+            try:
+                r = session.get(urls[index % len(urls)], timeout=timeout)
+                # Body is read, so the connection goes back to the pool
+                r.content
+                outcome = str(r.status_code)
+            except requests.RequestException as e:
+                outcome = type(e).__name__
+            latency = time.time() - at
+
+            with lock:
+                latencies.append(latency)
+                outcomes[outcome] += 1
+
+    started = time.time()
+    schedule.start(started)
+    try:
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for job in [executor.submit(worker) for _ in range(concurrency)]:
+                job.result()
+    finally:
+        session.close()
+    elapsed = time.time() - started
+
+    errors = sum(n for outcome, n in outcomes.items()
+                 if not outcome.isdigit() or int(outcome) >= 400)
+    return LoadResult(list(urls), len(latencies), errors, elapsed, sorted(latencies),
+                      dict(outcomes))
+
+
+def check_thresholds(result, max_p99=None, max_error_rate=None, min_rps=None):
+    """ Messages of the thresholds the result misses, max_p99 in seconds"""
+    failures = []
+    p99 = result.percentile(99)
+    if max_p99 is not None and p99 is not None and p99 > float(max_p99):
+        failures.append("p99 latency {} exceeds {}".format(format_ms(p99),
+                                                           format_ms(float(max_p99))))
+    if max_error_rate is not None and result.error_rate > float(max_error_rate):
+        failures.append("error rate {:.1%} exceeds {:.1%}".format(result.error_rate,
+                                                                  float(max_error_rate)))
+    if min_rps is not None and result.throughput < float(min_rps):
+        failures.append("throughput {:.1f} req/s is below {:g} req/s".format(
+            result.throughput, float(min_rps)))
+    if not result.requests:
+        failures.append("no requests were sent")
+    return failures
+
+
+def format_result(result):
+    """ Report lines of the result"""
+    return [
+        "{} - {} requests in {:.1f}s, {:.1f} req/s, {} errors ({:.1%})".format(
+            ', '.join(result.urls), result.requests, result.elapsed, result.throughput,
+            result.errors, result.error_rate),
+        "Latency {}".format(' '.join('p{} {}'.format(p, format_ms(result.percentile(p)))
+                                     for p in PERCENTILES)),
+        "Responses {}".format(', '.join('{} x{}'.format(outcome, n) for outcome, n
+                                        in sorted(result.outcomes.items())) or '-'),
+    ]
+
+
+class _Schedule(object):
+    """ Send times of the requests by stages, evenly spaced at the stage rate, as soon as a
+    worker is free for 0 rate"""
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self._lock = threading.Lock()
+        self._stage = 0
+        self._stage_started = None
+        self._sent = 0
+        self._index = 0
+
+    def start(self, now):
+        self._stage_started = now
+
+    def next(self):
+        """ (index, send time) of the next request, None after the last stage"""
+        with self._lock:
+            while self._stage < len(self.stages):
+                rps, seconds = self.stages[self._stage]
+                stage_end = self._stage_started + seconds
+                at = self._stage_started + self._sent / rps if rps else time.time()
+                if at < stage_end:
+                    self._sent += 1
+                    self._index += 1
+                    return self._index - 1, at
+                self._stage += 1
+                self._stage_started, self._sent = stage_end, 0
+            return None
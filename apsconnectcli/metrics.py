@@ -0,0 +1,197 @@
+from __future__ import print_function
+
+import os
+import json
+import time
+import functools
+import threading
+
+from apsconnectcli import files
+from apsconnectcli.errors import ConfigError
+
+METRICS_FORMATS = ('prometheus', 'json')
+# Seconds, from a single API call up to a slow rollout
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                    120.0, 300.0)
+METRICS = {
+    'apsconnect_api_requests_total': (
+        'counter', "API requests by service, endpoint and response status"),
+    'apsconnect_api_request_duration_seconds': (
+        'histogram', "API request duration by service and endpoint"),
+    'apsconnect_api_retries_total': (
+        'counter', "API calls retried after a transient failure by host and reason"),
+    'apsconnect_api_bytes_sent_total': ('counter', "Request bytes sent by service"),
+    'apsconnect_api_bytes_received_total': ('counter', "Response bytes received by service"),
+    'apsconnect_phase_duration_seconds': (
+        'histogram', "Duration of the command phases, e.g. service exposure wait"),
+    'apsconnect_operation_duration_seconds': (
+        'histogram', "Duration of install and uninstall operations by result"),
+    'apsconnect_run_timestamp_seconds': ('gauge', "Start time of the command run"),
+    'apsconnect_run_duration_seconds': ('gauge', "Duration of the command run"),
+    'apsconnect_run_exit_code': ('gauge', "Exit code of the command run"),
+}
+
+
+class Registry(object):
+    """ Counters, histograms and gauges of the process by name and labels, shared by all
+    threads. Recording does nothing until a metrics file is configured"""
+
+    def __init__(self):
+        self.enabled = False
+        self.metrics_file = None
+        self.metrics_format = None
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def configure(self, metrics_file=None, metrics_format=None):
+        """ Collect the metrics to write to metrics_file, in prometheus textfile format or
+        as JSON lines, by default by the file extension"""
+        if metrics_format is None and metrics_file:
+            metrics_format = 'json' if metrics_file.endswith(('.json', '.jsonl')) else 'prometheus'
+        if metrics_format is not None and metrics_format not in METRICS_FORMATS:
+            raise ConfigError("Metrics format must be one of {}, got {}".format(
+                ', '.join(METRICS_FORMATS), metrics_format))
+        self.metrics_file = metrics_file
+        self.metrics_format = metrics_format
+        self.enabled = bool(metrics_file)
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._values[(name, _labels_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = {'buckets': [0] * len(DURATION_BUCKETS),
+                                                 'count': 0, 'sum': 0.0}
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+    def samples(self):
+        """ (name, labels, value) sorted by name and labels, histogram value is a mapping of
+        buckets, count and sum"""
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(name, dict(labels), value) for (name, labels), value in items]
+
+    def prometheus_text(self):
+        """ Metrics in Prometheus text exposition format"""
+        lines, described = [], set()
+        for name, labels, value in self.samples():
+            kind, description = METRICS.get(name, ('untyped', name))
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} {}'.format(name, kind))
+            if kind != 'histogram':
+                lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+                continue
+            for bound, count in zip(DURATION_BUCKETS, value['buckets']):
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(dict(labels, le=_format_value(bound))), count))
+            lines.append('{}_bucket{} {}'.format(name, _format_labels(dict(labels, le='+Inf')),
+                                                 value['count']))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels),
+                                              _format_value(value['sum'])))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), value['count']))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def json_lines(self, **fields):
+        """ Metrics as JSON objects, one per series, with the fields added to every one"""
+        lines = []
+        for name, labels, value in self.samples():
+            record = dict(fields, metric=name, type=METRICS.get(name, ('untyped',))[0],
+                          labels=labels)
+            if isinstance(value, dict):
+                record.update(count=value['count'], sum=value['sum'],
+                              buckets=dict(zip([_format_value(b) for b in DURATION_BUCKETS],
+                                               value['buckets'])))
+            else:
+                record['value'] = value
+            lines.append(json.dumps(record, sort_keys=True))
+        return lines
+
+    def write(self, command=None, exit_code=0, started=None):
+        """ Write the metrics with the run gauges of the command to the metrics file: the
+        Prometheus textfile is replaced at once, so a collector never reads half of it, JSON
+        lines are appended to the previous runs. Returns the path"""
+        if not self.enabled:
+            return None
+
+        now = time.time()
+        labels = {'command': command or ''}
+        if started is not None:
+            self.set('apsconnect_run_timestamp_seconds', started, **labels)
+            self.set('apsconnect_run_duration_seconds', now - started, **labels)
+        self.set('apsconnect_run_exit_code', exit_code, **labels)
+
+        path = os.path.abspath(os.path.expanduser(self.metrics_file))
+        if self.metrics_format == 'json':
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            lines = self.json_lines(time=now, command=command, exit_code=exit_code)
+            with open(path, 'a') as fd:
+                fd.write(''.join(line + '\n' for line in lines))
+            return path
+
+        # Textfile collectors read the file as is, it must be readable by them
+        files.write_atomic(path, self.prometheus_text(), mode=0o644)
+        return path
+
+
+registry = Registry()
+configure = registry.configure
+inc = registry.inc
+observe = registry.observe
+write = registry.write
+
+
+def measured(operation):
+    """ Decorator observing the duration of the operation with ok or failed result"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            result = 'failed'
+            try:
+                value = func(*args, **kwargs)
+                result = 'ok'
+                return value
+            finally:
+                observe('apsconnect_operation_duration_seconds', time.time() - started,
+                        operation=operation, result=result)
+        return wrapper
+    return decorator
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                                           .replace('\n', '\\n'))
+                          for k, v in sorted(labels.items())) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
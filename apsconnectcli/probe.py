@@ -0,0 +1,113 @@
+from __future__ import print_function
+
+import math
+import time
+import random
+import threading
+from datetime import datetime
+
+from apsconnectcli import tracing
+from apsconnectcli.lazy import LazyModule
+
+PROBE_INTERVAL = 0.2
+PROBE_INITIAL_DELAY = 0.5
+PROBE_MAX_DELAY = 5
+PROBE_MIN_TIMEOUT = 1
+PROBE_WORKERS = 8
+PERCENTILES = (50, 95, 99)
+
+requests = LazyModule('requests')
+futures = LazyModule('concurrent.futures')
+
+
+def wait_until_healthy(urls, deadline, healthy_count=3, latency_budget=1.0):
+    """ Probe the urls concurrently until every one of them gives healthy_count consecutive
+    healthy responses, i.e. non-error responses within latency_budget seconds, or the deadline
+    passes. Returns probe results in order of the urls"""
+    stop = threading.Event()
+
+    def probe(url):
+        try:
+            return _probe_url(url, deadline, healthy_count, latency_budget, stop)
+        except Exception:
+            stop.set()
+            raise
+
+    with futures.ThreadPoolExecutor(max_workers=min(len(urls), PROBE_WORKERS)) as executor:
+        return list(executor.map(probe, urls))
+
+
+def percentile(values, percent):
+    """ Nearest-rank percentile"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def format_result(result):
+    latencies = ' '.join('p{} {}'.format(p, format_ms(percentile(result['latencies'], p)))
+                         for p in PERCENTILES)
+    return "{} - {} probes, {} failed, {}".format(result['url'], result['probes'],
+                                                  result['failed'], latencies)
+
+
+def _probe_url(url, deadline, healthy_count, latency_budget, stop):
+    # Own session per url, the connection is kept alive between the probes
+    session = requests.Session()
+    session.hooks['response'].append(tracing.requests_hook_for('backend'))
+    result = {'url': url, 'ready': False, 'probes': 0, 'failed': 0, 'latencies': [],
+              'error': None}
+    healthy = 0
+    delay = PROBE_INITIAL_DELAY
+
+    try:
+        while healthy < healthy_count and not stop.is_set():
+            remaining = (deadline - datetime.now()).total_seconds()
+            if remaining <= 0:
+                break
+
+            started = time.time()
+            try:
+                r = session.get(url, timeout=min(remaining, max(latency_budget * 2,
+                                                                PROBE_MIN_TIMEOUT)))
+                latency = time.time() - started
+                result['latencies'].append(latency)
+                if r.status_code >= 400:
+                    error = "HTTP {}".format(r.status_code)
+                elif latency > latency_budget:
+                    error = "response in {} exceeds {} budget".format(
+                        format_ms(latency), format_ms(latency_budget))
+                else:
+                    error = None
+            except requests.RequestException as e:
+                error = str(e)
+
+            result['probes'] += 1
+            result['error'] = error
+            if error:
+                # Backend is still starting, back off to not hammer it
+                healthy = 0
+                result['failed'] += 1
+                pause = delay / 2.0 + random.uniform(0, delay / 2.0)
+                delay = min(delay * 2, PROBE_MAX_DELAY)
+            else:
+                healthy += 1
+                pause = PROBE_INTERVAL
+                delay = PROBE_INITIAL_DELAY
+
+            if healthy < healthy_count:
+                stop.wait(max(0, min(pause, (deadline - datetime.now()).total_seconds())))
+    finally:
+        session.close()
+
+    result['ready'] = healthy >= healthy_count
+    if not result['ready'] and not result['error']:
+        result['error'] = "Waiting time exceeded"
+    return result
+
+
+def format_ms(seconds):
+    """ Seconds as whole milliseconds, the format of every latency and time reported"""
+    return '-' if seconds is None else '{:.0f}ms'.format(seconds * 1000)
@@ -0,0 +1,305 @@
+from __future__ import print_function
+
+import re
+import sys
+import time
+import random
+import itertools
+import threading
+from email.utils import mktime_tz, parsedate_tz
+
+from apsconnectcli import metrics
+from apsconnectcli.lazy import LazyModule
+from apsconnectcli.errors import CircuitOpenError, ConfigError
+
+if sys.version_info >= (3,):
+    from urllib.parse import urlparse
+else:
+    from urlparse import urlparse
+
+RETRIES = 4
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+BREAKER_THRESHOLD = 10
+BREAKER_RESET = 30.0
+RETRY_SETTINGS = ('retries', 'base_delay', 'max_delay', 'breaker_threshold', 'breaker_reset')
+# Transient failures of the API server, the hub or a proxy in front of them
+RETRYABLE_STATUSES = (408, 409, 429, 500, 502, 503, 504)
+# The request was rejected before it was processed, safe to send again even if it creates
+UNPROCESSED_STATUSES = (429, 503)
+NON_IDEMPOTENT_RPC = ('pem.APS.importPackage',)
+RPC_METHOD_RE = re.compile(r'<methodName>([^<]+)</methodName>')
+
+# Connection failed, the request was not sent
+CONNECT_FAILURE = 'connect'
+# Connection broke or timed out after the request was sent
+NETWORK_FAILURE = 'network'
+
+k8s_rest = LazyModule('kubernetes.client.rest')
+urllib3 = LazyModule('urllib3')
+requests = LazyModule('requests')
+
+
+class CircuitBreaker(object):
+    """ Calls to one host stopped after threshold consecutive transient failures, so the workers
+    of a batch don't keep loading the host which is down. After reset seconds one trial call is
+    let through, the circuit is closed again if the host answers it"""
+
+    def __init__(self, key, threshold=BREAKER_THRESHOLD, reset=BREAKER_RESET):
+        self.key = key
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def check(self):
+        """ Raise CircuitOpenError unless the call can be made"""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            wait = self.opened_at + self.reset - time.time()
+            if wait <= 0 and not self._trial:
+                self._trial = True
+                return
+        raise CircuitOpenError("Calls to {} are stopped after {} failures in a row, retry in "
+                               "{:.0f}s".format(self.key, self.failures, max(wait, 0)))
+
+    def record(self, ok):
+        with self._lock:
+            self._trial = False
+            if ok:
+                self.failures, self.opened_at = 0, None
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened_at = time.time()
+
+
+class RetryPolicy(object):
+    """ Retries of the calls failed by transient errors with exponential backoff and jitter,
+    Retry-After of the response is respected. Calls are counted by host in circuit breakers
+    shared by all threads"""
+
+    def __init__(self):
+        self.retries = RETRIES
+        self.base_delay = RETRY_BASE_DELAY
+        self.max_delay = RETRY_MAX_DELAY
+        self.breaker_threshold = BREAKER_THRESHOLD
+        self.breaker_reset = BREAKER_RESET
+        self.log = None
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def configure(self, log=None, **settings):
+        """ Change the settings, RETRY_SETTINGS names, 0 retries or breaker_threshold disable
+        them"""
+        for name, value in settings.items():
+            if name not in RETRY_SETTINGS:
+                raise ConfigError("Unknown retry setting {}".format(name))
+            if value is None:
+                continue
+            try:
+                value = int(value) if name in ('retries', 'breaker_threshold') else float(value)
+            except (TypeError, ValueError):
+                value = -1
+            if value < 0:
+                raise ConfigError("Retry setting {} must be a non-negative number, got {}"
+                                  .format(name, settings[name]))
+            setattr(self, name, value)
+
+        if log is not None:
+            self.log = log
+        with self._lock:
+            self._breakers = {}
+
+    def breaker(self, key):
+        if not key or not self.breaker_threshold:
+            return None
+        with self._lock:
+            if key not in self._breakers:
+                self._breakers[key] = CircuitBreaker(key, self.breaker_threshold,
+                                                     self.breaker_reset)
+            return self._breakers[key]
+
+    def backoff(self, attempt):
+        """ Delay before the attempt, doubled every attempt up to max_delay, half of it is
+        random so the workers failed together don't retry together"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def call(self, func, key=None, classify=None, idempotent=True):
+        """ Run func() retrying its transient failures. classify(outcome) gets the raised error
+        or the returned value and gives (status, headers) of the failure or None, status is
+        HTTP status, CONNECT_FAILURE or NETWORK_FAILURE. Non-idempotent calls are retried only
+        if they were not processed. The last error is raised, the last value returned"""
+        breaker = self.breaker(key)
+        for attempt in itertools.count(1):
+            if breaker:
+                breaker.check()
+            try:
+                result = func()
+            except Exception as e:
+                failure = classify and classify(e)
+                delay = self._retry_delay(attempt, failure, idempotent, breaker)
+                if delay is None:
+                    raise
+                reason = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+            else:
+                failure = classify and classify(result)
+                delay = self._retry_delay(attempt, failure, idempotent, breaker)
+                if delay is None:
+                    return result
+                reason = "HTTP {}".format(failure[0])
+                # Release the connection of the discarded response
+                getattr(result, 'close', lambda: None)()
+
+            metrics.inc('apsconnect_api_retries_total', host=key or 'API', reason=failure[0])
+            if self.log:
+                self.log("Call to {} failed: {}, retry {}/{} in {:.1f}s".format(
+                    key or 'API', reason, attempt, self.retries, delay))
+            time.sleep(delay)
+
+    def _retry_delay(self, attempt, failure, idempotent, breaker):
+        transient = failure is not None and (failure[0] in (CONNECT_FAILURE, NETWORK_FAILURE) or
+                                             failure[0] in RETRYABLE_STATUSES)
+        if breaker:
+            breaker.record(not transient)
+        if not transient or attempt > self.retries or (breaker and breaker.is_open):
+            return None
+        if not idempotent and failure[0] != CONNECT_FAILURE and \
+                failure[0] not in UNPROCESSED_STATUSES:
+            return None
+
+        delay = self.backoff(attempt)
+        retry_after = _retry_after(failure[1])
+        if retry_after is not None:
+            if retry_after > self.max_delay:
+                # Host asks to come back later than we are ready to wait
+                return None
+            delay = max(delay, retry_after)
+        return delay
+
+
+policy = RetryPolicy()
+configure = policy.configure
+
+
+def retry_k8s_client(api_client):
+    """ Retry the transient failures of the kubernetes ApiClient requests, creates are retried
+    only if they were not processed"""
+    rest_client = api_client.rest_client
+    request = rest_client.request
+    key = urlparse(api_client.host).netloc or api_client.host
+
+    def retried_request(method, url, *args, **kwargs):
+        return policy.call(lambda: request(method, url, *args, **kwargs), key, k8s_failure,
+                           idempotent=method.upper() != 'POST')
+
+    rest_client.request = retried_request
+    return api_client
+
+
+def retry_session(session):
+    """ Retry the transient failures of the requests session calls"""
+    request = session.request
+
+    def retried_request(method, url, **kwargs):
+        return send(request, method, url, **kwargs)
+
+    session.request = retried_request
+    return session
+
+
+def send(request, method, url, **kwargs):
+    """ requests call request(method, url, **kwargs) with the transient failures retried. POST
+    requests are retried only if they were not processed unless they are XML-RPC calls of
+    idempotent methods, file-like bodies only if they can be rewound"""
+    data = kwargs.get('data')
+    rewind = getattr(data, 'rewind', None)
+    if hasattr(data, 'read') and rewind is None:
+        return request(method, url, **kwargs)
+
+    rpc = rpc_method(data)
+    idempotent = method.upper() != 'POST' or (rpc is not None and rpc not in NON_IDEMPOTENT_RPC)
+
+    def attempt():
+        if rewind:
+            rewind()
+        return request(method, url, **kwargs)
+
+    return policy.call(attempt, urlparse(url).netloc, requests_failure, idempotent)
+
+
+def rpc_method(data):
+    """ Method name of the XML-RPC request body, None for other bodies"""
+    method = getattr(data, 'method', None)
+    if method is None and isinstance(data, bytes):
+        data = data[:512].decode('utf-8', 'replace')
+    if method is None and isinstance(data, type(u'')):
+        match = RPC_METHOD_RE.search(data[:512])
+        method = match.group(1) if match else None
+    return method
+
+
+def k8s_failure(outcome):
+    """ Failure of the kubernetes client request, an object which already exists or was
+    modified since it was read is not retried unlike other conflicts"""
+    if isinstance(outcome, k8s_rest.ApiException):
+        if not outcome.status:
+            # Request can't be made, e.g. TLS verification failed
+            return None
+        if outcome.status == 409 and ('AlreadyExists' in str(outcome.body) or
+                                      'has been modified' in str(outcome.body)):
+            return None
+        return outcome.status, outcome.headers
+    return _urllib3_failure(outcome)
+
+
+def requests_failure(outcome):
+    """ Failure of the requests call, the response of a transient error status or the
+    connection error"""
+    if isinstance(outcome, requests.Response):
+        if outcome.status_code in RETRYABLE_STATUSES:
+            return outcome.status_code, outcome.headers
+        return None
+    if isinstance(outcome, requests.exceptions.SSLError):
+        return None
+    if isinstance(outcome, requests.exceptions.ConnectTimeout):
+        return CONNECT_FAILURE, None
+    if isinstance(outcome, requests.exceptions.ConnectionError):
+        reason = outcome.args[0] if outcome.args else None
+        return _urllib3_failure(reason) or (NETWORK_FAILURE, None)
+    if isinstance(outcome, requests.exceptions.Timeout):
+        return NETWORK_FAILURE, None
+    return None
+
+
+def _urllib3_failure(error):
+    if not isinstance(error, urllib3.exceptions.HTTPError):
+        return None
+    if isinstance(error, urllib3.exceptions.MaxRetryError) and error.reason is not None:
+        error = error.reason
+    if isinstance(error, urllib3.exceptions.SSLError):
+        return None
+    if isinstance(error, urllib3.exceptions.ConnectTimeoutError):
+        # NewConnectionError too, the connection was refused
+        return CONNECT_FAILURE, None
+    return NETWORK_FAILURE, None
+
+
+def _retry_after(headers):
+    """ Seconds to wait from Retry-After header, delay-seconds or HTTP-date"""
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        date = parsedate_tz(value)
+        return max(mktime_tz(date) - time.time(), 0) if date else None
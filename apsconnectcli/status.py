@@ -0,0 +1,268 @@
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import threading
+
+from apsconnectcli import files
+from apsconnectcli import tracing
+from apsconnectcli.lazy import LazyModule
+from apsconnectcli.cluster import BACKEND_SELECTOR
+from apsconnectcli.errors import APSConnectError, ClusterError
+
+if sys.version_info >= (3,):
+    from urllib.parse import urlparse
+else:
+    from urlparse import urlparse
+
+STATUS_CACHE_PATH = os.path.expanduser('~/.aps_status')
+STATUS_TTL = 15
+HUB_REFRESH_INTERVAL = 30
+WATCH_TIMEOUT = 300
+WATCH_RETRY_DELAY = 5
+# Deployments and services watches keep a connection each, one more for the other calls
+STATUS_CONNECTIONS = 3
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+watch = LazyModule('kubernetes.watch')
+futures = LazyModule('concurrent.futures')
+queue = LazyModule('queue' if sys.version_info >= (3,) else 'Queue')
+
+
+def collect_status(cluster, hubs, namespace=None):
+    """ Backends of the cluster and application instances of the named hubs, listed
+    concurrently with one bulk call per resource type. Returns status snapshot, the hubs
+    which can't be listed are reported in its errors"""
+    with futures.ThreadPoolExecutor(max_workers=len(hubs) + 1) as executor:
+        backends_job = executor.submit(list_backends, cluster, namespace)
+        hub_jobs = [(name, executor.submit(list_frontends, hub, name)) for name, hub in hubs]
+
+    snapshot = _snapshot(backends_job.result()[0], [], [])
+    for name, job in hub_jobs:
+        try:
+            snapshot['frontends'].extend(job.result())
+        except APSConnectError as e:
+            snapshot['errors'].append("Hub {}: {}".format(name or 'default', e))
+    return snapshot
+
+
+def watch_status(cluster, hubs, namespace=None, interval=HUB_REFRESH_INTERVAL, stop=None):
+    """ Generator of status snapshots, a new one is yielded on every change of the backends
+    streamed by the deployments and services watches and every interval seconds when the hub
+    instances are listed again. Stops when the stop event is set"""
+    stop = stop or threading.Event()
+    events = queue.Queue()
+    objects = {'deployment': {}, 'service': {}}
+    frontends, errors = {}, {}
+
+    for kind, api in (('deployment', cluster.ext_api), ('service', cluster.core_api)):
+        thread = threading.Thread(target=_watch_objects,
+                                  args=(api, kind, namespace, events, stop))
+        thread.daemon = True
+        thread.start()
+
+    def refresh_hubs():
+        for name, hub in hubs:
+            try:
+                frontends[name] = list_frontends(hub, name)
+                errors.pop(name, None)
+            except APSConnectError as e:
+                # Previous instances are kept until the hub answers again
+                errors[name] = "Hub {}: {}".format(name or 'default', e)
+
+    try:
+        refresh_hubs()
+        refresh_at = time.time() + interval
+        listed = set()
+        while not stop.is_set():
+            try:
+                kind, event_type, obj = events.get(timeout=max(0, refresh_at - time.time()))
+            except queue.Empty:
+                refresh_hubs()
+                refresh_at = time.time() + interval
+            else:
+                if event_type == 'ERROR':
+                    errors[kind] = obj
+                elif event_type == 'LISTED':
+                    objects[kind] = {(o.metadata.namespace, o.metadata.name): o for o in obj}
+                    listed.add(kind)
+                    errors.pop(kind, None)
+                elif event_type == 'DELETED':
+                    objects[kind].pop((obj.metadata.namespace, obj.metadata.name), None)
+                else:
+                    objects[kind][(obj.metadata.namespace, obj.metadata.name)] = obj
+
+            if len(listed) < len(objects):
+                # Backends are not known until both lists are received
+                continue
+
+            yield _snapshot(_backends(objects['deployment'], objects['service']),
+                            [f for name, _ in hubs for f in frontends.get(name, [])],
+                            [errors[key] for key in sorted(errors, key=str)])
+    finally:
+        stop.set()
+
+
+def list_backends(cluster, namespace=None):
+    """ Backends of the connectors in the namespace or all namespaces, deployments and
+    services are listed with one labeled call each. Returns the backends and resource versions
+    of the lists"""
+    try:
+        with tracing.span('backends list'):
+            deployments = _list_objects(cluster.ext_api, 'deployment', namespace)
+            services = _list_objects(cluster.core_api, 'service', namespace)
+    except Exception as e:
+        raise ClusterError("Unable to list backends, error: {}".format(e))
+
+    backends = _backends({(d.metadata.namespace, d.metadata.name): d for d in deployments.items},
+                         {(s.metadata.namespace, s.metadata.name): s for s in services.items})
+    return backends, {'deployment': deployments.metadata.resource_version,
+                      'service': services.metadata.resource_version}
+
+
+def list_frontends(hub, hub_name=None):
+    """ Application instances on the hub, the instances of every application are listed
+    concurrently"""
+    with tracing.span('frontends list'):
+        applications = hub.list_applications()
+        jobs = [(a, hub.submit(hub.list_instances, a['aps']['id'])) for a in applications]
+
+        frontends = []
+        for application, job in jobs:
+            for instance in job.result():
+                frontends.append({
+                    'hub': hub_name,
+                    'connector_id': application.get('id'),
+                    'version': application.get('version'),
+                    'release': application.get('release'),
+                    'application_id': application['aps']['id'],
+                    'instance_id': instance.get('aps', {}).get('id'),
+                    'endpoint': instance.get('aps', {}).get('endpoint') or
+                    instance.get('endpoint'),
+                })
+
+    return frontends
+
+
+def join(snapshot):
+    """ Status rows of the backends with the hub instances using them, matched by the host of
+    the backend URL. Instances of unknown backends get rows of their own"""
+    by_address = {}
+    for frontend in snapshot['frontends']:
+        by_address.setdefault(_endpoint_address(frontend['endpoint']), []).append(frontend)
+
+    rows = []
+    for backend in sorted(snapshot['backends'], key=lambda b: (b['namespace'], b['name'])):
+        instances = by_address.pop(backend['address'], []) if backend['address'] else []
+        rows.append(dict(backend, instances=instances))
+
+    for address, instances in sorted(by_address.items(), key=lambda item: str(item[0])):
+        rows.append({'namespace': None, 'name': None, 'replicas': None, 'ready': None,
+                     'address': address, 'instances': instances})
+
+    return rows
+
+
+def load_cached(key, ttl=STATUS_TTL, path=STATUS_CACHE_PATH):
+    """ Status snapshot saved less than ttl seconds ago, None if there is no such"""
+    try:
+        with open(path) as fd:
+            snapshot = json.load(fd).get(key)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if snapshot and 0 <= time.time() - snapshot['time'] < ttl:
+        return snapshot
+    return None
+
+
+def save_cached(key, snapshot, ttl=STATUS_TTL, path=STATUS_CACHE_PATH):
+    """ Keep the snapshot for load_cached, expired snapshots of other keys are dropped"""
+    try:
+        with open(path) as fd:
+            cached = json.load(fd)
+    except (IOError, OSError, ValueError):
+        cached = {}
+
+    now = time.time()
+    cached = {k: v for k, v in cached.items() if now - v.get('time', 0) < ttl}
+    cached[key] = snapshot
+    files.write_json(path, cached)
+
+
+def _snapshot(backends, frontends, errors):
+    return {'time': time.time(), 'backends': backends, 'frontends': frontends,
+            'errors': errors}
+
+
+def _backends(deployments, services):
+    backends = []
+    for key in sorted(set(deployments) | set(services)):
+        deployment, service = deployments.get(key), services.get(key)
+        ingress = service and service.status and service.status.load_balancer and \
+            service.status.load_balancer.ingress
+        backends.append({
+            'namespace': key[0],
+            'name': key[1],
+            'replicas': deployment.spec.replicas if deployment else None,
+            'ready': (deployment.status.available_replicas or 0)
+            if deployment and deployment.status else None,
+            'address': (ingress[0].ip or ingress[0].hostname) if ingress else None,
+        })
+    return backends
+
+
+def _list_func(api, kind, namespace):
+    if namespace:
+        return getattr(api, 'list_namespaced_{}'.format(kind)), {'namespace': namespace}
+    return getattr(api, 'list_{}_for_all_namespaces'.format(kind)), {}
+
+
+def _list_objects(api, kind, namespace, **kwargs):
+    func, func_kwargs = _list_func(api, kind, namespace)
+    return func(label_selector=BACKEND_SELECTOR, **dict(func_kwargs, **kwargs))
+
+
+def _watch_objects(api, kind, namespace, events, stop):
+    """ Stream the changes of the labeled objects into events, the objects are listed again
+    when the watch can't be resumed"""
+    func, kwargs = _list_func(api, kind, namespace)
+    resource_version = None
+
+    while not stop.is_set():
+        try:
+            if resource_version is None:
+                objects = func(label_selector=BACKEND_SELECTOR, **kwargs)
+                resource_version = objects.metadata.resource_version
+                events.put((kind, 'LISTED', objects.items))
+
+            stream = watch.Watch()
+            for event in stream.stream(func, label_selector=BACKEND_SELECTOR,
+                                       resource_version=resource_version,
+                                       timeout_seconds=WATCH_TIMEOUT, **kwargs):
+                if stop.is_set():
+                    stream.stop()
+                    break
+                if event['type'] == 'ERROR':
+                    # Resource version is too old, start over from a fresh list
+                    resource_version = None
+                    stream.stop()
+                    break
+                resource_version = event['object'].metadata.resource_version
+                events.put((kind, event['type'], event['object']))
+        except Exception as e:
+            events.put((kind, 'ERROR', "Watch of {}s failed, error: {}".format(kind, e)))
+            resource_version = None
+            stop.wait(WATCH_RETRY_DELAY)
+
+
+def _endpoint_address(endpoint):
+    """ host[:port] of the backend URL, default port is omitted like in the service address"""
+    if not endpoint:
+        return None
+    url = urlparse(endpoint)
+    if url.port and url.port != DEFAULT_PORTS.get(url.scheme):
+        return '{}:{}'.format(url.hostname, url.port)
+    return url.hostname
@@ -0,0 +1,331 @@
+from __future__ import print_function
+
+import re
+import json
+import threading
+
+from apsconnectcli.lazy import LazyModule
+from apsconnectcli.errors import ConfigError
+
+TEMPLATE_KINDS = ('secret', 'deployment', 'service', 'autoscaler')
+TEMPLATE_OBJECT_KINDS = {'secret': 'Secret', 'deployment': 'Deployment', 'service': 'Service',
+                         'autoscaler': 'HorizontalPodAutoscaler'}
+# Variables substituted on render, ${variable} placeholders of other names are rejected
+TEMPLATE_VARIABLES = {
+    'secret': ('name', 'namespace', 'data', 'config', 'config_hash'),
+    'deployment': ('name', 'namespace', 'image', 'replicas', 'healthcheck_path', 'cpu_request',
+                   'memory_request', 'cpu_limit', 'memory_limit', 'probe_delay', 'probe_period',
+                   'probe_timeout'),
+    'service': ('name', 'namespace'),
+    'autoscaler': ('name', 'namespace', 'min_replicas', 'max_replicas', 'target_cpu'),
+}
+PLACEHOLDER_RE = re.compile(r'\$(\$|\{(\w+)\})')
+# Objects of the connector-backends are labeled, so they can be listed in bulk
+BACKEND_LABELS = {'managed-by': 'apsconnect'}
+
+yaml = LazyModule('yaml')
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _probe():
+    return {
+        'httpGet': {
+            'path': '${healthcheck_path}',
+            'port': 80,
+        },
+        'initialDelaySeconds': '${probe_delay}',
+        'periodSeconds': '${probe_period}',
+        'timeoutSeconds': '${probe_timeout}',
+    }
+
+
+BUILTIN_TEMPLATES = {
+    'secret': {
+        'apiVersion': 'v1',
+        'data': '${data}',
+        'kind': 'Secret',
+        'metadata': {
+            'annotations': {
+                'apsconnect/config-hash': '${config_hash}',
+            },
+            'labels': dict(BACKEND_LABELS),
+            'name': '${name}',
+            'namespace': '${namespace}',
+        },
+        'type': 'Opaque',
+    },
+    'deployment': {
+        'apiVersion': 'extensions/v1beta1',
+        'kind': 'Deployment',
+        'metadata': {
+            'labels': dict(BACKEND_LABELS, name='${name}'),
+            'name': '${name}',
+            'namespace': '${namespace}',
+        },
+        'spec': {
+            'replicas': '${replicas}',
+            'template': {
+                'metadata': {
+                    'labels': {
+                        'name': '${name}',
+                    },
+                },
+                'spec': {
+                    'containers': [
+                        {
+                            'name': '${name}',
+                            'image': '${image}',
+                            'env': [
+                                {
+                                    'name': 'CONFIG_FILE',
+                                    'value': '/config/config.json',
+                                },
+                            ],
+                            'livenessProbe': _probe(),
+                            'readinessProbe': _probe(),
+                            'ports': [
+                                {
+                                    'containerPort': 80,
+                                    'name': 'http-server',
+                                },
+                            ],
+                            'resources': {
+                                'limits': {
+                                    'cpu': '${cpu_limit}',
+                                    'memory': '${memory_limit}',
+                                },
+                                'requests': {
+                                    'cpu': '${cpu_request}',
+                                    'memory': '${memory_request}',
+                                },
+                            },
+                            'volumeMounts': [
+                                {
+                                    'mountPath': '/config',
+                                    'name': 'config-volume',
+                                },
+                            ],
+                        },
+                    ],
+                    'volumes': [
+                        {
+                            'name': 'config-volume',
+                            'secret': {
+                                'secretName': '${name}',
+                            },
+                        },
+                    ],
+                },
+            },
+        },
+    },
+    'service': {
+        'apiVersion': 'v1',
+        'kind': 'Service',
+        'metadata': {
+            'labels': dict(BACKEND_LABELS, name='${name}'),
+            'name': '${name}',
+            'namespace': '${namespace}',
+        },
+        'spec': {
+            'ports': [
+                {
+                    'port': 80,
+                    'protocol': 'TCP',
+                    'targetPort': 80,
+                }
+            ],
+            'selector': {
+                'name': '${name}'
+            },
+            'type': 'LoadBalancer'
+        }
+    },
+    'autoscaler': {
+        'apiVersion': 'autoscaling/v1',
+        'kind': 'HorizontalPodAutoscaler',
+        'metadata': {
+            'name': '${name}',
+            'namespace': '${namespace}',
+        },
+        'spec': {
+            'scaleTargetRef': {
+                'apiVersion': 'extensions/v1beta1',
+                'kind': 'Deployment',
+                'name': '${name}',
+            },
+            'minReplicas': '${min_replicas}',
+            'maxReplicas': '${max_replicas}',
+            'targetCPUUtilizationPercentage': '${target_cpu}',
+        },
+    },
+}
+
+
+class Template(object):
+    """ Object manifest with ${variable} placeholders compiled once into a function building
+    the object, so rendering costs a single expression evaluation. A string which is just
+    the placeholder gets the value as is and the field is dropped if the value is None, as well
+    as a mapping left empty by that. $$ stands for a literal $"""
+
+    def __init__(self, manifest, kind=None, variables=None):
+        self.kind = kind
+        self.variables = set()
+        self.optional = False
+        source = self._expression(manifest, '')
+        unknown = self.variables - set(variables) if variables is not None else None
+        if unknown:
+            raise ConfigError("Unknown variables {} in {} template, expected {}".format(
+                ', '.join('${{{}}}'.format(v) for v in sorted(unknown)), kind,
+                ', '.join(variables)))
+        self._render = eval(compile('lambda v: ' + source, '<{} template>'.format(kind), 'eval'),
+                            {'_compact': _compact})
+
+    def render(self, **values):
+        """ New object with the placeholders substituted by the values"""
+        missing = self.variables - set(values)
+        if missing:
+            raise ConfigError("Missing values of {} template: {}".format(
+                self.kind, ', '.join(sorted(missing))))
+        return self._render(values)
+
+    def _expression(self, node, path):
+        """ Python expression building the node, self.optional tells whether it can be
+        dropped"""
+        if isinstance(node, dict):
+            items, optional = [], []
+            for key, value in sorted(node.items(), key=lambda item: str(item[0])):
+                if not isinstance(key, type(u'')) and not isinstance(key, str):
+                    raise ConfigError("Key {!r} of {} template at {} is not a string".format(
+                        key, self.kind, path or '/'))
+                items.append('{!r}: {}'.format(key, self._expression(value, path + '/' + key)))
+                if self.optional:
+                    optional.append(key)
+            source = '{' + ', '.join(items) + '}'
+            self.optional = bool(optional) and len(optional) == len(node)
+            return '_compact({}, {!r})'.format(source, tuple(optional)) if optional else source
+
+        if isinstance(node, list):
+            items = [self._expression(item, '{}/{}'.format(path, i))
+                     for i, item in enumerate(node)]
+            self.optional = False
+            return '[' + ', '.join(items) + ']'
+
+        self.optional = False
+        if isinstance(node, (type(u''), str)):
+            return self._string(node)
+        if node is None or isinstance(node, (bool, int, float)):
+            return repr(node)
+        raise ConfigError("Value {!r} of {} template at {} is not supported".format(
+            node, self.kind, path or '/'))
+
+    def _string(self, text):
+        match = PLACEHOLDER_RE.match(text)
+        if match and match.end() == len(text) and match.group(2):
+            self.variables.add(match.group(2))
+            self.optional = True
+            return 'v[{!r}]'.format(match.group(2))
+
+        parts, names, position = [], [], 0
+        for match in PLACEHOLDER_RE.finditer(text):
+            parts.append(text[position:match.start()].replace('{', '{{').replace('}', '}}'))
+            if match.group(2):
+                names.append(match.group(2))
+                parts.append('{}')
+            else:
+                parts.append('$')
+            position = match.end()
+        if not names and position == 0:
+            return repr(text)
+
+        parts.append(text[position:].replace('{', '{{').replace('}', '}}'))
+        self.variables.update(names)
+        return '{!r}.format({})'.format(''.join(parts),
+                                        ', '.join('v[{!r}]'.format(n) for n in names))
+
+
+def load_templates(templates_file=None, overrides=None):
+    """ Compiled templates of the backend objects, the built-in ones replaced by the sections
+    of the YAML/JSON templates file, with the overrides sections merged in. Templates are
+    cached, so many backends installed at once compile them only once"""
+    key = (templates_file, json.dumps(overrides, sort_keys=True) if overrides else None)
+    with _cache_lock:
+        templates = _cache.get(key)
+    if templates is not None:
+        return templates
+
+    manifests = dict(BUILTIN_TEMPLATES)
+    if templates_file:
+        manifests.update(_read_templates_file(templates_file))
+
+    templates = {}
+    for kind in TEMPLATE_KINDS:
+        manifest = manifests[kind]
+        if overrides and overrides.get(kind):
+            manifest = merge_overrides(manifest, overrides[kind])
+        _check_manifest(kind, manifest)
+        templates[kind] = Template(manifest, kind, TEMPLATE_VARIABLES[kind])
+
+    with _cache_lock:
+        _cache[key] = templates
+    return templates
+
+
+def merge_overrides(template, overrides):
+    """ Template with overrides merged in, mappings are merged recursively, lists of
+    mappings item by item, other values are replaced, null removes the field"""
+    if isinstance(template, dict) and isinstance(overrides, dict):
+        merged = dict(template)
+        for key, value in overrides.items():
+            if value is None:
+                merged.pop(key, None)
+            elif key in merged:
+                merged[key] = merge_overrides(merged[key], value)
+            else:
+                merged[key] = value
+        return merged
+
+    if isinstance(template, list) and isinstance(overrides, list) \
+            and all(isinstance(item, dict) for item in template + overrides):
+        return [merge_overrides(template[i], item) if i < len(template) else item
+                for i, item in enumerate(overrides)] + template[len(overrides):]
+
+    return overrides
+
+
+def _read_templates_file(path):
+    try:
+        with open(path) as fd:
+            manifests = yaml.safe_load(fd) or {}
+    except Exception as e:
+        raise ConfigError("Unable to read templates file, error: {}".format(e))
+
+    if not isinstance(manifests, dict):
+        raise ConfigError("Templates must be a mapping with {} sections".format(
+            ', '.join(TEMPLATE_KINDS)))
+    unknown = set(manifests) - set(TEMPLATE_KINDS)
+    if unknown:
+        raise ConfigError("Unknown templates sections: {}, expected {}".format(
+            ', '.join(sorted(unknown)), ', '.join(TEMPLATE_KINDS)))
+    return manifests
+
+
+def _check_manifest(kind, manifest):
+    if not isinstance(manifest, dict):
+        raise ConfigError("{} template must be a mapping".format(kind.capitalize()))
+    if manifest.get('kind') != TEMPLATE_OBJECT_KINDS[kind]:
+        raise ConfigError("{} template must be of kind {}, got {}".format(
+            kind.capitalize(), TEMPLATE_OBJECT_KINDS[kind], manifest.get('kind')))
+    if not manifest.get('apiVersion'):
+        raise ConfigError("{} template has no apiVersion".format(kind.capitalize()))
+    if manifest.get('metadata', {}).get('name') != '${name}':
+        raise ConfigError("{} template must be named ${{name}}".format(kind.capitalize()))
+
+
+def _compact(mapping, keys):
+    for key in keys:
+        if mapping[key] is None or mapping[key] == {}:
+            del mapping[key]
+    return mapping
@@ -0,0 +1,210 @@
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from apsconnectcli import metrics
+from apsconnectcli.retry import rpc_method
+
+if sys.version_info >= (3,):
+    from urllib.parse import urlparse
+else:
+    from urlparse import urlparse
+
+# Path segments of object ids, replaced in the endpoint names to keep their number bounded
+ID_SEGMENT_RE = re.compile(r'^(\d{3,}|[0-9a-fA-F-]{8,})$')
+
+
+class Tracer(object):
+    """ Collects timing spans of the command phases together with the number of API calls
+    and bytes transferred within every span"""
+
+    def __init__(self):
+        self.enabled = False
+        self.timings = False
+        self.trace_file = None
+        self.spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def configure(self, timings=False, trace_file=None):
+        self.timings = bool(timings)
+        self.trace_file = trace_file
+        self.enabled = self.timings or bool(trace_file)
+
+    @contextmanager
+    def span(self, name):
+        if not self.enabled:
+            started = time.time()
+            try:
+                yield
+            finally:
+                metrics.observe('apsconnect_phase_duration_seconds', time.time() - started,
+                                phase=name)
+            return
+
+        record = {
+            'name': name,
+            'start': time.time(),
+            'calls': 0,
+            'bytes_sent': 0,
+            'bytes_received': 0,
+            'tid': threading.current_thread().ident,
+        }
+        stack = self._stack()
+        stack.append(record)
+        try:
+            yield
+        finally:
+            stack.pop()
+            record['end'] = time.time()
+            with self._lock:
+                self.spans.append(record)
+            metrics.observe('apsconnect_phase_duration_seconds', record['end'] - record['start'],
+                            phase=name)
+
+    def record_call(self, bytes_sent=0, bytes_received=0):
+        """ Account an API call in every span open in the current thread"""
+        if not self.enabled:
+            return
+
+        for record in self._stack():
+            record['calls'] += 1
+            record['bytes_sent'] += bytes_sent
+            record['bytes_received'] += bytes_received
+
+    def summary(self):
+        """ Spans aggregated by name in order of the first start"""
+        phases = {}
+        for record in sorted(self.spans, key=lambda r: r['start']):
+            phase = phases.setdefault(record['name'], {
+                'name': record['name'],
+                'start': record['start'],
+                'count': 0,
+                'elapsed': 0.0,
+                'calls': 0,
+                'bytes_sent': 0,
+                'bytes_received': 0,
+            })
+            phase['count'] += 1
+            phase['elapsed'] += record['end'] - record['start']
+            for key in ('calls', 'bytes_sent', 'bytes_received'):
+                phase[key] += record[key]
+
+        return sorted(phases.values(), key=lambda p: p['start'])
+
+    def write_chrome_trace(self, path):
+        """ Save spans in Chrome trace event format, viewable in chrome://tracing"""
+        pid = os.getpid()
+        events = [{
+            'name': record['name'],
+            'ph': 'X',
+            'ts': int(record['start'] * 1000000),
+            'dur': int((record['end'] - record['start']) * 1000000),
+            'pid': pid,
+            'tid': record['tid'],
+            'args': {key: record[key] for key in ('calls', 'bytes_sent', 'bytes_received')},
+        } for record in sorted(self.spans, key=lambda r: r['start'])]
+
+        with open(path, 'w') as fd:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fd, indent=1)
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+
+tracer = Tracer()
+span = tracer.span
+record_call = tracer.record_call
+
+
+def instrument_k8s_client(api_client):
+    """ Account every request of the kubernetes ApiClient in the current spans and the
+    metrics"""
+    rest_client = api_client.rest_client
+    request = rest_client.request
+
+    def traced_request(method, url, *args, **kwargs):
+        if not tracer.enabled and not metrics.registry.enabled:
+            return request(method, url, *args, **kwargs)
+
+        body = kwargs.get('body')
+        sent = len(json.dumps(body)) if body is not None else 0
+        started = time.time()
+        try:
+            r = request(method, url, *args, **kwargs)
+        except Exception as e:
+            _record_metrics('k8s', _k8s_endpoint(method, url), getattr(e, 'status', None),
+                            time.time() - started, sent, 0)
+            raise
+
+        data = getattr(r, 'data', None) if kwargs.get('_preload_content', True) else None
+        received = len(data) if data else 0
+        record_call(sent, received)
+        _record_metrics('k8s', _k8s_endpoint(method, url), getattr(r, 'status', None),
+                        time.time() - started, sent, received)
+        return r
+
+    rest_client.request = traced_request
+    return api_client
+
+
+def requests_hook_for(service):
+    """ requests response hook accounting the call in the current spans and the metrics of
+    the service"""
+    def hook(response, *args, **kwargs):
+        if tracer.enabled or metrics.registry.enabled:
+            body = response.request.body
+            sent = len(body) if body is not None and hasattr(body, '__len__') else 0
+            received = int(response.headers.get('Content-Length') or 0)
+            record_call(sent, received)
+            _record_metrics(service, _http_endpoint(response.request), response.status_code,
+                            response.elapsed.total_seconds(), sent, received)
+        return response
+
+    return hook
+
+
+requests_hook = requests_hook_for('http')
+
+
+def _record_metrics(service, endpoint, status, seconds, sent, received):
+    metrics.inc('apsconnect_api_requests_total', service=service, endpoint=endpoint,
+                status=status or 'error')
+    metrics.observe('apsconnect_api_request_duration_seconds', seconds, service=service,
+                    endpoint=endpoint)
+    if sent:
+        metrics.inc('apsconnect_api_bytes_sent_total', sent, service=service)
+    if received:
+        metrics.inc('apsconnect_api_bytes_received_total', received, service=service)
+
+
+def _k8s_endpoint(method, url):
+    """ Method and resource of the k8s API request, namespace and object names dropped"""
+    segments = [s for s in urlparse(url).path.split('/') if s]
+    if segments[:1] == ['api']:
+        segments = segments[2:]
+    elif segments[:1] == ['apis']:
+        segments = segments[3:]
+    if segments[:1] == ['namespaces'] and len(segments) > 2:
+        segments = segments[2:]
+    resource = '/'.join(segments[:1] + segments[2:3])
+    return '{} {}'.format(method.upper(), resource or '/')
+
+
+def _http_endpoint(request):
+    """ XML-RPC method of the request or its method and path with ids replaced by {id}"""
+    method = rpc_method(request.body)
+    if method:
+        return method
+    path = '/'.join('{id}' if ID_SEGMENT_RE.match(s) else s
+                    for s in urlparse(request.url).path.split('/'))
+    return '{} {}'.format(request.method, path or '/')
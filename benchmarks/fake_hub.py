@@ -0,0 +1,225 @@
+""" Minimal in-process OA Hub for the benchmarks
+
+Serves the XML-RPC API (APS.importPackage, APS.getUserToken, statistics.getStatisticsReport,
+setSystemProperty) at /RPC2 and APS REST aps/2/applications/ with the instances of every
+application on the same port. Packages are
+parsed like the hub does, so instances can be created only for imported versions. Files added
+with serve_file are available for download with ETag revalidation.
+"""
+from __future__ import print_function
+
+import io
+import os
+import re
+import sys
+import uuid
+import time
+import zipfile
+import hashlib
+import threading
+from xml.etree import ElementTree as xml_et
+
+from fake_server import FakeServer
+
+if sys.version_info >= (3,):
+    import xmlrpc.client as xmlrpclib
+    from urllib.request import urlopen
+else:
+    import xmlrpclib
+    from urllib2 import urlopen
+
+APS_NAMESPACE = '{http://aps-standard.org/ns/2}'
+HUB_VERSION = 'oa-7.1-2017'
+STATISTICS_REPORT = '<Report><ClientVersion>{}</ClientVersion></Report>'
+INSTANCES_PATTERN = re.compile(r'^/aps/2/applications/(?P<application>[^/]+)/instances/?$')
+
+
+class FakeHub(FakeServer):
+    def __init__(self, token_ttl=600, hub_version=HUB_VERSION, **kwargs):
+        super(FakeHub, self).__init__(**kwargs)
+        self.token_ttl = token_ttl
+        self.hub_version = hub_version
+        self.applications = []
+        self.instances = []
+        self.properties = {}
+        self.tokens = {}
+        self.files = {}
+        self._data_lock = threading.Lock()
+
+    def cfg(self):
+        """ Hub config as saved by init-hub"""
+        return {'host': '127.0.0.1', 'user': 'admin', 'password': '1q2w3e', 'ssl': False,
+                'port': self.port, 'aps_host': '127.0.0.1', 'aps_port': self.port,
+                'use_tls_aps': False, 'cache_token': False}
+
+    def serve_file(self, path):
+        """ Make the file downloadable, returns its URL"""
+        name = os.path.basename(path)
+        with open(path, 'rb') as fd:
+            self.files[name] = fd.read()
+        return '{}/files/{}'.format(self.url, name)
+
+    def handle(self, request):
+        if request.path == '/RPC2' and request.method == 'POST':
+            return self._rpc(request)
+        elif request.path.startswith('/files/'):
+            return self._file(request)
+        elif request.path.rstrip('/') == '/aps/2/applications':
+            return self._applications(request)
+        elif INSTANCES_PATTERN.match(request.path):
+            return self._instances(request,
+                                   INSTANCES_PATTERN.match(request.path).group('application'))
+
+        self.count('{} unknown'.format(request.method))
+        return 404, {'error': 'NotFound', 'message': request.path}
+
+    def _rpc(self, request):
+        params, method = xmlrpclib.loads(request.body)
+        self.count('RPC {}'.format(method))
+
+        if self.should_fail('RPC {}'.format(method)):
+            return self.failure_status, b'Injected failure'
+
+        handler = {
+            'pem.APS.importPackage': self._import_package,
+            'pem.APS.getUserToken': self._get_user_token,
+            'pem.statistics.getStatisticsReport': self._get_statistics_report,
+            'pem.setSystemProperty': self._set_system_property,
+        }.get(method)
+
+        if handler:
+            result = handler(params[0] if params else {})
+        else:
+            result = {'status': -1, 'error_message': "Unknown method {}".format(method)}
+
+        return 200, xmlrpclib.dumps((result,), methodresponse=True).encode('utf-8'), {
+            'Content-Type': 'text/xml'}
+
+    def _import_package(self, params):
+        if 'package_body' in params:
+            body = params['package_body']
+            body = body.data if hasattr(body, 'data') else body
+        elif 'package_url' in params:
+            try:
+                body = urlopen(params['package_url']).read()
+            except Exception as e:
+                return {'status': -1, 'error_message': "Unable to download package: {}".format(e)}
+        else:
+            return {'status': -1, 'error_message': "Package is not specified"}
+
+        try:
+            with zipfile.ZipFile(io.BytesIO(body)) as package:
+                tree = xml_et.fromstring(package.read('APP-META.xml'))
+            meta = {key: tree.find('{}{}'.format(APS_NAMESPACE, key)).text
+                    for key in ('id', 'version', 'release')}
+        except Exception as e:
+            return {'status': -1, 'error_message': "Invalid package: {}".format(e)}
+
+        application_id = str(uuid.uuid4())
+        with self._data_lock:
+            self.applications.append(dict(meta, aps={'id': application_id}))
+        return {'status': 0, 'result': {'application_id': application_id}}
+
+    def _get_user_token(self, params):
+        token = uuid.uuid4().hex
+        with self._data_lock:
+            self.tokens[token] = time.time() + self.token_ttl
+        return {'status': 0, 'result': {'aps_token': token}}
+
+    def _get_statistics_report(self, params):
+        return {'status': 0, 'result': [{'name': 'report-for-cep',
+                                         'value': STATISTICS_REPORT.format(self.hub_version)}]}
+
+    def _set_system_property(self, params):
+        with self._data_lock:
+            self.properties[params.get('name')] = params.get('bool_value')
+        return {'status': 0}
+
+    def _file(self, request):
+        self.count('{} files'.format(request.method))
+        data = self.files.get(request.path[len('/files/'):])
+        if data is None:
+            return 404, b''
+
+        etag = '"{}"'.format(hashlib.sha256(data).hexdigest())
+        if request.headers.get('If-None-Match') == etag:
+            return 304, b'', {'ETag': etag}
+        if self.should_fail('{} files'.format(request.method)):
+            return self.failure_status, b''
+        return 200, data, {'ETag': etag, 'Content-Type': 'application/zip'}
+
+    def _authorize(self, request, key):
+        """ Error response if the APS token is not valid or the failure is injected"""
+        with self._data_lock:
+            expires = self.tokens.get(request.headers.get('APS-Token'))
+        if not expires or expires < time.time():
+            return 401, {'error': 'Unauthorized', 'message': "Invalid or expired APS token"}
+
+        if self.should_fail(key):
+            return self.failure_status, {'error': 'InternalError', 'message': "Injected failure"}
+
+        return None
+
+    def _instances(self, request, application_id):
+        key = '{} aps/2/applications/instances'.format(request.method)
+        self.count(key)
+        error = self._authorize(request, key)
+        if error:
+            return error
+        if request.method != 'GET':
+            return 405, {'error': 'MethodNotAllowed', 'message': request.method}
+
+        with self._data_lock:
+            applications = [a for a in self.applications if a['aps']['id'] == application_id]
+            if not applications:
+                return 404, {'error': 'NotFound', 'message': application_id}
+            application = applications[0]
+            return 200, [i for i in self.instances
+                         if i['aps']['package'] == {name: application[field] for name, field in
+                                                    (('type', 'id'), ('version', 'version'),
+                                                     ('release', 'release'))}]
+
+    def _applications(self, request):
+        key = '{} aps/2/applications'.format(request.method)
+        self.count(key)
+        error = self._authorize(request, key)
+        if error:
+            return error
+
+        if request.method == 'GET':
+            with self._data_lock:
+                return 200, list(self.applications)
+        elif request.method != 'POST':
+            return 405, {'error': 'MethodNotAllowed', 'message': request.method}
+
+        payload = request.json() or {}
+        package = payload.get('aps', {}).get('package', {})
+        with self._data_lock:
+            imported = [a for a in self.applications if a['id'] == package.get('type')
+                        and a['version'] == package.get('version')
+                        and a['release'] == package.get('release')]
+            if not imported:
+                return 400, {'error': 'APSPackageNotFound',
+                             'message': "Package {} is not imported".format(package)}
+            instance = dict(payload, aps=dict(payload['aps'], id=str(uuid.uuid4())))
+            self.instances.append(instance)
+        return 200, instance
+
+
+def build_package(path, connector_id='http://example.com/benchmark', version='1.0',
+                  release='1', size=0):
+    """ Write a connector package with APP-META.xml and size bytes of payload"""
+    meta = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<application xmlns="http://aps-standard.org/ns/2" version="2.0">\n'
+            '    <id>{}</id>\n'
+            '    <name>benchmark</name>\n'
+            '    <version>{}</version>\n'
+            '    <release>{}</release>\n'
+            '</application>\n').format(connector_id, version, release)
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as package:
+        package.writestr('APP-META.xml', meta)
+        if size:
+            package.writestr('payload.bin', os.urandom(size))
+
+    return path
@@ -0,0 +1,471 @@
+""" Minimal in-process Kubernetes API server for the benchmarks
+
+Serves secrets, services and pods of the core API, deployments and replica sets of
+extensions/v1beta1 and horizontal pod autoscalers of autoscaling/v1 with create, read, list,
+watch (also across all namespaces), replace, JSON patch, delete and delete collection.
+Deployments are rolled out into a replica set and pods which become ready after rollout_delay,
+LoadBalancer services get the ingress address after expose_delay. FakeBackend answers the
+health checks of the service and pods.
+"""
+from __future__ import print_function
+
+import re
+import copy
+import json
+import time
+import uuid
+import threading
+
+from fake_server import FakeServer
+
+RESOURCES = {
+    'secrets': ('v1', 'Secret'),
+    'services': ('v1', 'Service'),
+    'pods': ('v1', 'Pod'),
+    'deployments': ('extensions/v1beta1', 'Deployment'),
+    'replicasets': ('extensions/v1beta1', 'ReplicaSet'),
+    'horizontalpodautoscalers': ('autoscaling/v1', 'HorizontalPodAutoscaler'),
+}
+PATH_PATTERN = re.compile(r'^/(?:api/v1|apis/extensions/v1beta1|apis/autoscaling/v1)/'
+                          r'(?:namespaces/(?P<namespace>[^/]+)/)?(?P<resource>[a-z]+)'
+                          r'(?:/(?P<name>[^/]+))?(?:/(?P<status>status))?$')
+VERSION = {
+    'major': '1',
+    'minor': '7',
+    'gitVersion': 'v1.7.0-fake',
+    'gitCommit': 'fake',
+    'gitTreeState': 'clean',
+    'buildDate': '2017-07-01T00:00:00Z',
+    'goVersion': 'go1.8.3',
+    'compiler': 'gc',
+    'platform': 'linux/amd64',
+}
+WATCH_MAX_TIMEOUT = 60
+PATCH_CONTENT_TYPES = ('application/json-patch+json', 'application/merge-patch+json',
+                       'application/strategic-merge-patch+json')
+
+
+class FakeKubernetes(FakeServer):
+    def __init__(self, rollout_delay=0.1, expose_delay=0.1, ingress_ip='127.0.0.1',
+                 pod_ip='127.0.0.1', collection_delete=True, **kwargs):
+        super(FakeKubernetes, self).__init__(**kwargs)
+        self.rollout_delay = rollout_delay
+        self.expose_delay = expose_delay
+        self.ingress_ip = ingress_ip
+        self.pod_ip = pod_ip
+        self.collection_delete = collection_delete
+        self.objects = {resource: {} for resource in RESOURCES}
+        self._resource_version = 0
+        self._events = []
+        self._cond = threading.Condition()
+
+    def handle(self, request):
+        if request.path == '/version/' or request.path == '/version':
+            self.count('GET version')
+            return 200, VERSION
+
+        match = PATH_PATTERN.match(request.path)
+        if not match or match.group('resource') not in RESOURCES:
+            self.count('{} unknown'.format(request.method))
+            return _status(404, 'NotFound', "{} not found".format(request.path))
+
+        namespace, resource, name = match.group('namespace', 'resource', 'name')
+        if namespace is None and (name or request.method != 'GET'):
+            # Only lists and watches are served across all namespaces
+            return _status(404, 'NotFound', "{} not found".format(request.path))
+        key = '{} {}{}'.format(request.method, resource, '/status' if match.group('status')
+                               else '')
+        if request.method == 'GET' and not name:
+            key += ' watch' if request.query.get('watch') in ('true', 'True', '1') else ' list'
+        elif request.method == 'DELETE' and not name:
+            key += ' collection'
+        self.count(key)
+
+        if self.should_fail(key):
+            return _status(self.failure_status, 'InternalError', "Injected failure")
+
+        if request.method == 'GET' and name:
+            return self._read(resource, namespace, name)
+        elif request.method == 'GET':
+            if request.query.get('watch') in ('true', 'True', '1'):
+                return 200, self._watch(resource, namespace, request.query)
+            return self._list(resource, namespace, request.query)
+        elif request.method == 'POST' and not name:
+            return self._create(resource, namespace, request.json())
+        elif request.method == 'PUT' and name:
+            return self._replace(resource, namespace, name, request.json())
+        elif request.method == 'PATCH' and name:
+            return self._patch(resource, namespace, name, request.json(),
+                               request.headers.get('Content-Type'))
+        elif request.method == 'DELETE' and name:
+            return self._delete(resource, namespace, name)
+        elif request.method == 'DELETE':
+            if not self.collection_delete:
+                return _status(405, 'MethodNotAllowed', "Collection delete is not supported")
+            return self._delete_collection(resource, namespace, request.query)
+
+        return _status(405, 'MethodNotAllowed', "{} is not supported".format(request.method))
+
+    def _read(self, resource, namespace, name):
+        with self._cond:
+            obj = self.objects[resource].get((namespace, name))
+            if not obj:
+                return _not_found(resource, name)
+            return 200, copy.deepcopy(obj)
+
+    def _list(self, resource, namespace, query):
+        with self._cond:
+            items = [copy.deepcopy(obj) for obj in self._select(resource, namespace, query)]
+            version, kind = RESOURCES[resource]
+            return 200, {
+                'apiVersion': version,
+                'kind': kind + 'List',
+                'metadata': {'resourceVersion': str(self._resource_version)},
+                'items': items,
+            }
+
+    def _watch(self, resource, namespace, query):
+        timeout = min(int(query.get('timeoutSeconds') or WATCH_MAX_TIMEOUT), WATCH_MAX_TIMEOUT)
+        deadline = time.time() + timeout
+
+        with self._cond:
+            if query.get('resourceVersion'):
+                since = int(query['resourceVersion'])
+                pending = []
+            else:
+                since = self._resource_version
+                pending = [('ADDED', copy.deepcopy(obj))
+                           for obj in self._select(resource, namespace, query)]
+
+        while True:
+            for event_type, obj in pending:
+                yield (json.dumps({'type': event_type, 'object': obj}) + '\n').encode('utf-8')
+
+            with self._cond:
+                while since >= self._resource_version and not self.stopped.is_set():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return
+                    self._cond.wait(min(remaining, 0.5))
+                if self.stopped.is_set():
+                    return
+
+                pending = [(event_type, obj) for version, event_type, event_resource, obj
+                           in self._events if version > since and event_resource == resource
+                           and _matches(obj, namespace, query)]
+                since = self._resource_version
+
+    def _create(self, resource, namespace, body):
+        name = body['metadata']['name']
+        with self._cond:
+            if (namespace, name) in self.objects[resource]:
+                return _status(409, 'AlreadyExists', '{} "{}" already exists'.format(resource,
+                                                                                     name))
+            obj = copy.deepcopy(body)
+            version, kind = RESOURCES[resource]
+            obj.update({'apiVersion': version, 'kind': kind})
+            obj['metadata'].update({
+                'namespace': namespace,
+                'uid': str(uuid.uuid4()),
+                'creationTimestamp': _now(),
+                'selfLink': '/{}/namespaces/{}/{}/{}'.format(
+                    'api/v1' if version == 'v1' else 'apis/' + version, namespace, resource,
+                    name),
+            })
+            if resource == 'deployments':
+                obj['metadata']['generation'] = 1
+                obj['status'] = {'observedGeneration': 0}
+            elif resource == 'services':
+                obj['spec'].setdefault('clusterIP', '10.0.0.{}'.format(
+                    len(self.objects['services']) % 250 + 1))
+                obj['status'] = {'loadBalancer': {}}
+
+            self.objects[resource][(namespace, name)] = obj
+            self._emit('ADDED', resource, obj)
+
+        if resource == 'deployments':
+            self._rollout(namespace, name)
+        elif resource == 'services' and obj['spec'].get('type') == 'LoadBalancer':
+            self._later(self.expose_delay, self._expose, namespace, name)
+
+        return 201, copy.deepcopy(obj)
+
+    def _patch(self, resource, namespace, name, body, content_type):
+        # Merge patches must be objects, like the real API server the body is checked against
+        # the content type and not guessed from the JSON
+        content_type = (content_type or '').split(';')[0].strip()
+        if content_type not in PATCH_CONTENT_TYPES:
+            return _status(415, 'UnsupportedMediaType',
+                           "the body of the request was in an unknown format - accepted media "
+                           "types include: {}".format(', '.join(PATCH_CONTENT_TYPES)))
+        if isinstance(body, list) != (content_type == 'application/json-patch+json'):
+            return _status(400, 'BadRequest', "Invalid {} body of {} type".format(
+                content_type, type(body).__name__))
+
+        with self._cond:
+            obj = self.objects[resource].get((namespace, name))
+            if not obj:
+                return _not_found(resource, name)
+
+            patched = copy.deepcopy(obj)
+            try:
+                if isinstance(body, list):
+                    for op in body:
+                        _apply_json_patch_op(patched, op)
+                else:
+                    _merge(patched, body)
+            except (KeyError, IndexError, ValueError) as e:
+                return _status(422, 'Invalid', "Invalid patch: {}".format(e))
+
+            rollout = self._update(resource, namespace, name, obj, patched)
+
+        if rollout:
+            self._rollout(namespace, name)
+
+        return 200, copy.deepcopy(patched)
+
+    def _replace(self, resource, namespace, name, body):
+        with self._cond:
+            obj = self.objects[resource].get((namespace, name))
+            if not obj:
+                return _not_found(resource, name)
+
+            version = body['metadata'].get('resourceVersion')
+            if version and version != obj['metadata']['resourceVersion']:
+                return _status(409, 'Conflict', 'Operation cannot be fulfilled on {} "{}": '
+                               'the object has been modified'.format(resource, name))
+            if resource == 'services' and \
+                    body['spec'].get('clusterIP') != obj['spec'].get('clusterIP'):
+                return _status(422, 'Invalid', 'Service "{}" is invalid: spec.clusterIP: '
+                               'field is immutable'.format(name))
+
+            replaced = copy.deepcopy(body)
+            for key in ('apiVersion', 'kind', 'status'):
+                if key in obj:
+                    replaced[key] = copy.deepcopy(obj[key])
+            for key in ('namespace', 'uid', 'creationTimestamp', 'selfLink', 'generation'):
+                if key in obj['metadata']:
+                    replaced['metadata'][key] = obj['metadata'][key]
+
+            rollout = self._update(resource, namespace, name, obj, replaced)
+
+        if rollout:
+            self._rollout(namespace, name)
+
+        return 200, copy.deepcopy(replaced)
+
+    def _update(self, resource, namespace, name, obj, updated):
+        """ Store the updated object, the caller holds the lock. Returns whether the deployment
+        is rolled out"""
+        rollout = resource == 'deployments' and updated['spec'] != obj['spec']
+        if rollout:
+            updated['metadata']['generation'] += 1
+        self.objects[resource][(namespace, name)] = updated
+        self._emit('MODIFIED', resource, updated)
+        return rollout
+
+    def _delete(self, resource, namespace, name):
+        with self._cond:
+            obj = self.objects[resource].pop((namespace, name), None)
+            if not obj:
+                return _not_found(resource, name)
+            self._emit('DELETED', resource, obj)
+        return _status(200, None, None)
+
+    def _delete_collection(self, resource, namespace, query):
+        with self._cond:
+            for obj in self._select(resource, namespace, query):
+                del self.objects[resource][(namespace, obj['metadata']['name'])]
+                self._emit('DELETED', resource, obj)
+        return _status(200, None, None)
+
+    def _rollout(self, namespace, name):
+        """ Replace replica set and pods of the deployment, pods become ready later"""
+        with self._cond:
+            deployment = self.objects['deployments'].get((namespace, name))
+            if not deployment:
+                return
+
+            generation = deployment['metadata']['generation']
+            template = deployment['spec']['template']
+            replicas = deployment['spec'].get('replicas', 1)
+            labels = dict(template['metadata'].get('labels', {}))
+
+            for resource in ('replicasets', 'pods'):
+                for (obj_namespace, obj_name), obj in list(self.objects[resource].items()):
+                    if obj_namespace == namespace and obj_name.startswith(name + '-'):
+                        del self.objects[resource][(obj_namespace, obj_name)]
+                        self._emit('DELETED', resource, obj)
+
+            rs_name = '{}-{}'.format(name, generation)
+            pod_labels = dict(labels, **{'pod-template-hash': str(generation)})
+
+        self._create('replicasets', namespace, {
+            'metadata': {'name': rs_name, 'labels': pod_labels},
+            'spec': {'replicas': replicas, 'template': template},
+            'status': {'replicas': replicas},
+        })
+        for i in range(replicas):
+            self._create('pods', namespace, {
+                'metadata': {'name': '{}-{}'.format(rs_name, i), 'labels': pod_labels},
+                'spec': copy.deepcopy(template['spec']),
+                'status': {
+                    'phase': 'Pending',
+                    'conditions': [{'type': 'Ready', 'status': 'False'}],
+                },
+            })
+
+        self._update_status('deployments', namespace, name, {
+            'observedGeneration': generation,
+            'replicas': replicas,
+            'updatedReplicas': replicas,
+            'availableReplicas': 0,
+        })
+        self._later(self.rollout_delay, self._ready, namespace, name, rs_name, generation)
+
+    def _ready(self, namespace, name, rs_name, generation):
+        with self._cond:
+            deployment = self.objects['deployments'].get((namespace, name))
+            if not deployment or deployment['metadata']['generation'] != generation:
+                return
+
+            ready = 0
+            for (pod_namespace, pod_name), pod in self.objects['pods'].items():
+                if pod_namespace == namespace and pod_name.startswith(rs_name + '-'):
+                    pod['status'] = {
+                        'phase': 'Running',
+                        'podIP': self.pod_ip,
+                        'conditions': [{'type': 'Ready', 'status': 'True'}],
+                    }
+                    self._emit('MODIFIED', 'pods', pod)
+                    ready += 1
+
+        self._update_status('deployments', namespace, name, {'availableReplicas': ready,
+                                                             'readyReplicas': ready})
+
+    def _expose(self, namespace, name):
+        # Address can be given per service with a function of namespace and name
+        ip = self.ingress_ip(namespace, name) if callable(self.ingress_ip) else self.ingress_ip
+        self._update_status('services', namespace, name,
+                            {'loadBalancer': {'ingress': [{'ip': ip}]}})
+
+    def _update_status(self, resource, namespace, name, status):
+        with self._cond:
+            obj = self.objects[resource].get((namespace, name))
+            if obj:
+                obj.setdefault('status', {}).update(status)
+                self._emit('MODIFIED', resource, obj)
+
+    def _emit(self, event_type, resource, obj):
+        """ Record the event, the caller holds the lock"""
+        self._resource_version += 1
+        obj['metadata']['resourceVersion'] = str(self._resource_version)
+        self._events.append((self._resource_version, event_type, resource, copy.deepcopy(obj)))
+        self._cond.notify_all()
+
+    def _select(self, resource, namespace, query):
+        return [obj for (obj_namespace, _), obj in sorted(self.objects[resource].items())
+                if namespace in (None, obj_namespace) and _matches(obj, namespace, query)]
+
+    def _later(self, delay, func, *args):
+        if not delay:
+            return func(*args)
+        timer = threading.Timer(delay, func, args)
+        timer.daemon = True
+        timer.start()
+
+
+class FakeBackend(FakeServer):
+    """ Connector backend behind the fake service and pods, the health check fails until
+    warmup seconds pass since the start"""
+
+    def __init__(self, warmup=0.0, **kwargs):
+        super(FakeBackend, self).__init__(**kwargs)
+        self.warmup = warmup
+        self.started = None
+
+    @property
+    def address(self):
+        """ Address to use as the ingress or pod IP"""
+        return '127.0.0.1:{}'.format(self.port)
+
+    def start(self):
+        self.started = time.time()
+        return super(FakeBackend, self).start()
+
+    def handle(self, request):
+        self.count('{} {}'.format(request.method, request.path))
+        if time.time() - self.started < self.warmup or self.should_fail(request.path):
+            return 503, b'warming up'
+        return 200, b'ok'
+
+
+def _matches(obj, namespace, query):
+    metadata = obj['metadata']
+    if namespace is not None and metadata.get('namespace') != namespace:
+        return False
+
+    for selector, values in (('labelSelector', metadata.get('labels') or {}),
+                             ('fieldSelector', {'metadata.name': metadata['name'],
+                                                'metadata.namespace': metadata.get('namespace')})):
+        for requirement in filter(None, (query.get(selector) or '').split(',')):
+            key, _, value = requirement.partition('=')
+            if values.get(key) != value:
+                return False
+
+    return True
+
+
+def _apply_json_patch_op(obj, op):
+    keys = [k.replace('~1', '/').replace('~0', '~') for k in op['path'].split('/')[1:]]
+    target = obj
+    for key in keys[:-1]:
+        target = target[int(key)] if isinstance(target, list) else target[key]
+
+    key = keys[-1]
+    if isinstance(target, list):
+        index = len(target) if key == '-' else int(key)
+        if op['op'] == 'add':
+            target.insert(index, op['value'])
+        elif op['op'] == 'replace':
+            target[index] = op['value']
+        elif op['op'] == 'remove':
+            del target[index]
+        else:
+            raise ValueError("unsupported op {}".format(op['op']))
+    elif op['op'] in ('add', 'replace'):
+        target[key] = op['value']
+    elif op['op'] == 'remove':
+        del target[key]
+    else:
+        raise ValueError("unsupported op {}".format(op['op']))
+
+
+def _merge(target, patch):
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+
+
+def _not_found(resource, name):
+    return _status(404, 'NotFound', '{} "{}" not found'.format(resource, name))
+
+
+def _status(code, reason, message):
+    return code, {
+        'kind': 'Status',
+        'apiVersion': 'v1',
+        'metadata': {},
+        'status': 'Success' if code < 400 else 'Failure',
+        'reason': reason,
+        'message': message,
+        'code': code,
+    }
+
+
+def _now():
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
@@ -0,0 +1,156 @@
+""" Base of the in-process fake API servers used by the benchmarks
+
+Every server listens on a random local port in a background thread, counts the requests it
+served and can add latency to and fail a share of the requests.
+"""
+from __future__ import print_function
+
+import json
+import random
+import threading
+from collections import Counter
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeServer(object):
+    """ HTTP server dispatching requests to handle(request), latency is added to every
+    request and failure_rate share of them is answered with failure_status"""
+
+    def __init__(self, latency=0.0, failure_rate=0.0, failure_status=500, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.requests = Counter()
+        self.failures = Counter()
+        self.stopped = threading.Event()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(self))
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, key):
+        with self._lock:
+            self.requests[key] += 1
+
+    def should_fail(self, key):
+        """ Decide whether the request is failed by the injection"""
+        with self._lock:
+            if self.failure_rate and self._random.random() < self.failure_rate:
+                self.failures[key] += 1
+                return True
+        return False
+
+    def delay(self):
+        if self.latency:
+            self.stopped.wait(self.latency * self._random.uniform(0.8, 1.2))
+
+    def total_requests(self):
+        with self._lock:
+            return sum(self.requests.values())
+
+    def handle(self, request):
+        """ Serve the request, returns status, body and optional headers. The body can be
+        a generator of chunks to stream the response"""
+        raise NotImplementedError
+
+
+class Request(object):
+    def __init__(self, handler):
+        url = urlparse(handler.path)
+        self.method = handler.command
+        self.path = url.path
+        self.query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        self.headers = handler.headers
+        length = int(handler.headers.get('Content-Length') or 0)
+        self.body = handler.rfile.read(length) if length else b''
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8')) if self.body else None
+
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _dispatch(self):
+            request = Request(self)
+            server.delay()
+            status, body, headers = (tuple(server.handle(request)) + (None,))[:3]
+            headers = dict(headers or {})
+
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body).encode('utf-8')
+                headers.setdefault('Content-Type', 'application/json')
+            elif body is not None and not isinstance(body, bytes) and hasattr(body, '__iter__'):
+                return self._stream(status, body, headers)
+
+            body = body or b''
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def _stream(self, status, chunks, headers):
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                for chunk in chunks:
+                    self.wfile.write('{:x}\r\n'.format(len(chunk)).encode() + chunk + b'\r\n')
+                    self.wfile.flush()
+                self.wfile.write(b'0\r\n\r\n')
+            except (IOError, OSError):
+                # Client closed the stream
+                self.close_connection = True
+
+        do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = _dispatch
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
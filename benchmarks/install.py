@@ -0,0 +1,426 @@
+""" End to end benchmark of backend and frontend installs against fake API servers
+
+Every scenario runs in a fresh interpreter with in-process fake Kubernetes API and OA Hub
+servers, the wall time and requests served are measured for the scenario action only, peak RSS
+for the whole process, e.g.:
+
+    python benchmarks/install.py --latency-ms 20 --count 20 --workers 8
+    python benchmarks/install.py --scenario backends-batch --failure-rate 0.05 --details
+    python benchmarks/install.py --failure-rate 0.1 --failure-status 503 --retries 6
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import resource
+import tempfile
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from fake_hub import FakeHub, build_package  # noqa: E402
+from fake_k8s import FakeKubernetes, FakeBackend  # noqa: E402
+from apsconnectcli import api  # noqa: E402
+from apsconnectcli import apsconnect  # noqa: E402
+from apsconnectcli import cache as package_cache  # noqa: E402
+from apsconnectcli import status as backend_status  # noqa: E402
+from apsconnectcli.cluster import client  # noqa: E402
+
+REPORT_MARKER = '@@install@@'
+
+
+class Environment(object):
+    """ Fake servers and the clients of the scenario"""
+
+    def __init__(self, options, tdir):
+        self.options = options
+        self.tdir = tdir
+        latency = options.latency_ms / 1000.0
+        api.configure_retries(retries=options.retries)
+        self.backend = FakeBackend(warmup=options.warmup, latency=latency,
+                                   seed=options.seed).start()
+        self.k8s = FakeKubernetes(rollout_delay=options.rollout_delay,
+                                  expose_delay=options.expose_delay,
+                                  ingress_ip=self.backend.address, pod_ip=self.backend.address,
+                                  latency=latency, seed=options.seed).start()
+        self.hubs = [FakeHub(latency=latency,
+                             seed=None if options.seed is None else options.seed + i + 1).start()
+                     for i in range(options.hubs)]
+
+        self.cluster = api.ClusterClient(api_client=client.ApiClient(host=self.k8s.url),
+                                         pool_maxsize=options.workers)
+
+        self.config_file = os.path.join(tdir, 'config.json')
+        with open(self.config_file, 'w') as fd:
+            json.dump({'benchmark': True}, fd)
+
+        self.package_path = build_package(os.path.join(tdir, 'benchmark.app.zip'),
+                                          size=options.package_size * 1024)
+
+    def hub_session(self):
+        return api.HubClient(self.hubs[0].cfg())
+
+    @property
+    def servers(self):
+        return [self.k8s, self.backend] + self.hubs
+
+    def stop(self):
+        for server in self.servers:
+            server.stop()
+
+    def install_backend(self, name, force=False, timeout=60, image='image', **kwargs):
+        return api.install_backend(self.cluster, name, image, {'benchmark': True},
+                                   replicas=self.options.replicas, force=force, wait_for='both',
+                                   timeout=timeout, **kwargs).url
+
+    def install_frontend(self, session, package, skip_imported=False, journal=None):
+        result = api.install_frontend(session, package, 'key', 'secret', 'http://127.0.0.1/',
+                                      skip_imported=skip_imported, journal=journal)
+        return "Connector {} {}-{} installed".format(result.connector_id, result.version,
+                                                     result.release)
+
+    def container(self, name):
+        """ Container of the deployment as stored by the fake API server"""
+        deployment = self.k8s.objects['deployments'][('default', name)]
+        return deployment['spec']['template']['spec']['containers'][0]
+
+
+def backend(env):
+    """ Install a backend and wait for the service and rollout"""
+    return lambda: (True, env.install_backend('backend'))
+
+
+def backend_ready(env):
+    """ Install a backend and probe the service and pods until they are healthy"""
+    return lambda: (True, env.install_backend('backend', verify_ready=True, probe_pods=True))
+
+
+def backend_force(env):
+    """ Re-apply an installed backend with --force and a new image, rolling it out"""
+    env.install_backend('backend')
+
+    def run():
+        url = env.install_backend('backend', force=True, image='image:2')
+        image = env.container('backend')['image']
+        return image == 'image:2', '{}, image {}'.format(url, image)
+
+    return run
+
+
+def backend_force_drop(env):
+    """ Re-apply an installed backend with --force without the CPU request it had"""
+    env.install_backend('backend', cpu_request='100m')
+
+    def run():
+        url = env.install_backend('backend', force=True)
+        requests = env.container('backend')['resources'].get('requests')
+        return not requests, '{}, requests {}'.format(url, requests or '-')
+
+    return run
+
+
+def backend_resume(env):
+    """ Resume a backend install which timed out waiting for the service exposure"""
+    journal_dir = os.path.join(env.tdir, 'journal')
+    env.k8s.expose_delay = max(env.options.expose_delay, 0.5)
+    try:
+        env.install_backend('backend', timeout=0.2,
+                            journal=api.backend_journal(env.cluster, 'backend',
+                                                        journal_dir=journal_dir))
+    except api.WaitTimeoutError:
+        pass
+    else:
+        raise Exception("Install is expected to time out")
+
+    def run():
+        journal = api.backend_journal(env.cluster, 'backend', resume=True,
+                                      journal_dir=journal_dir)
+        steps = sorted(journal.steps)
+        env.install_backend('backend', journal=journal)
+        return True, 'resumed after {}'.format(', '.join(steps))
+
+    return run
+
+
+def backends_batch(env):
+    """ Install --count backends with --workers in parallel like install-many"""
+    specs = [{'name': 'backend-{}'.format(i), 'image': 'image',
+              'config_file': env.config_file, 'replicas': env.options.replicas,
+              'wait_for': 'both', 'timeout': 60} for i in range(env.options.count)]
+
+    def run():
+        with apsconnect.futures.ThreadPoolExecutor(max_workers=env.options.workers) as executor:
+            results = list(executor.map(
+                lambda spec: apsconnect._install_backend_job(spec, env.cluster), specs))
+        failed = len([r for r in results if not r['ok']])
+        return not failed, '{} of {} installed'.format(len(results) - failed, len(results))
+
+    return run
+
+
+def uninstall(env):
+    """ Uninstall a backend and wait for the pods termination"""
+    env.install_backend('backend')
+
+    def run():
+        api.uninstall_backend(env.cluster, 'backend', wait=True, timeout=60)
+        return True, ''
+
+    return run
+
+
+def frontend(env):
+    """ Install a frontend importing the package from the local file"""
+    package = api.fetch_package(env.package_path)
+    return lambda: (True, env.install_frontend(env.hub_session(), package))
+
+
+def frontend_url(env):
+    """ Install a frontend from http source through the package cache"""
+    url = env.hubs[0].serve_file(env.package_path)
+    cache_dir = os.path.join(env.tdir, 'cache')
+
+    def run():
+        # Token is fetched while the package is downloaded like install-frontend does
+        session = env.hub_session()
+        session.prefetch_token()
+        package = package_cache.fetch_package(url, cache_dir=cache_dir)
+        return True, env.install_frontend(session, package)
+
+    return run
+
+
+def frontend_skip(env):
+    """ Install a frontend with --skip-imported when the package is already imported"""
+    package = api.fetch_package(env.package_path)
+    env.install_frontend(env.hub_session(), package)
+    return lambda: (True, env.install_frontend(env.hub_session(), package, skip_imported=True))
+
+
+def frontend_resume(env):
+    """ Resume a frontend install which failed creating the instance after the import"""
+    journal_dir = os.path.join(env.tdir, 'journal')
+    package = api.fetch_package(env.package_path)
+    session = env.hub_session()
+
+    def fail(payload):
+        raise api.HubError("Instance creation failed")
+
+    session.create_instance = fail
+    try:
+        env.install_frontend(session, package,
+                             journal=api.frontend_journal(session, package,
+                                                          journal_dir=journal_dir))
+    except api.HubError:
+        pass
+
+    def run():
+        session = env.hub_session()
+        journal = api.frontend_journal(session, package, resume=True, journal_dir=journal_dir)
+        steps = sorted(journal.steps)
+        env.install_frontend(session, package, journal=journal)
+        return True, 'resumed after {}'.format(', '.join(steps))
+
+    return run
+
+
+def frontend_hubs(env):
+    """ Install a frontend to --hubs hub profiles concurrently"""
+    cfg_path = os.path.join(env.tdir, 'aps_config')
+    with open(cfg_path, 'w') as fd:
+        json.dump({'profiles': {'hub{}'.format(i): hub.cfg()
+                                for i, hub in enumerate(env.hubs)}}, fd)
+    package = api.fetch_package(env.package_path)
+
+    def install(hub, log):
+        return env.install_frontend(hub, package)
+
+    def run():
+        sessions = [(name, api.HubClient.from_config(cfg))
+                    for name, cfg in api.hub_profiles('all', cfg_path)]
+        results = apsconnect._run_on_hubs(sessions, install)
+        failed = len([r for r in results if not r['ok']])
+        return not failed, '{} of {} hubs'.format(len(results) - failed, len(results))
+
+    return run
+
+
+def status(env):
+    """ Collect the status of --count backends with their instances spread over --hubs hubs"""
+    env.k8s.ingress_ip = lambda namespace, name: '10.0.{}.{}'.format(
+        *divmod(int(name.rsplit('-', 1)[1]), 256))
+    specs = [{'name': 'backend-{}'.format(i), 'image': 'image',
+              'config_file': env.config_file, 'replicas': env.options.replicas,
+              'timeout': 60} for i in range(env.options.count)]
+    with apsconnect.futures.ThreadPoolExecutor(max_workers=env.options.workers) as executor:
+        results = list(executor.map(
+            lambda spec: apsconnect._install_backend_job(spec, env.cluster), specs))
+
+    package = api.fetch_package(env.package_path)
+    sessions = [('hub{}'.format(i), api.HubClient(hub.cfg())) for i, hub in enumerate(env.hubs)]
+    for i, result in enumerate(results):
+        api.install_frontend(sessions[i % len(sessions)][1], package, 'key', 'secret',
+                             result['details'], skip_imported=True)
+
+    def run():
+        snapshot = backend_status.collect_status(env.cluster, sessions)
+        matched = sum(len(row['instances']) for row in backend_status.join(snapshot)
+                      if row['name'])
+        return not snapshot['errors'], '{} backends, {} instances, {} matched{}'.format(
+            len(snapshot['backends']), len(snapshot['frontends']), matched,
+            ''.join('; ' + error for error in snapshot['errors']))
+
+    return run
+
+
+SCENARIOS = (
+    ('backend', backend),
+    ('backend-ready', backend_ready),
+    ('backend-force', backend_force),
+    ('backend-force-drop', backend_force_drop),
+    ('backend-resume', backend_resume),
+    ('backends-batch', backends_batch),
+    ('uninstall', uninstall),
+    ('frontend', frontend),
+    ('frontend-url', frontend_url),
+    ('frontend-skip', frontend_skip),
+    ('frontend-resume', frontend_resume),
+    ('frontend-hubs', frontend_hubs),
+    ('status', status),
+)
+
+
+def _peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def run_scenario(name, options):
+    """ Run the scenario in this process, returns its report"""
+    setup = dict(SCENARIOS)[name]
+    tdir = tempfile.mkdtemp(prefix='apsconnect-bench-')
+    env = Environment(options, tdir)
+    try:
+        action = setup(env)
+        # Failures are injected into the measured action only, the setup must succeed
+        for server in env.servers:
+            server.failure_rate = options.failure_rate
+            server.failure_status = options.failure_status
+        before = [dict(server.requests) for server in env.servers]
+        started = time.time()
+        try:
+            ok, details = action()
+        except Exception as e:
+            ok, details = False, ' '.join(str(e).splitlines())
+        elapsed = time.time() - started
+
+        requests = {}
+        for label, server, counts in zip(['k8s', 'backend'] + ['hub'] * len(env.hubs),
+                                         env.servers, before):
+            for key, value in server.requests.items():
+                value -= counts.get(key, 0)
+                if value:
+                    key = '{} {}'.format(label, key)
+                    requests[key] = requests.get(key, 0) + value
+
+        return {
+            'scenario': name,
+            'ok': ok,
+            'details': details or '',
+            'elapsed': elapsed,
+            'k8s_requests': sum(v for k, v in requests.items() if k.startswith('k8s ')),
+            'hub_requests': sum(v for k, v in requests.items() if k.startswith('hub ')),
+            'backend_requests': sum(v for k, v in requests.items()
+                                    if k.startswith('backend ')),
+            'injected_failures': sum(sum(s.failures.values()) for s in env.servers),
+            'requests': requests,
+            'peak_rss': _peak_rss(),
+        }
+    finally:
+        env.stop()
+        shutil.rmtree(tdir, ignore_errors=True)
+
+
+def spawn_scenario(name, argv):
+    """ Run the scenario in a fresh interpreter, so peak RSS is not shared"""
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', name] + argv,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    for line in out.decode('utf-8', 'replace').splitlines():
+        if line.startswith(REPORT_MARKER):
+            return json.loads(line[len(REPORT_MARKER):])
+
+    output = (out + err).decode('utf-8', 'replace')
+    return {'scenario': name, 'ok': False, 'details': ''.join(output.strip().splitlines()[-1:]),
+            'elapsed': 0, 'k8s_requests': 0, 'hub_requests': 0, 'backend_requests': 0,
+            'injected_failures': 0,
+            'requests': {}, 'peak_rss': 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=[s[0] for s in SCENARIOS],
+                        help="scenario to run, can be repeated, all by default")
+    parser.add_argument('--latency-ms', type=float, default=0, help="latency of every request")
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help="share of requests answered with --failure-status")
+    parser.add_argument('--failure-status', type=int, default=500,
+                        help="HTTP status of the injected failures")
+    parser.add_argument('--retries', type=int, default=None,
+                        help="retries of the failed API calls")
+    parser.add_argument('--seed', type=int, default=None, help="seed of failure injection")
+    parser.add_argument('--count', type=int, default=10, help="backends in batch install")
+    parser.add_argument('--workers', type=int, default=4, help="workers of batch install")
+    parser.add_argument('--replicas', type=int, default=2, help="replicas of every backend")
+    parser.add_argument('--hubs', type=int, default=3, help="hubs of multi-hub install")
+    parser.add_argument('--rollout-delay', type=float, default=0.1,
+                        help="seconds until the pods are ready")
+    parser.add_argument('--expose-delay', type=float, default=0.1,
+                        help="seconds until the service gets the ingress address")
+    parser.add_argument('--warmup', type=float, default=0.3,
+                        help="seconds until the backend health check passes")
+    parser.add_argument('--package-size', type=int, default=1024,
+                        help="connector package payload, KB")
+    parser.add_argument('--details', action='store_true', help="print requests by endpoint")
+    parser.add_argument('--json', action='store_true', help="print reports as JSON")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.child:
+        report = run_scenario(options.child, options)
+        print(REPORT_MARKER + json.dumps(report))
+        return
+
+    argv = [arg for arg in sys.argv[1:] if arg not in ('--details', '--json')]
+    reports = [spawn_scenario(name, argv) for name in options.scenario or
+               [s[0] for s in SCENARIOS]]
+
+    if options.json:
+        print(json.dumps(reports, indent=4))
+    else:
+        apsconnect._print_table(
+            ('SCENARIO', 'STATUS', 'WALL', 'K8S REQ', 'HUB REQ', 'BACKEND REQ', 'INJECTED',
+             'PEAK RSS', 'DETAILS'),
+            [(r['scenario'], 'ok' if r['ok'] else 'FAILED', '{:.3f}s'.format(r['elapsed']),
+              r['k8s_requests'], r['hub_requests'], r['backend_requests'],
+              r['injected_failures'],
+              apsconnect._format_size(r['peak_rss']), r['details']) for r in reports])
+
+        if options.details:
+            for r in reports:
+                print()
+                print(r['scenario'])
+                for key, value in sorted(r['requests'].items()):
+                    print('    {:<48} {}'.format(key, value))
+
+    sys.exit(0 if all(r['ok'] for r in reports) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+""" Start up benchmark of apsconnect commands
+
+Runs every command in a fresh interpreter, reports the median wall time and heavy modules
+imported by the command. Exits with non-zero code if a command imports a module outside of its
+budget or is slower than --max-time seconds, e.g.:
+
+    python benchmarks/startup.py --runs 10 --max-time 0.5
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('fire', 'kubernetes', 'osaapi', 'requests', 'yaml')
+REPORT_MARKER = '@@startup@@'
+
+# Command arguments and heavy modules the command is allowed to import
+COMMANDS = (
+    (('--help',), ('fire',)),
+    (('generate-oauth', 'benchmark'), ('fire',)),
+    (('cache', 'list'), ('fire',)),
+    (('install-backend', '--help'), ('fire',)),
+    (('install-frontend', '--help'), ('fire',)),
+)
+
+RUNNER = """
+import atexit, json, sys, time
+started = time.time()
+
+def report():
+    sys.__stderr__.write({marker!r} + json.dumps({{
+        'elapsed': time.time() - started,
+        'modules': sorted(m for m in {modules!r} if m in sys.modules),
+    }}) + '\\n')
+
+atexit.register(report)
+sys.argv = ['apsconnect'] + {args!r}
+from apsconnectcli.apsconnect import main
+main()
+"""
+
+
+def run_command(args):
+    code = RUNNER.format(marker=REPORT_MARKER, modules=HEAVY_MODULES, args=list(args))
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR, HOME=os.environ.get('HOME', ROOT_DIR))
+    started = time.time()
+    proc = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, env=env, cwd=ROOT_DIR)
+    out, err = proc.communicate()
+    wall = time.time() - started
+    output = err.decode('utf-8', 'replace')
+
+    # Report is written at exit even if the command crashed, it is not a start up sample then
+    if proc.returncode != 0:
+        raise Exception("Command {} failed with exit code {}:\n{}{}".format(
+            ' '.join(args), proc.returncode, out.decode('utf-8', 'replace'), output))
+
+    for line in output.splitlines():
+        if line.startswith(REPORT_MARKER):
+            report = json.loads(line[len(REPORT_MARKER):])
+            report['wall'] = wall
+            return report
+
+    raise Exception("Command {} didn't report:\n{}".format(' '.join(args), output))
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help="runs per command")
+    parser.add_argument('--max-time', type=float, default=None,
+                        help="fail if median wall time of a command exceeds it, seconds")
+    options = parser.parse_args()
+
+    failed = False
+    row = '{:<28}  {:>9}  {:>9}  {}'
+    print(row.format('COMMAND', 'WALL', 'IN-PROC', 'HEAVY MODULES'))
+
+    for args, allowed in COMMANDS:
+        reports = [run_command(args) for _ in range(options.runs)]
+        wall = median([r['wall'] for r in reports])
+        elapsed = median([r['elapsed'] for r in reports])
+        modules = reports[-1]['modules']
+        unexpected = [m for m in modules if m not in allowed]
+
+        print(row.format(' '.join(args), '{:.3f}s'.format(wall), '{:.3f}s'.format(elapsed),
+                         ', '.join(modules) or '-'))
+
+        if unexpected:
+            print("  FAILED: unexpected imports {}".format(', '.join(unexpected)))
+            failed = True
+        if options.max_time is not None and wall > options.max_time:
+            print("  FAILED: {:.3f}s exceeds {:.3f}s".format(wall, options.max_time))
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()